@@ -0,0 +1,126 @@
+import os
+import math
+import time
+import asyncio
+from typing import Dict, Optional
+
+from fastapi import HTTPException
+
+from metrics import registry
+from pool import db_pool_size
+
+# Control de admisión por clase de endpoint (por worker).
+# Las clases pesadas (export, bulk) tienen su propio límite de concurrencia y una cola de
+# espera acotada, y además comparten un tope común de DB_POOL_SIZE − reserva: esas
+# conexiones quedan siempre libres para las rutas interactivas (firmas, búsquedas), que
+# no pasan por aquí. Si la cola está llena se responde 429; si se agota la espera, 503.
+# Ambos con Retry-After estimado según lo que tardan las solicitudes de la clase.
+
+# Conexiones del pool reservadas para rutas interactivas
+def interactive_reserved() -> int:
+    return int(os.getenv("ADMISSION_INTERACTIVE_RESERVED", str(max(1, math.ceil(db_pool_size() * 0.4)))))
+
+# Espera máxima (s) en cola antes de responder 503
+ADMISSION_WAIT_SECONDS = float(os.getenv("ADMISSION_WAIT_SECONDS", "5"))
+
+# Límite de concurrencia y largo de cola por clase
+CLASSES = {
+    "export": (int(os.getenv("ADMISSION_EXPORT_LIMIT", "2")), int(os.getenv("ADMISSION_EXPORT_QUEUE", "4"))),
+    "bulk": (int(os.getenv("ADMISSION_BULK_LIMIT", "1")), int(os.getenv("ADMISSION_BULK_QUEUE", "2"))),
+}
+
+ADMITTED = registry.counter(
+    "admission_admitted_total", "Solicitudes admitidas", ("class",))
+REJECTED = registry.counter(
+    "admission_rejected_total", "Solicitudes rechazadas (queue_full = 429, timeout = 503)", ("class", "reason"))
+IN_FLIGHT = registry.gauge(
+    "admission_in_flight", "Solicitudes admitidas en curso", ("class",))
+WAITING = registry.gauge(
+    "admission_waiting", "Solicitudes esperando admisión", ("class",))
+WAIT_SECONDS = registry.histogram(
+    "admission_wait_seconds", "Espera en cola antes de ser admitida", ("class",))
+
+
+class Limiter:
+    """Semáforo con cola acotada y estimación del tiempo de servicio (EWMA)."""
+
+    def __init__(self, name: str, limit: int, queue_size: int):
+        self.name = name
+        self.limit = max(limit, 1)
+        self.queue_size = max(queue_size, 0)
+        self._semaphore = asyncio.Semaphore(self.limit)
+        self._active = 0
+        self._waiting = 0
+        self._service_seconds = 1.0
+
+    def retry_after(self) -> int:
+        """Segundos estimados hasta que se libere un cupo para quien llegue ahora."""
+        backlog = (self._waiting + 1) / self.limit
+        return max(1, math.ceil(backlog * self._service_seconds))
+
+    def _reject(self, status_code: int, reason: str, message: str):
+        REJECTED.inc(self.name, reason)
+        raise HTTPException(status_code=status_code, detail=message,
+                            headers={"Retry-After": str(self.retry_after())})
+
+    async def acquire(self, deadline: float) -> None:
+        start = time.monotonic()
+        if not self._semaphore.locked():
+            # Hay cupo: se toma sin ceder el event loop
+            await self._semaphore.acquire()
+        else:
+            if self._waiting >= self.queue_size:
+                self._reject(429, "queue_full", "Demasiadas solicitudes de este tipo en curso, reintente más tarde")
+            self._waiting += 1
+            WAITING.set(self.name, value=self._waiting)
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), max(deadline - start, 0))
+            except asyncio.TimeoutError:
+                self._reject(503, "timeout", "Servicio ocupado, reintente más tarde")
+            finally:
+                self._waiting -= 1
+                WAITING.set(self.name, value=self._waiting)
+        WAIT_SECONDS.observe(time.monotonic() - start, self.name)
+        self._active += 1
+        IN_FLIGHT.set(self.name, value=self._active)
+
+    def release(self, held: Optional[float] = None) -> None:
+        """held = duración del request; None si se suelta sin haberlo atendido."""
+        self._active -= 1
+        IN_FLIGHT.set(self.name, value=self._active)
+        if held is not None:
+            self._service_seconds = 0.8 * self._service_seconds + 0.2 * held
+        self._semaphore.release()
+
+
+# Tope común de las clases pesadas: lo que queda del pool tras la reserva interactiva
+_heavy = Limiter("heavy", db_pool_size() - interactive_reserved(),
+                 sum(queue for _, queue in CLASSES.values()))
+_limiters: Dict[str, Limiter] = {name: Limiter(name, limit, queue) for name, (limit, queue) in CLASSES.items()}
+
+
+def admit(klass: str):
+    """
+    Dependencia de FastAPI que reserva un cupo de la clase durante todo el request:
+    Depends(admit("export")).
+    """
+    limiter = _limiters[klass]
+
+    async def dependency():
+        deadline = time.monotonic() + ADMISSION_WAIT_SECONDS
+        await limiter.acquire(deadline)
+        try:
+            await _heavy.acquire(deadline)
+        except BaseException:
+            limiter.release()
+            raise
+        ADMITTED.inc(klass)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            held = time.monotonic() - start
+            _heavy.release(held)
+            limiter.release(held)
+
+    return dependency
@@ -0,0 +1,302 @@
+import os
+import csv
+import sys
+import gzip
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: sin lock entre procesos
+    fcntl = None
+
+from db import (
+    ARCHIVE_USER_COLUMNS, ARCHIVE_PRODUCT_COLUMNS,
+    archive_nomina_rows, restore_archived_nomina,
+)
+from invalidation import channel
+from push import TOPIC as NOMINA_EVENT_TOPIC
+
+# Archivo frío de nóminas cerradas.
+# Cada nómina archivada queda en ARCHIVE_DIR/nomina-<id>/ como users.csv.gz y
+# products.csv.gz (firmas incluidas) más un manifest.json con conteos y checksums;
+# ARCHIVE_DIR/index.json resume todas. Se leen en modo solo lectura desde /exportExcel
+# y /report, y restore_nomina las devuelve a las tablas calientes.
+# En despliegues con disco efímero ARCHIVE_DIR debe apuntar a un volumen persistente.
+
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+
+logger = logging.getLogger("archive")
+
+# Marca de NULL en los CSV (distinto de cadena vacía)
+_NULL = "\\N"
+
+_INT_COLUMNS = {
+    "idUser", "nomina_idNomina", "nomina_idClient", "idProduct", "quantity",
+    "user_idUser", "user_nomina_idNomina", "user_nomina_idClient",
+}
+
+# Las firmas son campos largos
+csv.field_size_limit(min(sys.maxsize, 2 ** 31 - 1))
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def _nomina_dir(nomina_id: int) -> str:
+    return os.path.join(ARCHIVE_DIR, f"nomina-{int(nomina_id)}")
+
+
+def _encode(value: Any) -> str:
+    if value is None:
+        return _NULL
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    return str(value)
+
+
+def _decode(column: str, value: str) -> Any:
+    if value == _NULL:
+        return None
+    if column in _INT_COLUMNS:
+        return int(value)
+    if column == "signatureDate":
+        return datetime.fromisoformat(value)
+    return value
+
+
+def _write_csv_gz(path: str, columns: List[str], rows: List[Dict]) -> str:
+    """Escribe el CSV comprimido de forma atómica y devuelve su sha256."""
+    tmp = f"{path}.tmp-{os.getpid()}"
+    with gzip.open(tmp, "wt", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow([_encode(row.get(c)) for c in columns])
+    with open(tmp, "rb") as f:
+        os.fsync(f.fileno())
+        digest = hashlib.sha256()
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    os.replace(tmp, path)
+    return digest.hexdigest()
+
+
+def _read_csv_gz(path: str) -> List[Dict]:
+    with gzip.open(path, "rt", encoding="utf-8", newline="") as f:
+        reader = csv.reader(f)
+        columns = next(reader)
+        return [{c: _decode(c, v) for c, v in zip(columns, row)} for row in reader]
+
+
+def _sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ArchiveIndex:
+    """index.json con el manifest de cada nómina archivada; se relee si cambió en disco."""
+
+    def __init__(self, directory: str):
+        self.path = os.path.join(directory, "index.json")
+        self._entries: Dict[str, Dict] = {}
+        self._mtime = None
+
+    @contextmanager
+    def _locked(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + ".lock", "w") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def _load(self) -> None:
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            self._entries, self._mtime = {}, None
+            return
+        if mtime != self._mtime:
+            with open(self.path, encoding="utf-8") as f:
+                self._entries = json.load(f).get("nominas", {})
+            self._mtime = mtime
+
+    def _save(self) -> None:
+        tmp = f"{self.path}.tmp-{os.getpid()}"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"nominas": self._entries}, f, ensure_ascii=False, indent=1, default=str)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self._mtime = os.stat(self.path).st_mtime_ns
+
+    def get(self, nomina_id: int) -> Optional[Dict]:
+        self._load()
+        return self._entries.get(str(nomina_id))
+
+    def all(self) -> List[Dict]:
+        self._load()
+        return list(self._entries.values())
+
+    def put(self, manifest: Dict) -> None:
+        with self._locked():
+            self._mtime = None
+            self._load()
+            self._entries[str(manifest["idNomina"])] = manifest
+            self._save()
+
+    def remove(self, nomina_id: int) -> None:
+        with self._locked():
+            self._mtime = None
+            self._load()
+            self._entries.pop(str(nomina_id), None)
+            self._save()
+
+
+index = ArchiveIndex(ARCHIVE_DIR)
+
+
+def _write_archive(nomina: Dict, users: List[Dict], products: List[Dict]) -> Dict:
+    directory = _nomina_dir(nomina["idNomina"])
+    os.makedirs(directory, exist_ok=True)
+    manifest = {
+        "idNomina": nomina["idNomina"],
+        "name": nomina["name"],
+        "client_idClient": nomina["client_idClient"],
+        "archived_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "users": len(users),
+        "products": len(products),
+        "signed": sum(1 for u in users if u.get("signature")),
+        "files": {
+            "users.csv.gz": _write_csv_gz(os.path.join(directory, "users.csv.gz"), ARCHIVE_USER_COLUMNS, users),
+            "products.csv.gz": _write_csv_gz(os.path.join(directory, "products.csv.gz"), ARCHIVE_PRODUCT_COLUMNS, products),
+        },
+    }
+    # Se verifica lo escrito antes de borrar nada de la base
+    if len(_read_csv_gz(os.path.join(directory, "users.csv.gz"))) != len(users):
+        raise ArchiveError("El archivo de usuarios no coincide con la base de datos")
+    with open(os.path.join(directory, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    return manifest
+
+
+def _read_archive(nomina_id: int) -> Dict[str, List[Dict]]:
+    manifest = index.get(nomina_id)
+    if manifest is None:
+        raise ArchiveError(f"La nómina {nomina_id} no está archivada")
+    directory = _nomina_dir(nomina_id)
+    data = {}
+    for name, checksum in manifest["files"].items():
+        path = os.path.join(directory, name)
+        if _sha256(path) != checksum:
+            raise ArchiveError(f"Checksum inválido en {path}")
+        data[name.split(".", 1)[0]] = _read_csv_gz(path)
+    return data
+
+
+def is_archived(nomina_id: int) -> bool:
+    return index.get(nomina_id) is not None
+
+
+def _discard(nomina_id: int) -> None:
+    """Saca la nómina del índice y borra sus archivos."""
+    index.remove(nomina_id)
+    directory = _nomina_dir(nomina_id)
+    for name in ("users.csv.gz", "products.csv.gz", "manifest.json"):
+        try:
+            os.remove(os.path.join(directory, name))
+        except FileNotFoundError:
+            pass
+    try:
+        os.rmdir(directory)
+    except OSError:
+        pass
+
+
+def _on_nomina_event(key: str, payload: Optional[Dict]) -> None:
+    # Borrar la nómina (o su cliente) borra también su archivo: si no, /exportExcel y
+    # /report la seguirían sirviendo desde el índice y /restore fallaría sin la fila nomina
+    if payload and payload.get("type") == "nomina_deleted" and is_archived(int(key)):
+        _discard(int(key))
+        logger.info("Nómina %s eliminada: se borró su archivo", key)
+
+
+channel.subscribe(NOMINA_EVENT_TOPIC, _on_nomina_event)
+
+
+async def archive_nomina(nomina_id: int) -> Dict:
+    """
+    Escribe la nómina al archivo y lo verifica dentro de la transacción que la tiene
+    bloqueada; solo si eso resulta se borran las filas calientes.
+    """
+    async def store(nomina: Dict, users: List[Dict], products: List[Dict]) -> Dict:
+        if nomina["archived_at"] is not None:
+            raise ArchiveError(f"La nómina {nomina_id} ya está archivada")
+        manifest = await asyncio.to_thread(_write_archive, nomina, users, products)
+        await asyncio.to_thread(index.put, manifest)
+        return manifest
+
+    try:
+        manifest = await archive_nomina_rows(nomina_id, store)
+    except ArchiveError:
+        raise
+    except Exception:
+        # La base quedó intacta: el archivo no debe figurar en el índice
+        await asyncio.to_thread(index.remove, nomina_id)
+        raise
+    if manifest is None:
+        raise ArchiveError(f"La nómina {nomina_id} no existe")
+    logger.info("Nómina %s archivada: %s usuarios, %s productos",
+                nomina_id, manifest["users"], manifest["products"])
+    return manifest
+
+
+async def restore_nomina(nomina_id: int) -> Dict:
+    """Reinserta usuarios y productos con sus IDs originales y elimina el archivo."""
+    data = await asyncio.to_thread(_read_archive, nomina_id)
+    await restore_archived_nomina(nomina_id, data["users"], data["products"])
+    await asyncio.to_thread(_discard, nomina_id)
+    return {"idNomina": nomina_id, "users": len(data["users"]), "products": len(data["products"])}
+
+
+async def export_rows(nomina_id: int) -> List[Dict]:
+    """Filas con la misma forma que export_excel_query, leídas del archivo."""
+    data = await asyncio.to_thread(_read_archive, nomina_id)
+    products_by_user: Dict[int, List[Dict]] = {}
+    for p in data["products"]:
+        products_by_user.setdefault(p["user_idUser"], []).append(p)
+    rows = []
+    for u in data["users"]:
+        base = {
+            "rut": u["rut"], "username": u["name"], "lastName": u["lastName"], "area": u["area"],
+            "signature": u["signature"], "employee": u["employee"], "signatureDate": u["signatureDate"],
+            "sex": u["sex"], "center": u["center"], "service": u["service"],
+        }
+        # Igual que el LEFT JOIN: una fila por producto, o una sola con NULL si no tiene
+        for p in products_by_user.get(u["idUser"]) or [None]:
+            rows.append({
+                **base,
+                "sku": p and p["sku"], "productName": p and p["name"], "color": p and p["color"],
+                "quantity": p and p["quantity"], "size": p and p["size"],
+            })
+    return rows
+
+
+def report_counts(nomina_id: int) -> Optional[Dict[str, int]]:
+    """Conteos del reporte guardados en el manifest (None si no está archivada)."""
+    manifest = index.get(nomina_id)
+    if manifest is None:
+        return None
+    return {"total": manifest["users"], "signed": manifest["signed"]}
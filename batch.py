@@ -0,0 +1,170 @@
+import os
+import json
+import gzip
+import base64
+import asyncio
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlsplit
+
+from fastapi import HTTPException
+from fastapi.responses import Response
+from fastapi.encoders import jsonable_encoder
+
+from metrics import registry
+
+# /batch: varias operaciones contra las rutas existentes en un solo round trip.
+# Cada operación se despacha dentro del proceso a la app ASGI completa (middlewares,
+# dependencias y validación incluidos), con los headers del request original. Las
+# lecturas consecutivas corren en paralelo; cada escritura espera a las anteriores y las
+# lecturas posteriores la ven (misma ventana read-your-writes del cliente).
+
+BATCH_MAX_OPERATIONS = int(os.getenv("BATCH_MAX_OPERATIONS", "50"))
+# Lecturas simultáneas por batch (cada una puede tomar una conexión del pool)
+BATCH_READ_CONCURRENCY = int(os.getenv("BATCH_READ_CONCURRENCY", "6"))
+# Solo para lecturas: cancelar una escritura a mitad de su transacción soltaría una
+# conexión todavía en uso y el cliente recibiría 504 por algo que igual puede confirmarse
+BATCH_OPERATION_TIMEOUT = float(os.getenv("BATCH_OPERATION_TIMEOUT", "30"))
+# Respuestas más chicas no se comprimen
+BATCH_GZIP_MIN_BYTES = 512
+
+_READS = {"GET", "HEAD"}
+_METHODS = _READS | {"POST", "PUT", "PATCH", "DELETE"}
+# Headers del request original que no aplican a las operaciones internas
+_DROPPED_HEADERS = {b"content-length", b"content-type", b"accept-encoding", b"transfer-encoding"}
+
+OPERATIONS = registry.counter(
+    "batch_operations_total", "Operaciones ejecutadas dentro de /batch", ("method", "outcome"))
+BATCH_SIZE = registry.histogram(
+    "batch_size_operations", "Operaciones por request a /batch", buckets=(1, 2, 5, 10, 20, 50, 100))
+
+
+class _Unsupported(Exception):
+    pass
+
+
+def validate(operations: List[Dict]) -> None:
+    if not operations:
+        raise HTTPException(status_code=400, detail="El batch no tiene operaciones")
+    if len(operations) > BATCH_MAX_OPERATIONS:
+        raise HTTPException(status_code=400, detail=f"Máximo {BATCH_MAX_OPERATIONS} operaciones por batch")
+    for i, op in enumerate(operations):
+        method = op.get("method", "GET").upper()
+        path = op.get("path") or ""
+        if method not in _METHODS:
+            raise HTTPException(status_code=400, detail=f"Operación {i}: método no soportado {method}")
+        if not path.startswith("/") or urlsplit(path).path.rstrip("/") == "/batch":
+            raise HTTPException(status_code=400, detail=f"Operación {i}: path inválido")
+
+
+async def _dispatch(app, parent_scope: Dict, op: Dict) -> Dict[str, Any]:
+    method = op.get("method", "GET").upper()
+    url = urlsplit(op["path"])
+    body = b"" if op.get("body") is None else json.dumps(op["body"]).encode("utf-8")
+    headers = [(k, v) for k, v in parent_scope.get("headers", []) if k not in _DROPPED_HEADERS]
+    if body:
+        headers += [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+    scope = {
+        **{k: v for k, v in parent_scope.items() if k in ("type", "asgi", "http_version", "scheme", "server", "client", "root_path")},
+        "method": method,
+        "path": url.path,
+        "raw_path": url.path.encode("utf-8"),
+        "query_string": url.query.encode("utf-8"),
+        "headers": headers,
+        "state": dict(parent_scope.get("state") or {}),
+    }
+
+    sent = False
+    done = asyncio.Event()
+
+    async def receive():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        # Nunca hay desconexión: la operación termina cuando responde
+        await done.wait()
+        return {"type": "http.disconnect"}
+
+    status, content_type, chunks = 500, "", []
+
+    async def send(message):
+        nonlocal status, content_type
+        if message["type"] == "http.response.start":
+            status = message["status"]
+            content_type = dict(message.get("headers", [])).get(b"content-type", b"").decode("latin-1")
+            if content_type.startswith("text/event-stream"):
+                raise _Unsupported()
+        elif message["type"] == "http.response.body":
+            chunks.append(message.get("body", b""))
+
+    try:
+        if method in _READS:
+            await asyncio.wait_for(app(scope, receive, send), BATCH_OPERATION_TIMEOUT)
+        else:
+            await app(scope, receive, send)
+    except _Unsupported:
+        return {"status": 400, "body": {"detail": "Las rutas de streaming no se pueden usar en /batch"}}
+    except asyncio.TimeoutError:
+        return {"status": 504, "body": {"detail": "La lectura excedió el tiempo máximo del batch"}}
+    except Exception:
+        # ServerErrorMiddleware ya respondió (500, o lo que haya enviado el handler) y relanza
+        if not content_type:
+            return {"status": 500, "body": {"detail": "Error interno en la operación"}}
+    finally:
+        done.set()
+
+    raw = b"".join(chunks)
+    if content_type.startswith("application/json"):
+        result = json.loads(raw) if raw else None
+    elif content_type.startswith("text/"):
+        result = raw.decode("utf-8", errors="replace")
+    else:
+        return {"status": status, "encoding": "base64", "body": base64.b64encode(raw).decode("ascii")}
+    return {"status": status, "body": result}
+
+
+async def run(app, parent_scope: Dict, operations: List[Dict], stop_on_error: bool = False) -> List[Dict]:
+    """
+    Ejecuta las operaciones y devuelve sus resultados en el mismo orden. Con stop_on_error,
+    una escritura fallida (status >= 400) deja las siguientes operaciones sin ejecutar (424).
+    """
+    BATCH_SIZE.observe(len(operations))
+    results: List[Optional[Dict]] = [None] * len(operations)
+    semaphore = asyncio.Semaphore(max(BATCH_READ_CONCURRENCY, 1))
+
+    async def read(i: int, op: Dict) -> None:
+        async with semaphore:
+            results[i] = await _dispatch(app, parent_scope, op)
+
+    pending_reads: List = []
+    failed = False
+    for i, op in enumerate(operations):
+        method = op.get("method", "GET").upper()
+        if failed:
+            results[i] = {"status": 424, "body": {"detail": "No ejecutada: falló una escritura anterior del batch"}}
+            continue
+        if method in _READS:
+            pending_reads.append(read(i, op))
+            continue
+        # Una escritura espera a las lecturas anteriores y las posteriores esperan a la escritura
+        await asyncio.gather(*pending_reads)
+        pending_reads = []
+        results[i] = await _dispatch(app, parent_scope, op)
+        failed = stop_on_error and results[i]["status"] >= 400
+    await asyncio.gather(*pending_reads)
+
+    for op, result in zip(operations, results):
+        status = result["status"]
+        OPERATIONS.inc(op.get("method", "GET").upper(), "skipped" if status == 424 else "ok" if status < 400 else "error")
+    return results
+
+
+def respond(results: List[Dict], accept_encoding: str) -> Response:
+    """Respuesta JSON única, comprimida con gzip si el cliente lo acepta."""
+    payload = json.dumps(jsonable_encoder({"results": results}), ensure_ascii=False,
+                         separators=(",", ":")).encode("utf-8")
+    headers = {"Vary": "Accept-Encoding"}
+    if "gzip" in (accept_encoding or "") and len(payload) >= BATCH_GZIP_MIN_BYTES:
+        payload = gzip.compress(payload, compresslevel=6)
+        headers["Content-Encoding"] = "gzip"
+    return Response(content=payload, media_type="application/json", headers=headers)
@@ -0,0 +1,9 @@
+"""
+Suite de carga y benchmark de la API.
+
+Uso típico (desde la raíz del repo, con DB_HOST/DB_USER/DB_PASSWORD apuntando a un MySQL local):
+
+    python -m bench seed --users 100000 --products-per-user 5 --reset
+    python -m bench run --duration 60 --concurrency 16 --output bench.json
+    python -m bench compare base.json bench.json
+"""
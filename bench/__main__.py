@@ -0,0 +1,151 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import urllib.request
+from datetime import datetime, timezone
+
+from bench import seed as seeding
+from bench.load import DEFAULT_MIX, compare, run_load
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def _start_server(database: str, port: int, api_key: str, workers: int) -> subprocess.Popen:
+    """Levanta uvicorn con main:app apuntando a la base de benchmark."""
+    env = dict(os.environ, DB_NAME=database, API_KEY=api_key, PORT=str(port))
+    env.setdefault("DB_HOST", "127.0.0.1")
+    env.setdefault("DB_USER", "root")
+    cmd = [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+           "--workers", str(workers), "--log-level", "warning"]
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env)
+    url = f"http://127.0.0.1:{port}/hello"
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f"El servidor terminó con código {proc.returncode}")
+        try:
+            req = urllib.request.Request(url, headers={"X-API-Key": api_key})
+            with urllib.request.urlopen(req, timeout=1):
+                return proc
+        except OSError:
+            time.sleep(0.2)
+    proc.terminate()
+    raise SystemExit("El servidor no respondió en 30 s")
+
+
+def _parse_mix(value: str) -> dict:
+    mix = dict(DEFAULT_MIX)
+    for item in filter(None, value.split(",")):
+        name, _, weight = item.partition("=")
+        if name not in mix:
+            raise SystemExit(f"Escenario desconocido: {name}")
+        mix[name] = int(weight)
+    return mix
+
+
+def cmd_seed(args) -> None:
+    seeding.create_schema(args.database, reset=args.reset)
+    summary = seeding.seed(args.database, args.clients, args.nominas_per_client,
+                           args.users, args.products_per_user, args.seed)
+    print(json.dumps({k: v for k, v in summary.items() if k != "nominas"}, indent=2))
+
+
+def cmd_run(args) -> None:
+    fixture = seeding.load_fixture(args.database)
+    if not fixture["nominas"]:
+        raise SystemExit("La base de benchmark está vacía; ejecuta primero `python -m bench seed`")
+    api_key = args.api_key or os.getenv("API_KEY") or "bench"
+    proc = None
+    base_url = args.url
+    if not base_url:
+        proc = _start_server(args.database, args.port, api_key, args.workers)
+        base_url = f"http://127.0.0.1:{args.port}"
+    try:
+        results = run_load(base_url, api_key, fixture, args.concurrency, args.duration,
+                           _parse_mix(args.mix), args.seed, args.warmup)
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait(timeout=10)
+    report = {
+        "meta": {
+            "commit": _git_commit(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "database": args.database,
+            "users": fixture["users"],
+            "nominas": len(fixture["nominas"]),
+            "concurrency": args.concurrency,
+            "workers": args.workers,
+            "mix": _parse_mix(args.mix),
+        },
+        "results": results,
+    }
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    print(output)
+
+
+def cmd_compare(args) -> None:
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    with open(args.candidate, encoding="utf-8") as f:
+        candidate = json.load(f)
+    lines, regressed = compare(baseline, candidate, args.threshold)
+    print(f"{baseline['meta']['commit']} -> {candidate['meta']['commit']}")
+    print("\n".join(lines))
+    if regressed:
+        raise SystemExit(f"Regresión de p95 mayor a {args.threshold}%")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="python -m bench", description="Benchmark de la API de Mike's")
+    parser.add_argument("--database", default=os.getenv("BENCH_DB_NAME", "mikes_bench"))
+    parser.add_argument("--seed", type=int, default=42)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_seed = sub.add_parser("seed", help="Crea el esquema y siembra datos sintéticos")
+    p_seed.add_argument("--clients", type=int, default=5)
+    p_seed.add_argument("--nominas-per-client", type=int, default=4)
+    p_seed.add_argument("--users", type=int, default=100_000)
+    p_seed.add_argument("--products-per-user", type=int, default=5)
+    p_seed.add_argument("--reset", action="store_true", help="Borra la base de benchmark antes de sembrar")
+    p_seed.set_defaults(func=cmd_seed)
+
+    p_run = sub.add_parser("run", help="Ejecuta la mezcla de carga y reporta latencias")
+    p_run.add_argument("--url", help="API ya levantada; si se omite se levanta main:app localmente")
+    p_run.add_argument("--port", type=int, default=8765)
+    p_run.add_argument("--workers", type=int, default=1)
+    p_run.add_argument("--api-key")
+    p_run.add_argument("--concurrency", type=int, default=8)
+    p_run.add_argument("--duration", type=float, default=30.0)
+    p_run.add_argument("--warmup", type=float, default=2.0)
+    p_run.add_argument("--mix", default="", help="Pesos, p. ej. search_as_you_type=50,import_bulk=0")
+    p_run.add_argument("--output", help="Archivo JSON de salida")
+    p_run.set_defaults(func=cmd_run)
+
+    p_cmp = sub.add_parser("compare", help="Compara dos reportes JSON")
+    p_cmp.add_argument("baseline")
+    p_cmp.add_argument("candidate")
+    p_cmp.add_argument("--threshold", type=float, default=10.0, help="Regresión de p95 tolerada (%%)")
+    p_cmp.set_defaults(func=cmd_compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
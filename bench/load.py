@@ -0,0 +1,227 @@
+import http.client
+import json
+import math
+import random
+import threading
+import time
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import quote, urlsplit
+
+from bench.seed import FIRST_NAMES, LAST_NAMES, make_rut
+
+# Generador de carga con hilos y conexiones keep-alive (solo biblioteca estándar)
+
+# Mezcla por defecto: peso relativo de cada escenario
+DEFAULT_MIX = {
+    "search_as_you_type": 35,
+    "browse_pages": 30,
+    "sign_user": 25,
+    "export_excel": 5,
+    "import_bulk": 5,
+}
+
+
+class Client:
+    """Cliente HTTP por hilo que registra la latencia de cada request bajo un nombre de endpoint."""
+
+    def __init__(self, base_url: str, api_key: str, recorder: "Recorder"):
+        parts = urlsplit(base_url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.api_key = api_key
+        self.recorder = recorder
+        self.conn = None
+
+    def request(self, endpoint: str, method: str, path: str, body: Optional[dict] = None) -> Optional[object]:
+        headers = {"X-API-Key": self.api_key, "Connection": "keep-alive"}
+        payload = None
+        if body is not None:
+            payload = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        start = time.perf_counter()
+        status = 0
+        data = None
+        try:
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+            self.conn.request(method, path, body=payload, headers=headers)
+            response = self.conn.getresponse()
+            raw = response.read()
+            status = response.status
+            if status == 200 and raw:
+                data = json.loads(raw)
+        except (OSError, http.client.HTTPException, ValueError):
+            if self.conn is not None:
+                self.conn.close()
+            self.conn = None
+        self.recorder.record(endpoint, time.perf_counter() - start, status)
+        return data
+
+
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+
+    def record(self, endpoint: str, seconds: float, status: int) -> None:
+        with self._lock:
+            self.latencies[endpoint].append(seconds)
+            if not 200 <= status < 300:
+                self.errors[endpoint] += 1
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    # Percentil por rango más cercano
+    k = max(math.ceil(pct / 100 * len(sorted_values)) - 1, 0)
+    return sorted_values[min(k, len(sorted_values) - 1)]
+
+
+def summarize(recorder: Recorder, elapsed: float) -> Dict:
+    endpoints = {}
+    total = 0
+    for endpoint, values in sorted(recorder.latencies.items()):
+        values = sorted(values)
+        total += len(values)
+        endpoints[endpoint] = {
+            "requests": len(values),
+            "errors": recorder.errors.get(endpoint, 0),
+            "throughput_rps": round(len(values) / elapsed, 2),
+            "p50_ms": round(percentile(values, 50) * 1000, 2),
+            "p95_ms": round(percentile(values, 95) * 1000, 2),
+            "p99_ms": round(percentile(values, 99) * 1000, 2),
+            "max_ms": round(values[-1] * 1000, 2),
+        }
+    return {
+        "duration_s": round(elapsed, 2),
+        "requests": total,
+        "throughput_rps": round(total / elapsed, 2) if elapsed else 0.0,
+        "endpoints": endpoints,
+    }
+
+
+class Scenarios:
+    """Escenarios realistas; cada uno emite una o más requests con el cliente dado."""
+
+    def __init__(self, fixture: Dict, rng: random.Random, page_size: int = 8, import_size: int = 50):
+        self.nominas = fixture["nominas"]
+        self.max_user = max(fixture["users"], 1)
+        self.rng = rng
+        self.page_size = page_size
+        self.import_size = import_size
+
+    def _nomina(self) -> Dict:
+        return self.rng.choice(self.nominas)
+
+    def search_as_you_type(self, client: Client) -> None:
+        # Se escribe un nombre letra por letra, como en el buscador del frontend
+        term = self.rng.choice(FIRST_NAMES + LAST_NAMES)[: self.rng.randint(3, 6)]
+        nomina = self._nomina()
+        scoped = self.rng.random() < 0.5
+        for i in range(1, len(term) + 1):
+            q = quote(term[:i])
+            if scoped:
+                client.request("GET /nomina/{nomina_id}/users/search", "GET",
+                               f"/nomina/{nomina['idNomina']}/users/search?q={q}")
+            else:
+                client.request("GET /users/search", "GET", f"/users/search?q={q}")
+
+    def browse_pages(self, client: Client) -> None:
+        nomina = self._nomina()
+        page = 1
+        for _ in range(self.rng.randint(1, 4)):
+            data = client.request("GET /users/paginated", "GET",
+                                  f"/users/paginated?nominaId={nomina['idNomina']}&page={page}&limit={self.page_size}")
+            if not data or not data.get("has_more"):
+                break
+            page = self.rng.randint(page + 1, max(page + 1, data.get("total_pages", page + 1)))
+        client.request("GET /report", "GET", f"/report?nominaId={nomina['idNomina']}")
+
+    def sign_user(self, client: Client) -> None:
+        user_id = self.rng.randint(1, self.max_user)
+        client.request("GET /user/{user_id}", "GET", f"/user/{user_id}")
+        client.request("PUT /user/{id}/comment", "PUT", f"/user/{user_id}/comment", {
+            "comment": "Entregado (bench)",
+            "signature": "data:image/png;base64," + "A" * self.rng.randint(2000, 8000),
+            "performedBy": "bench",
+            "signatureDate": time.strftime("%Y-%m-%d %H:%M:%S"),
+        })
+
+    def export_excel(self, client: Client) -> None:
+        nomina = self._nomina()
+        client.request("GET /exportExcel", "GET", f"/exportExcel?nominaId={nomina['idNomina']}")
+
+    def import_bulk(self, client: Client) -> None:
+        nomina = self._nomina()
+        created = client.request("POST /nomina", "POST", "/nomina", {
+            "name": f"bench-import-{self.rng.randint(0, 10**9)}",
+            "client_idClient": nomina["idClient"],
+        })
+        if not created:
+            return
+        base = 50_000_000 + self.rng.randint(0, 10**7)
+        users = [{
+            "rut": make_rut(base + i),
+            "name": self.rng.choice(FIRST_NAMES),
+            "lastName": self.rng.choice(LAST_NAMES),
+            "products": [{"name": "Polera manga corta", "sku": "POL-001", "quantity": 1, "size": "M", "color": "Azul"}],
+        } for i in range(self.import_size)]
+        client.request("POST /import_bulk", "POST", "/import_bulk", {
+            "nomina_idNomina": created["idNomina"],
+            "nomina_idClient": nomina["idClient"],
+            "users": users,
+        })
+
+
+def run_load(base_url: str, api_key: str, fixture: Dict, concurrency: int, duration: float,
+             mix: Dict[str, int] = None, seed_value: int = 42, warmup: float = 2.0) -> Dict:
+    """Ejecuta la mezcla de escenarios con `concurrency` hilos durante `duration` segundos."""
+    mix = mix or DEFAULT_MIX
+    names = [name for name, weight in mix.items() if weight > 0]
+    weights = [mix[name] for name in names]
+    recorder = Recorder()
+    warm_recorder = Recorder()
+    deadline_warm = time.perf_counter() + warmup
+    deadline = deadline_warm + duration
+
+    def worker(index: int) -> None:
+        rng = random.Random(seed_value + index)
+        scenarios = Scenarios(fixture, rng)
+        client = Client(base_url, api_key, warm_recorder)
+        while True:
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+            client.recorder = warm_recorder if now < deadline_warm else recorder
+            name = rng.choices(names, weights)[0]
+            step: Callable[[Client], None] = getattr(scenarios, name)
+            step(client)
+
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return summarize(recorder, duration)
+
+
+def compare(baseline: Dict, candidate: Dict, threshold_pct: float) -> Tuple[List[str], bool]:
+    """Compara dos reportes JSON; devuelve líneas de tabla y si hubo regresión en p95."""
+    lines = [f"{'endpoint':42} {'p50 ms':>16} {'p95 ms':>16} {'p99 ms':>16} {'rps':>14}"]
+    regressed = False
+    for endpoint, new in sorted(candidate["results"]["endpoints"].items()):
+        old = baseline["results"]["endpoints"].get(endpoint)
+        if not old:
+            lines.append(f"{endpoint:42} (nuevo)")
+            continue
+        cells = []
+        for key in ("p50_ms", "p95_ms", "p99_ms", "throughput_rps"):
+            delta = ((new[key] - old[key]) / old[key] * 100) if old[key] else 0.0
+            cells.append(f"{new[key]:>8.1f} {delta:>+6.1f}%")
+        if old["p95_ms"] and (new["p95_ms"] - old["p95_ms"]) / old["p95_ms"] * 100 > threshold_pct:
+            regressed = True
+        lines.append(f"{endpoint:42} " + " ".join(f"{c:>16}" for c in cells))
+    return lines, regressed
@@ -0,0 +1,175 @@
+import os
+import random
+import time
+from typing import Dict, List
+
+import mysql.connector
+
+import migrations
+from rut import check_digit as rut_check_digit
+
+# Generación de datos sintéticos para benchmarks
+
+FIRST_NAMES = [
+    "Juan", "María", "José", "Francisca", "Diego", "Camila", "Matías", "Valentina",
+    "Benjamín", "Catalina", "Vicente", "Fernanda", "Tomás", "Javiera", "Cristóbal",
+    "Constanza", "Felipe", "Antonia", "Sebastián", "Isidora",
+]
+LAST_NAMES = [
+    "González", "Muñoz", "Rojas", "Díaz", "Pérez", "Soto", "Contreras", "Silva",
+    "Martínez", "Sepúlveda", "Morales", "Rodríguez", "López", "Fuentes", "Hernández",
+    "Torres", "Araya", "Flores", "Espinoza", "Valenzuela",
+]
+AREAS = ["Operaciones", "Logística", "Administración", "Mantención", "Bodega", "Ventas"]
+SERVICES = ["Aseo", "Seguridad", "Casino", "Transporte", "Producción"]
+CENTERS = ["Santiago", "Antofagasta", "Concepción", "Valparaíso", "Puerto Montt"]
+PRODUCTS = [
+    ("POL-001", "Polera manga corta"), ("PAN-002", "Pantalón cargo"), ("ZAP-003", "Zapato de seguridad"),
+    ("CHA-004", "Chaqueta softshell"), ("GOR-005", "Gorro legionario"), ("GUA-006", "Guantes nitrilo"),
+    ("PAR-007", "Parka térmica"), ("BUZ-008", "Buzo piloto"),
+]
+COLORS = ["Azul", "Negro", "Gris", "Naranjo", "Verde"]
+SIZES = ["XS", "S", "M", "L", "XL", "XXL", "38", "40", "42", "44"]
+
+BATCH = 5000
+
+
+def make_rut(number: int) -> str:
+    return f"{number}-{rut_check_digit(number)}"
+
+
+def connect(database: str = None):
+    return mysql.connector.connect(
+        host=os.getenv("DB_HOST", "127.0.0.1"),
+        port=int(os.getenv("DB_PORT", "3306")),
+        user=os.getenv("DB_USER", "root"),
+        password=os.getenv("DB_PASSWORD", ""),
+        database=database,
+    )
+
+
+def create_schema(database: str, reset: bool = False) -> None:
+    """Crea la base de datos de benchmark y le aplica las migraciones del repo."""
+    conn = connect()
+    cursor = conn.cursor()
+    try:
+        if reset:
+            cursor.execute(f"DROP DATABASE IF EXISTS `{database}`")
+        cursor.execute(f"CREATE DATABASE IF NOT EXISTS `{database}` CHARACTER SET utf8mb4")
+    finally:
+        cursor.close()
+        conn.close()
+    conn = connect(database)
+    try:
+        migrations.upgrade(conn)
+    finally:
+        conn.close()
+
+
+def seed(database: str, clients: int, nominas_per_client: int, users: int,
+         products_per_user: int, seed_value: int = 42) -> Dict:
+    """
+    Inserta datos sintéticos reproducibles.
+    Los usuarios se reparten en partes iguales entre todas las nóminas.
+    Devuelve un resumen con los ids generados para que el generador de carga los use.
+    """
+    rng = random.Random(seed_value)
+    conn = connect(database)
+    cursor = conn.cursor()
+    start = time.perf_counter()
+    try:
+        cursor.executemany(
+            "INSERT INTO employee (name, password, role) VALUES (%s, %s, %s)",
+            [("bench", "bench", "admin")] + [(f"empleado{i}", "bench", "user") for i in range(1, 20)],
+        )
+
+        nominas: List[Dict] = []
+        for c in range(1, clients + 1):
+            cursor.execute("INSERT INTO client (name) VALUES (%s)", (f"Cliente {c}",))
+            client_id = cursor.lastrowid
+            for n in range(1, nominas_per_client + 1):
+                cursor.execute(
+                    "INSERT INTO nomina (name, client_idClient) VALUES (%s, %s)",
+                    (f"Nómina {c}-{n}", client_id),
+                )
+                nominas.append({"idNomina": cursor.lastrowid, "idClient": client_id})
+        conn.commit()
+
+        per_nomina = max(users // max(len(nominas), 1), 1)
+        user_rows, product_rows = [], []
+        next_user_id = 1
+        rut_base = 10_000_000
+        for nomina in nominas:
+            for _ in range(per_nomina):
+                uid = next_user_id
+                next_user_id += 1
+                user_rows.append((
+                    uid,
+                    make_rut(rut_base + uid),
+                    rng.choice(FIRST_NAMES),
+                    f"{rng.choice(LAST_NAMES)} {rng.choice(LAST_NAMES)}",
+                    rng.choice(["M", "F"]),
+                    rng.choice(AREAS),
+                    rng.choice(SERVICES),
+                    rng.choice(CENTERS),
+                    nomina["idNomina"],
+                    nomina["idClient"],
+                ))
+                for sku, pname in rng.sample(PRODUCTS, min(products_per_user, len(PRODUCTS))):
+                    product_rows.append((
+                        sku, pname, rng.choice(COLORS), rng.randint(1, 3), rng.choice(SIZES),
+                        uid, nomina["idNomina"], nomina["idClient"],
+                    ))
+                if len(user_rows) >= BATCH:
+                    _flush(cursor, user_rows, product_rows)
+                    conn.commit()
+        _flush(cursor, user_rows, product_rows)
+        conn.commit()
+
+        return {
+            "nominas": nominas,
+            "users": next_user_id - 1,
+            "products": (next_user_id - 1) * min(products_per_user, len(PRODUCTS)),
+            "seconds": round(time.perf_counter() - start, 2),
+        }
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def _flush(cursor, user_rows: list, product_rows: list) -> None:
+    if user_rows:
+        cursor.executemany(
+            """
+            INSERT INTO app_user
+              (idUser, rut, name, lastName, sex, area, service, center, nomina_idNomina, nomina_idClient)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            """,
+            user_rows,
+        )
+    for i in range(0, len(product_rows), BATCH):
+        cursor.executemany(
+            """
+            INSERT INTO product
+              (sku, name, color, quantity, size, user_idUser, user_nomina_idNomina, user_nomina_idClient)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+            """,
+            product_rows[i:i + BATCH],
+        )
+    user_rows.clear()
+    product_rows.clear()
+
+
+def load_fixture(database: str) -> Dict:
+    """Lee los ids ya sembrados (para correr carga sin volver a sembrar)."""
+    conn = connect(database)
+    cursor = conn.cursor(dictionary=True)
+    try:
+        cursor.execute("SELECT idNomina, client_idClient AS idClient FROM nomina ORDER BY idNomina")
+        nominas = cursor.fetchall()
+        cursor.execute("SELECT COALESCE(MAX(idUser), 0) AS users FROM app_user")
+        users = cursor.fetchone()["users"]
+        return {"nominas": nominas, "users": users}
+    finally:
+        cursor.close()
+        conn.close()
@@ -0,0 +1,174 @@
+import os
+import time
+import logging
+import threading
+from contextvars import ContextVar
+from typing import Any, Callable, Optional
+
+from mysql.connector import Error
+
+from metrics import registry
+
+# Circuit breaker por pool de conexiones.
+# Tras DB_BREAKER_FAILURES fallos seguidos al conectar (o conexiones perdidas en medio de
+# una consulta) el circuito se abre: pedir una conexión falla al instante con CircuitOpen
+# en vez de esperar el timeout de mysql.connector.connect en cada request. Un hilo en
+# segundo plano prueba conectarse cada DB_BREAKER_PROBE_SECONDS y cierra el circuito
+# cuando la base responde; los requests nunca hacen de sonda.
+# Mientras tanto las lecturas con @coalesced devuelven su último resultado bueno
+# (ver coalesce.py) y DegradedModeMiddleware lo marca como obsoleto en la respuesta.
+
+DB_BREAKER_FAILURES = int(os.getenv("DB_BREAKER_FAILURES", "3"))
+DB_BREAKER_PROBE_SECONDS = float(os.getenv("DB_BREAKER_PROBE_SECONDS", "2"))
+
+# Errores de MySQL que indican que la base no está disponible (no un error de la consulta)
+UNAVAILABLE_ERRNOS = {
+    2003,  # CR_CONN_HOST_ERROR
+    2005,  # CR_UNKNOWN_HOST
+    2006,  # CR_SERVER_GONE_ERROR
+    2013,  # CR_SERVER_LOST
+    2055,  # CR_SERVER_LOST_EXTENDED
+}
+
+CIRCUIT_OPEN = registry.gauge(
+    "db_circuit_open", "1 si el circuito del pool está abierto", ("pool",))
+CIRCUIT_TRANSITIONS = registry.counter(
+    "db_circuit_transitions_total", "Aperturas y cierres del circuito", ("pool", "state"))
+CIRCUIT_REJECTIONS = registry.counter(
+    "db_circuit_rejections_total", "Conexiones negadas sin intentar porque el circuito está abierto", ("pool",))
+
+logger = logging.getLogger("breaker")
+
+
+class CircuitOpen(Error):
+    """La base se considera caída; se falla sin intentar conectar."""
+
+
+class _Degraded:
+    __slots__ = ("rejected", "stale_age", "retry_after")
+
+    def __init__(self):
+        self.rejected = False
+        self.stale_age: Optional[float] = None
+        self.retry_after = 1
+
+
+# Estado del request en curso (lo fija DegradedModeMiddleware; el objeto se comparte con
+# los hilos de la base porque run_sync copia el contexto)
+current_degraded: ContextVar[Optional[_Degraded]] = ContextVar("current_degraded", default=None)
+
+
+def is_unavailable(error: BaseException) -> bool:
+    """
+    True si el error significa que la base no responde (para servir datos obsoletos).
+    Un PoolTimeout no cuenta: es saturación del pool (p. ej. durante exportaciones), no
+    una caída, y no justifica devolver datos de hasta COALESCE_STALE_SECONDS atrás.
+    """
+    if isinstance(error, CircuitOpen):
+        return True
+    return isinstance(error, Error) and error.errno in UNAVAILABLE_ERRNOS
+
+
+def mark_stale(age: float) -> None:
+    degraded = current_degraded.get()
+    if degraded is not None:
+        degraded.stale_age = max(age, degraded.stale_age or 0)
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, probe: Callable[[], Any], failures: int = DB_BREAKER_FAILURES,
+                 probe_seconds: float = DB_BREAKER_PROBE_SECONDS):
+        self.name = name
+        self.failures = max(failures, 1)
+        self.probe_seconds = probe_seconds
+        self._probe = probe
+        self._lock = threading.Lock()
+        self._consecutive = 0
+        self._open = False
+        self._opened_at = 0.0
+        CIRCUIT_OPEN.set(name, value=0)
+
+    @property
+    def is_open(self) -> bool:
+        return self._open
+
+    def check(self) -> None:
+        """Llamar antes de pedir una conexión: falla al instante si el circuito está abierto."""
+        if not self._open:
+            return
+        CIRCUIT_REJECTIONS.inc(self.name)
+        degraded = current_degraded.get()
+        if degraded is not None:
+            degraded.rejected = True
+            degraded.retry_after = max(1, round(self.probe_seconds))
+        raise CircuitOpen(msg=f"Base de datos no disponible (circuito {self.name} abierto)")
+
+    def record_success(self) -> None:
+        if self._consecutive:
+            with self._lock:
+                self._consecutive = 0
+
+    def record_failure(self, error: BaseException) -> None:
+        with self._lock:
+            self._consecutive += 1
+            if self._open or self._consecutive < self.failures:
+                return
+            self._open = True
+            self._opened_at = time.monotonic()
+        CIRCUIT_OPEN.set(self.name, value=1)
+        CIRCUIT_TRANSITIONS.inc(self.name, "open")
+        logger.error("Circuito %s abierto tras %s fallos: %s", self.name, self.failures, error)
+        threading.Thread(target=self._probe_until_recovered, name=f"breaker-{self.name}", daemon=True).start()
+
+    def _probe_until_recovered(self) -> None:
+        while True:
+            time.sleep(self.probe_seconds)
+            try:
+                self._probe()
+            except Exception as e:
+                logger.debug("Sonda del circuito %s falló: %s", self.name, e)
+                continue
+            with self._lock:
+                self._open = False
+                self._consecutive = 0
+            CIRCUIT_OPEN.set(self.name, value=0)
+            CIRCUIT_TRANSITIONS.inc(self.name, "closed")
+            logger.warning("Circuito %s cerrado: la base respondió tras %.1f s",
+                           self.name, time.monotonic() - self._opened_at)
+            return
+
+
+class DegradedModeMiddleware:
+    """
+    Middleware ASGI: agrega X-Data-Stale (antigüedad en segundos) y Warning 110 a las
+    respuestas servidas con datos obsoletos, y convierte en 503 con Retry-After los 500
+    causados por el circuito abierto (los handlers envuelven todo error en un 500).
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        degraded = _Degraded()
+        token = current_degraded.set(degraded)
+
+        async def wrapped_send(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                status = message["status"]
+                if degraded.stale_age is not None:
+                    headers.append((b"x-data-stale", str(int(degraded.stale_age)).encode()))
+                    headers.append((b"warning", b'110 - "Response is Stale"'))
+                if status == 500 and degraded.rejected:
+                    status = 503
+                    headers.append((b"retry-after", str(degraded.retry_after).encode()))
+                message = {**message, "status": status, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, wrapped_send)
+        finally:
+            current_degraded.reset(token)
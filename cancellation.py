@@ -0,0 +1,103 @@
+import os
+import asyncio
+from contextvars import ContextVar
+from typing import Optional
+
+from metrics import registry
+
+# Presupuestos de tiempo por sentencia y cancelación al desconectarse el cliente.
+# Los SELECT llevan el hint MAX_EXECUTION_TIME con el presupuesto del request (MySQL los
+# corta del lado del servidor). Si el cliente cierra la conexión durante un GET, el
+# middleware cancela el handler y db.py manda KILL QUERY a la sentencia en curso.
+
+# Presupuesto (ms) por defecto para cada SELECT; 0 = sin límite
+DB_STATEMENT_BUDGET_MS = int(os.getenv("DB_STATEMENT_BUDGET_MS", "30000"))
+
+# Presupuesto del request en curso (lo fija la dependencia statement_budget de cada ruta)
+statement_budget_ms: ContextVar[int] = ContextVar("statement_budget_ms", default=DB_STATEMENT_BUDGET_MS)
+
+DISCONNECTS = registry.counter(
+    "http_client_disconnects_total", "Requests cancelados porque el cliente cerró la conexión", ("method",))
+
+# Solo se cancelan métodos sin efectos: cortar una escritura a medias no es seguro
+_CANCELLABLE = {"GET", "HEAD"}
+
+
+def statement_budget(ms: int):
+    """Dependencia de FastAPI: Depends(statement_budget(2000)) fija el presupuesto de la ruta."""
+    async def dependency():
+        token = statement_budget_ms.set(ms)
+        try:
+            yield
+        finally:
+            statement_budget_ms.reset(token)
+    return dependency
+
+
+class DisconnectMiddleware:
+    """
+    Middleware ASGI que corre el handler de los GET en una tarea y la cancela si llega
+    http.disconnect antes de terminar la respuesta.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in _CANCELLABLE:
+            await self.app(scope, receive, send)
+            return
+
+        first = await receive()
+        if first["type"] == "http.disconnect":
+            return
+        if first.get("more_body"):
+            # GET con cuerpo en partes: no se vigila
+            await self.app(scope, _replay(first, receive), send)
+            return
+
+        disconnected = asyncio.Event()
+        pending: Optional[dict] = first
+        response_complete = False
+
+        async def wrapped_receive():
+            nonlocal pending
+            if pending is not None:
+                message, pending = pending, None
+                return message
+            await disconnected.wait()
+            return {"type": "http.disconnect"}
+
+        async def wrapped_send(message):
+            nonlocal response_complete
+            if message["type"] == "http.response.body" and not message.get("more_body"):
+                response_complete = True
+            await send(message)
+
+        handler = asyncio.ensure_future(self.app(scope, wrapped_receive, wrapped_send))
+        watcher = asyncio.ensure_future(receive())
+        try:
+            done, _ = await asyncio.wait({handler, watcher}, return_when=asyncio.FIRST_COMPLETED)
+            if handler not in done and not response_complete and watcher.result()["type"] == "http.disconnect":
+                DISCONNECTS.inc(scope["method"])
+                disconnected.set()
+                handler.cancel()
+            try:
+                await handler
+            except asyncio.CancelledError:
+                if not disconnected.is_set():
+                    raise
+        finally:
+            watcher.cancel()
+            if not handler.done():
+                handler.cancel()
+
+
+def _replay(first, receive):
+    pending = [first]
+
+    async def wrapped():
+        if pending:
+            return pending.pop()
+        return await receive()
+    return wrapped
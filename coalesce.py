@@ -0,0 +1,208 @@
+import os
+import time
+import asyncio
+import functools
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Set, Tuple
+
+from metrics import registry
+from invalidation import channel
+from replication import sticky_writes
+from push import TOPIC as NOMINA_EVENT_TOPIC
+from breaker import is_unavailable, mark_stale
+
+# Coalescing de lecturas idénticas (single-flight) con micro-caché opcional.
+# Llamadas concurrentes con los mismos argumentos comparten una sola consulta en vuelo;
+# si ttl > 0 el resultado se reutiliza ese tiempo. Las escrituras invalidan por etiqueta:
+# los eventos de nómina (push) borran "nomina:<id>" y invalidate_reads() cualquier otra.
+# El resultado se comparte entre llamadores: no se debe modificar.
+# Además se guarda el último resultado bueno de cada llamada: si la base no está disponible
+# (circuito abierto, conexión perdida) se devuelve ese, marcado como obsoleto. Esa copia
+# está acotada en bytes; las lecturas pesadas (nóminas completas con firmas) la omiten
+# con @coalesced(stale=False).
+
+TOPIC = "read_cache"
+
+COALESCE_ENABLED = os.getenv("COALESCE_ENABLED", "1") == "1"
+
+# Ventana (s) de la micro-caché; 0 = solo se comparten las consultas en vuelo
+COALESCE_CACHE_SECONDS = float(os.getenv("COALESCE_CACHE_SECONDS", "1"))
+
+_MAX_CACHED = 2000
+
+# Antigüedad máxima (s) de un resultado servido como obsoleto; 0 = nunca
+COALESCE_STALE_SECONDS = float(os.getenv("COALESCE_STALE_SECONDS", "3600"))
+_MAX_STALE = 5000
+# Tamaño aproximado máximo de los resultados guardados para servir obsoletos (por worker)
+COALESCE_STALE_MAX_BYTES = int(os.getenv("COALESCE_STALE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+# outcome: leader = ejecutó la consulta, joined = esperó una en vuelo,
+# cached = micro-caché, bypass = no se compartió (read-your-writes o desactivado)
+CALLS = registry.counter(
+    "coalesce_calls_total", "Llamadas a lecturas con coalescing por resultado", ("function", "outcome"))
+SAVED = registry.counter(
+    "coalesce_db_calls_saved_total", "Consultas a la base evitadas (joined + cached)", ("function",))
+INVALIDATIONS = registry.counter(
+    "coalesce_invalidations_total", "Etiquetas invalidadas en la micro-caché")
+STALE_SERVED = registry.counter(
+    "coalesce_stale_served_total", "Resultados obsoletos servidos porque la base no estaba disponible", ("function",))
+
+Key = Tuple[str, tuple, tuple]
+
+
+def _key(name: str, args: tuple, kwargs: dict) -> Key:
+    return (name, args, tuple(sorted(kwargs.items())))
+
+
+def _approx_size(value: Any) -> int:
+    # Cuenta sobre todo los textos (las firmas); suficiente para acotar la memoria
+    if isinstance(value, (str, bytes)):
+        return 48 + len(value)
+    if isinstance(value, dict):
+        return 64 + sum(_approx_size(v) for v in value.values()) + 32 * len(value)
+    if isinstance(value, (list, tuple)):
+        return 56 + sum(_approx_size(v) for v in value)
+    return 32
+
+
+class SingleFlight:
+    def __init__(self):
+        self._inflight: Dict[Key, Tuple[asyncio.Future, Optional[str]]] = {}
+        self._cache: Dict[Key, Tuple[float, Any]] = {}
+        self._tags: Dict[str, Set[Key]] = {}
+        # Generación por etiqueta: un resultado que empezó antes de invalidarse no se guarda
+        self._generation: Dict[str, int] = {}
+        # Último resultado bueno por llamada (no se invalida: solo se usa con la base caída)
+        self._last_good: "OrderedDict[Key, Tuple[float, Any, int]]" = OrderedDict()
+        self._last_good_bytes = 0
+
+    def invalidate(self, tag: str) -> None:
+        INVALIDATIONS.inc()
+        self._generation[tag] = self._generation.get(tag, 0) + 1
+        for key in self._tags.pop(tag, ()):
+            self._cache.pop(key, None)
+        # Las llamadas que lleguen después no se suman a una consulta ya obsoleta
+        for key in [k for k, (_, t) in self._inflight.items() if t == tag]:
+            del self._inflight[key]
+
+    def clear(self) -> None:
+        self._cache.clear()
+        self._tags.clear()
+
+    def _forget(self, key: Key) -> None:
+        entry = self._last_good.pop(key, None)
+        if entry is not None:
+            self._last_good_bytes -= entry[2]
+
+    def remember(self, key: Key, value: Any) -> None:
+        if COALESCE_STALE_SECONDS <= 0:
+            return
+        self._forget(key)
+        size = _approx_size(value)
+        if size > COALESCE_STALE_MAX_BYTES // 4:
+            return
+        self._last_good[key] = (time.monotonic(), value, size)
+        self._last_good_bytes += size
+        while len(self._last_good) > _MAX_STALE or self._last_good_bytes > COALESCE_STALE_MAX_BYTES:
+            self._forget(next(iter(self._last_good)))
+
+    def last_good(self, key: Key) -> Optional[Tuple[float, Any]]:
+        """(antigüedad en s, valor) del último resultado bueno, o None."""
+        entry = self._last_good.get(key)
+        if entry is None:
+            return None
+        age = time.monotonic() - entry[0]
+        if age > COALESCE_STALE_SECONDS:
+            self._forget(key)
+            return None
+        return age, entry[1]
+
+    def _store(self, key: Key, tag: Optional[str], ttl: float, value: Any) -> None:
+        if len(self._cache) >= _MAX_CACHED:
+            now = time.monotonic()
+            for stale in [k for k, (expires, _) in self._cache.items() if expires <= now]:
+                del self._cache[stale]
+            while len(self._cache) >= _MAX_CACHED:
+                del self._cache[next(iter(self._cache))]
+        self._cache[key] = (time.monotonic() + ttl, value)
+        if tag is not None:
+            self._tags.setdefault(tag, set()).add(key)
+
+    async def run(self, name: str, fn: Callable, args: tuple, kwargs: dict,
+                  tag: Optional[str], ttl: float) -> Any:
+        key = _key(name, args, kwargs)
+        cached = self._cache.get(key)
+        if cached is not None:
+            if cached[0] > time.monotonic():
+                CALLS.inc(name, "cached")
+                SAVED.inc(name)
+                return cached[1]
+            del self._cache[key]
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            CALLS.inc(name, "joined")
+            SAVED.inc(name)
+            return await asyncio.shield(inflight[0])
+
+        CALLS.inc(name, "leader")
+        generation = self._generation.get(tag) if tag is not None else None
+        # La consulta corre en su propia tarea: si el request que la inició se cancela,
+        # los demás siguen esperando el mismo resultado
+        future = asyncio.ensure_future(fn(*args, **kwargs))
+        self._inflight[key] = (future, tag)
+        try:
+            value = await asyncio.shield(future)
+        finally:
+            if self._inflight.get(key, (None,))[0] is future:
+                del self._inflight[key]
+        if ttl > 0 and (tag is None or self._generation.get(tag) == generation):
+            self._store(key, tag, ttl, value)
+        return value
+
+
+flights = SingleFlight()
+
+
+def coalesced(tag: Callable[..., str] = None, ttl: float = None, stale: bool = True):
+    """
+    Decorador para lecturas async de db.py. tag(*args) devuelve la etiqueta con la que
+    las escrituras invalidan el resultado; ttl sobreescribe COALESCE_CACHE_SECONDS.
+    stale=False no guarda el último resultado bueno (resultados grandes).
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            # Quien acaba de escribir lee su propia escritura, sin compartir ni caché, y
+            # tampoco recibe un resultado obsoleto que no la incluya
+            sticky = sticky_writes.requires_primary()
+            try:
+                if not COALESCE_ENABLED or sticky:
+                    CALLS.inc(fn.__name__, "bypass")
+                    value = await fn(*args, **kwargs)
+                else:
+                    window = COALESCE_CACHE_SECONDS if ttl is None else ttl
+                    value = await flights.run(fn.__name__, fn, args, kwargs,
+                                              tag(*args, **kwargs) if tag else None, window)
+            except Exception as e:
+                fallback = flights.last_good(_key(fn.__name__, args, kwargs)) if stale and not sticky and is_unavailable(e) else None
+                if fallback is None:
+                    raise
+                STALE_SERVED.inc(fn.__name__)
+                mark_stale(fallback[0])
+                return fallback[1]
+            if stale:
+                flights.remember(_key(fn.__name__, args, kwargs), value)
+            return value
+        return wrapper
+    return decorator
+
+
+async def invalidate_reads(tag: str) -> None:
+    """Invalida una etiqueta en este proceso y en los demás workers."""
+    await channel.publish(TOPIC, tag)
+
+
+channel.subscribe(TOPIC, lambda key, payload: flights.invalidate(key))
+# Todo evento de nómina (ver push.py) deja obsoletas las lecturas de esa nómina
+channel.subscribe(NOMINA_EVENT_TOPIC, lambda key, payload: flights.invalidate(f"nomina:{key}"))
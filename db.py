@@ -1,70 +1,481 @@
 import os
+import re
+import sys
+import time
+import random
+import asyncio
+import logging
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from functools import lru_cache, partial
 import mysql.connector
 from mysql.connector import Error
 from dotenv import load_dotenv
 from typing import List, Dict, Any, Tuple, Optional, Union
 
+from metrics import registry, ROW_BUCKETS
+from timing import current_timing
+from replication import replica_configs, sticky_writes, DB_REPLICA_RETRY_SECONDS
+from pool import ConnectionPool, db_pool_size
+from breaker import UNAVAILABLE_ERRNOS
+from cancellation import statement_budget_ms
+from push import publish_nomina_event
+from replication import primary
+from coalesce import coalesced, invalidate_reads
+from profiling import current_profile
+from rut import normalize as normalize_rut, is_valid as is_valid_rut
+
 # Cargar variables de entorno
 load_dotenv()
 
+logger = logging.getLogger("db")
+
+# Umbral (ms) a partir del cual una consulta se registra como lenta
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "500"))
+
+# Sincronización incremental: las transacciones pueden confirmar sus cambios fuera del
+# orden de sus ids, así que el token devuelto no avanza más allá de lo que tenga al menos
+# esta antigüedad (s); el cliente vuelve a recibir la cola reciente, que es idempotente
+CHANGE_SYNC_OVERLAP_SECONDS = int(os.getenv("CHANGE_SYNC_OVERLAP_SECONDS", "30"))
+
+# Días que se conserva nomina_change; un token más antiguo obliga a resincronizar completo
+CHANGE_LOG_RETENTION_DAYS = int(os.getenv("CHANGE_LOG_RETENTION_DAYS", "30"))
+
+# Reintentos de una transacción completa ante deadlock o espera de lock agotada,
+# con backoff exponencial (base en ms) y jitter
+DB_TX_RETRIES = int(os.getenv("DB_TX_RETRIES", "3"))
+DB_TX_RETRY_BASE_MS = float(os.getenv("DB_TX_RETRY_BASE_MS", "50"))
+
+# Métricas de base de datos
+QUERY_SECONDS = registry.histogram(
+    "db_query_duration_seconds", "Latencia de cada sentencia SQL", ("statement", "op"))
+QUERY_ROWS = registry.histogram(
+    "db_query_rows", "Filas devueltas por sentencia SELECT", ("statement",), buckets=ROW_BUCKETS)
+QUERY_ERRORS = registry.counter(
+    "db_query_errors_total", "Sentencias SQL que terminaron en error", ("statement", "op"))
+SLOW_QUERIES = registry.counter(
+    "db_slow_queries_total", "Sentencias que superaron SLOW_QUERY_MS", ("statement",))
+ROUTED_QUERIES = registry.counter(
+    "db_routed_queries_total", "Sentencias por destino (primary/replica)", ("target",))
+REPLICA_FALLBACKS = registry.counter(
+    "db_replica_fallbacks_total", "Lecturas enviadas al primario por no haber réplica disponible")
+TRANSACTION_SECONDS = registry.histogram(
+    "db_transaction_duration_seconds", "Duración de transacciones explícitas", ("outcome",))
+STATEMENT_TIMEOUTS = registry.counter(
+    "db_statement_timeouts_total", "SELECT cortados por MAX_EXECUTION_TIME", ("statement",))
+QUERY_CANCELLATIONS = registry.counter(
+    "db_query_cancellations_total", "Sentencias canceladas con KILL QUERY (cliente desconectado)", ("statement",))
+TRANSACTION_RETRIES = registry.counter(
+    "db_transaction_retries_total", "Transacciones reintentadas por deadlock o lock wait", ("function", "reason"))
+TRANSACTION_CONFLICTS = registry.counter(
+    "db_transaction_conflicts_total", "Transacciones que fallaron por deadlock o lock wait tras agotar los reintentos", ("function", "reason"))
+
+# Códigos de MySQL: tiempo de ejecución agotado / sentencia interrumpida
+ER_QUERY_TIMEOUT = 3024
+ER_QUERY_INTERRUPTED = 1317
+
+# Conflictos de locks que se resuelven reintentando la transacción completa
+_RETRYABLE = {1213: "deadlock", 1205: "lock_wait_timeout"}
+
+_WHITESPACE = re.compile(r"\s+")
+_IN_LIST = re.compile(r"IN \((?:%s,\s*)+%s\)", re.IGNORECASE)
+_LEADING_SELECT = re.compile(r"^\s*SELECT\b", re.IGNORECASE)
+
+
+@lru_cache(maxsize=512)
+def _fingerprint(query: str) -> Tuple[str, str]:
+    """Devuelve (sql normalizado, verbo) sin parámetros, apto para logs."""
+    normalized = _IN_LIST.sub("IN (...)", _WHITESPACE.sub(" ", query).strip())
+    op = normalized.split(" ", 1)[0].upper() if normalized else ""
+    return normalized, op
+
+
+def _with_budget(query: str, budget_ms: int) -> str:
+    """Agrega el hint MAX_EXECUTION_TIME a un SELECT (MySQL lo ignora en otras sentencias)."""
+    if budget_ms <= 0:
+        return query
+    return _LEADING_SELECT.sub(f"SELECT /*+ MAX_EXECUTION_TIME({int(budget_ms)}) */", query, count=1)
+
+
+class _Inflight:
+    """Sentencia en curso de una llamada a execute(), para poder cortarla con KILL QUERY."""
+    __slots__ = ("lock", "config", "connection_id", "cancelled", "statement")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.config = None
+        self.connection_id = None
+        self.cancelled = False
+        self.statement = None
+
+
+class _Transaction:
+    __slots__ = ("connection", "started", "savepoints")
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.started = time.perf_counter()
+        self.savepoints = 0
+
+
+# Transacción abierta en el contexto (request) en curso; fija una conexión del primario
+_transaction: ContextVar[Optional[_Transaction]] = ContextVar("db_transaction", default=None)
+
+
+def _primary_config() -> Dict[str, Any]:
+    return {
+        "host": os.getenv('DB_HOST'),
+        "port": int(os.getenv('DB_PORT', '3306')),
+        "user": os.getenv('DB_USER'),
+        "password": os.getenv('DB_PASSWORD'),
+        "database": os.getenv('DB_NAME'),
+    }
+
+
 class Database:
     def __init__(self):
-        self.connection = None
+        pool_size = db_pool_size()
+        self.primary = ConnectionPool("primary", _primary_config(), pool_size)
+        # Réplicas de lectura (DB_REPLICA_HOSTS); vacío = todo va al primario
+        self.replica_configs = replica_configs()
+        self.replicas = [ConnectionPool(f"replica{i}", config, pool_size)
+                         for i, config in enumerate(self.replica_configs)]
+        self._replica_down_until: Dict[int, float] = {}
+        self._next_replica = 0
+        # Un hilo por conexión posible: las consultas nunca bloquean el event loop
+        self._executor = ThreadPoolExecutor(
+            max_workers=pool_size * (1 + len(self.replicas)), thread_name_prefix="db")
+
+    @property
+    def connection(self):
+        """Conexión de la transacción abierta en el contexto actual (None fuera de transacción)."""
+        tx = _transaction.get()
+        return tx.connection if tx else None
 
     def connect(self):
-        if not self.connection or not self.connection.is_connected():
+        """Verifica que el primario responda (abre una conexión del pool si hace falta)."""
+        try:
+            with self.primary.connection():
+                pass
+        except Error as e:
+            print("❌ Error conectando a MySQL:", e)
+            raise
+
+    def _acquire_replica(self):
+        """Devuelve (pool, conexión) de una réplica en round-robin, o None si no hay disponible."""
+        now = time.monotonic()
+        for _ in range(len(self.replicas)):
+            index = self._next_replica % len(self.replicas)
+            self._next_replica += 1
+            if self._replica_down_until.get(index, 0) > now:
+                continue
+            pool = self.replicas[index]
             try:
-                self.connection = mysql.connector.connect(
-                    host=os.getenv('DB_HOST'),
-                    port=int(os.getenv('DB_PORT', '3306')),
-                    user=os.getenv('DB_USER'),
-                    password=os.getenv('DB_PASSWORD'),
-                    database=os.getenv('DB_NAME')
-                )
-                print("🔌 Conectado a MySQL en", os.getenv("DB_HOST"))
+                return pool, pool.acquire()
             except Error as e:
-                print("❌ Error conectando a MySQL:", e)
-                raise
+                self._replica_down_until[index] = now + DB_REPLICA_RETRY_SECONDS
+                logger.warning("Réplica %s:%s no disponible: %s", pool.config["host"], pool.config["port"], e)
+        return None
 
-    def execute_query(self, query: str, params: tuple = None) -> Tuple[List[Dict], Optional[int]]:
-        """Ejecuta una consulta SQL y devuelve los resultados y el último ID insertado"""
-        self.connect()
-        cursor = self.connection.cursor(dictionary=True)
+    def _route(self, op: str, use_primary: bool):
+        """Elige el pool: réplica para SELECT fuera de transacción, primario en otro caso."""
+        if (op == 'SELECT' and self.replicas and not use_primary
+                and not sticky_writes.requires_primary()):
+            acquired = self._acquire_replica()
+            if acquired is not None:
+                return acquired[0], acquired[1], "replica"
+            REPLICA_FALLBACKS.inc()
+        return self.primary, self.primary.acquire(), "primary"
+
+    def execute_query(self, query: str, params: tuple = None, use_primary: bool = False,
+                      statement: str = None, inflight: _Inflight = None) -> Tuple[List[Dict], Optional[int]]:
+        """
+        Ejecuta una consulta SQL (bloqueante) y devuelve los resultados y el último ID insertado.
+        Los SELECT van a una réplica si hay; use_primary=True fuerza el primario, y llevan
+        el presupuesto de tiempo del request (cancellation.statement_budget_ms).
+        Dentro de una transacción usa la conexión de la transacción y no hace commit.
+        """
+        # La sentencia se etiqueta con la función de db.py que la emite
+        statement = statement or sys._getframe(1).f_code.co_name
+        normalized, op = _fingerprint(query)
+        tx = _transaction.get()
+        if tx is not None:
+            pool, connection, target = None, tx.connection, "primary"
+        else:
+            pool, connection, target = self._route(op, use_primary)
+        ROUTED_QUERIES.inc(target)
+        discard = False
+        cursor = connection.cursor(dictionary=True)
+        # Request bajo el profiler (None salvo con PROFILING_ENABLED y un request armado)
+        profile = current_profile.get()
+        if profile is not None:
+            profile.enter_thread()
+        rows = None
+        start = time.perf_counter()
         try:
+            if inflight is not None:
+                with inflight.lock:
+                    if inflight.cancelled:
+                        raise Error(msg="Sentencia cancelada antes de ejecutarse", errno=ER_QUERY_INTERRUPTED)
+                    inflight.config = pool.config if pool is not None else self.primary.config
+                    inflight.connection_id = connection.connection_id
+                    inflight.statement = statement
+            if op == 'SELECT':
+                query = _with_budget(query, statement_budget_ms.get())
             cursor.execute(query, params or ())
             last_id = cursor.lastrowid
             
             # Solo para consultas SELECT
-            if query.strip().upper().startswith('SELECT'):
+            if op == 'SELECT':
                 result = cursor.fetchall()
+                rows = len(result)
+                QUERY_ROWS.observe(rows, statement)
             else:
                 result = []
+                sticky_writes.record_write()
                 
-            self.connection.commit()
+            if tx is None:
+                connection.commit()
+            (pool or self.primary).breaker.record_success()
             return result, last_id
         except Error as e:
-            self.connection.rollback()
-            print(f"Error executing query: {e}")
+            QUERY_ERRORS.inc(statement, op)
+            if e.errno == ER_QUERY_TIMEOUT:
+                STATEMENT_TIMEOUTS.inc(statement)
+            if e.errno in UNAVAILABLE_ERRNOS:
+                # Conexión perdida: no vuelve al pool y cuenta para el circuit breaker
+                (pool or self.primary).breaker.record_failure(e)
+                discard = True
+            if tx is None:
+                try:
+                    connection.rollback()
+                except Error:
+                    discard = True
+            logger.error("Error ejecutando %s (%s): %s", statement, op, e)
             raise e
         finally:
-            cursor.close()
+            if inflight is not None:
+                # Tomar el lock espera a un KILL QUERY en curso antes de soltar la conexión
+                with inflight.lock:
+                    inflight.connection_id = None
+            elapsed = time.perf_counter() - start
+            QUERY_SECONDS.observe(elapsed, statement, op)
+            timing = current_timing.get()
+            if timing is not None:
+                timing.db += elapsed
+                timing.db_queries += 1
+            if elapsed * 1000 >= SLOW_QUERY_MS:
+                SLOW_QUERIES.inc(statement)
+                logger.warning("Consulta lenta (%.1f ms) en %s: %s", elapsed * 1000, statement, normalized[:500])
+            if profile is not None:
+                profile.exit_thread()
+                profile.record_query(statement, normalized, op, target, elapsed * 1000, rows)
+            try:
+                cursor.close()
+            except Error:
+                discard = True
+            if pool is not None:
+                pool.release(connection, discard)
+
+    async def execute(self, query: str, params: tuple = None, use_primary: bool = False,
+                      statement: str = None) -> Tuple[List[Dict], Optional[int]]:
+        """Versión async de execute_query: corre en el pool de hilos de la base de datos."""
+        statement = statement or sys._getframe(1).f_code.co_name
+        inflight = _Inflight()
+        try:
+            return await self.run_sync(self.execute_query, query, params, use_primary, statement, inflight)
+        except asyncio.CancelledError:
+            # El hilo sigue con la sentencia: se corta en MySQL y la conexión vuelve limpia al pool
+            asyncio.get_running_loop().run_in_executor(None, self._kill, inflight)
+            raise
 
-    def begin_transaction(self):
-        self.connection.start_transaction()
+    def _kill(self, inflight: _Inflight) -> None:
+        """KILL QUERY sobre la sentencia de `inflight`, desde una conexión aparte."""
+        with inflight.lock:
+            inflight.cancelled = True
+            if inflight.connection_id is None:
+                return
+            try:
+                connection = mysql.connector.connect(**inflight.config, connection_timeout=5)
+                try:
+                    cursor = connection.cursor()
+                    cursor.execute(f"KILL QUERY {int(inflight.connection_id)}")
+                    cursor.close()
+                finally:
+                    connection.close()
+                QUERY_CANCELLATIONS.inc(inflight.statement)
+            except Error as e:
+                logger.warning("No se pudo cancelar la consulta %s: %s", inflight.statement, e)
+
+    async def run_sync(self, fn, *args):
+        """
+        Ejecuta una función bloqueante fuera del event loop, con las contextvars del request.
+        Dentro de una transacción se usa el executor por defecto: la conexión ya está fijada,
+        así que esas sentencias nunca esperan detrás de hilos bloqueados esperando el pool.
+        """
+        loop = asyncio.get_running_loop()
+        executor = None if _transaction.get() is not None else self._executor
+        ctx = contextvars.copy_context()
+        return await loop.run_in_executor(executor, partial(ctx.run, fn, *args))
+
+    async def begin_transaction(self):
+        connection = await self.run_sync(self.primary.acquire)
+        tx = _Transaction(connection)
+        _transaction.set(tx)
+        try:
+            await self.run_sync(connection.start_transaction)
+        except Error:
+            _transaction.set(None)
+            self.primary.release(connection, discard=True)
+            raise
+        sticky_writes.record_write()
 
-    def commit(self):
-        self.connection.commit()
+    async def commit(self):
+        await self._finish("commit")
 
-    def rollback(self):
-        self.connection.rollback()
+    async def rollback(self):
+        await self._finish("rollback")
+
+    async def _finish(self, outcome: str) -> None:
+        tx = _transaction.get()
+        if tx is None:
+            return
+        discard = False
+        try:
+            await self.run_sync(getattr(tx.connection, outcome))
+        except Error:
+            discard = True
+            raise
+        finally:
+            _transaction.set(None)
+            self.primary.release(tx.connection, discard)
+            TRANSACTION_SECONDS.observe(time.perf_counter() - tx.started, outcome)
+
+    @asynccontextmanager
+    async def transaction(self):
+        """
+        `async with db.transaction():` confirma al salir y revierte ante cualquier error.
+        Anidada dentro de otra transacción usa un SAVEPOINT: un error revierte solo el bloque
+        interno y la transacción exterior sigue abierta.
+        """
+        tx = _transaction.get()
+        if tx is not None:
+            tx.savepoints += 1
+            name = f"sp{tx.savepoints}"
+            await self.execute(f"SAVEPOINT {name}")
+            try:
+                yield
+            except BaseException:
+                try:
+                    await self.execute(f"ROLLBACK TO SAVEPOINT {name}")
+                except Error:
+                    # Un deadlock ya revirtió la transacción entera (y el savepoint)
+                    pass
+                raise
+            await self.execute(f"RELEASE SAVEPOINT {name}")
+            return
+
+        await self.begin_transaction()
+        try:
+            yield
+        except BaseException:
+            try:
+                await self.rollback()
+            except Error as e:
+                # Se propaga el error original; la conexión ya se descartó
+                logger.warning("No se pudo revertir la transacción: %s", e)
+            raise
+        await self.commit()
+
+    async def run_in_transaction(self, fn, *args, retries: int = DB_TX_RETRIES):
+        """
+        Ejecuta `await fn(*args)` dentro de una transacción y la confirma. Ante deadlock (1213)
+        o lock wait timeout (1205) la revierte y la repite completa hasta `retries` veces, con
+        backoff exponencial y jitter; fn debe poder repetirse (sin efectos fuera de la base).
+        Dentro de otra transacción corre en un savepoint y no reintenta: el conflicto se
+        propaga para que la transacción exterior lo resuelva.
+        """
+        if _transaction.get() is not None:
+            async with self.transaction():
+                return await fn(*args)
+        function = getattr(fn, "__name__", "transaction")
+        attempt = 0
+        while True:
+            try:
+                async with self.transaction():
+                    return await fn(*args)
+            except Error as e:
+                reason = _RETRYABLE.get(e.errno)
+                if reason is None:
+                    raise
+                if attempt >= retries:
+                    TRANSACTION_CONFLICTS.inc(function, reason)
+                    raise
+                attempt += 1
+                TRANSACTION_RETRIES.inc(function, reason)
+                delay = DB_TX_RETRY_BASE_MS / 1000 * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+                logger.warning("%s en %s; reintento %s/%s en %.0f ms", reason, function, attempt, retries, delay * 1000)
+                await asyncio.sleep(delay)
+
+    def close(self) -> None:
+        """Cierra las conexiones ociosas (al apagar el worker)."""
+        for pool in [self.primary] + self.replicas:
+            pool.close_idle()
+        self._executor.shutdown(wait=False)
 
 # Instancia global de la base de datos
 db = Database()
 
+# Nómina de un usuario (para publicar eventos de cambio)
+async def _nomina_of_user(id_user: int) -> Optional[int]:
+    q = 'SELECT nomina_idNomina FROM app_user WHERE idUser = %s'
+    rows, _ = await db.execute(q, (id_user,), use_primary=True)
+    return rows[0]['nomina_idNomina'] if rows else None
+
+# Usuario y nómina de un producto (para publicar eventos de cambio)
+async def _product_owner(id_product: int) -> Optional[Dict]:
+    q = 'SELECT user_idUser, user_nomina_idNomina FROM product WHERE idProduct = %s'
+    rows, _ = await db.execute(q, (id_product,), use_primary=True)
+    return rows[0] if rows else None
+
+# Registrar cambios en nomina_change (va en la transacción de la escritura que los origina)
+async def _log_changes(nomina_id: Optional[int], entity: str, entity_ids: List[int], op: str) -> None:
+    ids = [i for i in entity_ids if i is not None]
+    if nomina_id is None or not ids:
+        return
+    for chunk in _chunked_list(ids, 1000):
+        q = 'INSERT INTO nomina_change (nomina_id, entity, entity_id, op) VALUES ' + ','.join(['(%s, %s, %s, %s)'] * len(chunk))
+        params = tuple(v for entity_id in chunk for v in (nomina_id, entity, entity_id, op))
+        await db.execute(q, params)
+
+# Escritura de una sola sentencia junto con su registro de cambio, en una transacción
+async def _logged_write(q: str, params: tuple, nomina_id: Optional[int], entity: str, op: str,
+                        entity_id: Optional[int] = None, extra: List[Tuple[str, tuple]] = ()) -> Optional[int]:
+    """
+    Ejecuta q y anota el cambio de forma atómica. Si entity_id es None se usa el id insertado.
+    extra son sentencias (sql, params) que van en la misma transacción después de q.
+    Devuelve el último id insertado.
+    """
+    statement = sys._getframe(1).f_code.co_name
+
+    async def write():
+        _, last_id = await db.execute(q, params, statement=statement)
+        for extra_q, extra_params in extra:
+            await db.execute(extra_q, extra_params, statement=statement)
+        await _log_changes(nomina_id, entity, [entity_id if entity_id is not None else last_id], op)
+        return last_id
+
+    write.__name__ = statement
+    return await db.run_in_transaction(write)
+
 # Comprobar nombre
 async def get_user_by_name(name: str) -> Dict:
     sql = 'SELECT idEmployee, name, password, role FROM employee WHERE name = %s LIMIT 1'
-    results, _ = db.execute_query(sql, (name,))
+    results, _ = await db.execute(sql, (name,))
     return results[0] if results else None
 
 # Comprobar clave
@@ -89,86 +500,91 @@ async def authenticate(name: str, password: str) -> Dict:
     }
 
 # Obtener todos los clientes
+@coalesced(tag=lambda: "clients")
 async def get_client() -> List[Dict]:
     query = 'SELECT idClient, name FROM client'
-    results, _ = db.execute_query(query)
+    results, _ = await db.execute(query)
     return results
 
 # Agregar un cliente
 async def add_client(name: str) -> Dict:
     query = 'INSERT INTO client (name) VALUES (%s)'
-    _, last_id = db.execute_query(query, (name,))
+    _, last_id = await db.execute(query, (name,))
+    await invalidate_reads("clients")
     return {"insertId": last_id}
 
 # Obtener todos los empleados
 async def get_employee() -> List[Dict]:
     q = 'SELECT idEmployee, name, password, role FROM employee'
-    results, _ = db.execute_query(q)
+    results, _ = await db.execute(q)
     return results
 
 # Eliminar un empleado
 async def delete_employee(id: int) -> None:
     q = 'DELETE FROM employee WHERE idEmployee = %s'
-    db.execute_query(q, (id,))
+    await db.execute(q, (id,))
 
 # Actualizar un empleado
 async def update_employee(id: int, name: str, password: str, role: str) -> None:
     q = 'UPDATE employee SET name = %s, password = %s, role = %s WHERE idEmployee = %s'
-    db.execute_query(q, (name, password, role, id))
+    await db.execute(q, (name, password, role, id))
 
 # Agregar un nuevo empleado
 async def add_employee(name: str, password: str, role: str) -> Dict:
     q = 'INSERT INTO employee (name, password, role) VALUES (%s, %s, %s)'
-    _, last_id = db.execute_query(q, (name, password, role))
+    _, last_id = await db.execute(q, (name, password, role))
     return {"insertId": last_id}
 
 # Obtener nóminas según cliente
+@coalesced(tag=lambda client_id: "nominas")
 async def get_nominas(client_id: int) -> List[Dict]:
     q = """
-    SELECT idNomina, name 
+    SELECT idNomina, name, archived_at 
     FROM nomina 
     WHERE client_idClient = %s
     """
-    results, _ = db.execute_query(q, (client_id,))
+    results, _ = await db.execute(q, (client_id,))
     return results
 
 # Eliminar una nómina con sus usuarios y su cliente si no quedan nóminas del mismo
 async def delete_nomina(id_nomina: int, client_id: int) -> None:
-    try:
-        db.begin_transaction()
-        
-        # 1) Obtener IDs de usuarios a borrar
-        q0 = 'SELECT idUser FROM app_user WHERE nomina_idNomina = %s'
-        users, _ = db.execute_query(q0, (id_nomina,))
+    async def delete_nomina_tx():
+        # 1) Bloquear en el orden de las cascadas: nómina, usuarios por idUser, productos
+        await db.execute('SELECT idNomina FROM nomina WHERE idNomina = %s FOR UPDATE', (id_nomina,))
+        q0 = 'SELECT idUser FROM app_user WHERE nomina_idNomina = %s ORDER BY idUser FOR UPDATE'
+        users, _ = await db.execute(q0, (id_nomina,))
         user_ids = [row['idUser'] for row in users]
         
         # 2) Borrar productos de esos usuarios (si hay alguno)
         if user_ids:
             q_prod = 'DELETE FROM product WHERE user_idUser IN ({})'.format(','.join(['%s'] * len(user_ids)))
-            db.execute_query(q_prod, tuple(user_ids))
+            await db.execute(q_prod, tuple(user_ids))
         
         # 3) Borrar usuarios de la nómina
         q1 = 'DELETE FROM app_user WHERE nomina_idNomina = %s'
-        db.execute_query(q1, (id_nomina,))
+        await db.execute(q1, (id_nomina,))
 
         # 4) Borrar la nómina
         q2 = 'DELETE FROM nomina WHERE idNomina = %s'
-        db.execute_query(q2, (id_nomina,))
-        
-        db.commit()
-    except Exception as e:
-        db.rollback()
-        raise e
+        await db.execute(q2, (id_nomina,))
+
+        # 5) Una sola lápida para toda la nómina
+        await _log_changes(id_nomina, 'nomina', [id_nomina], 'delete')
+
+    await db.run_in_transaction(delete_nomina_tx)
+    await publish_nomina_event(id_nomina, "nomina_deleted")
+    await invalidate_reads("nominas")
 
 # Obtener usuarios
 async def get_users(nomina_id: int) -> List[Dict]:
     q = """
     SELECT * FROM vista_usuarios WHERE nomina_idNomina = %s;
     """
-    results, _ = db.execute_query(q, (nomina_id,))
+    results, _ = await db.execute(q, (nomina_id,))
     return results
 
 # Obtener usuarios con paginación
+@coalesced(tag=lambda nomina_id, *args, **kwargs: f"nomina:{nomina_id}")
 async def get_users_paginated(nomina_id: int, offset: int = 0, limit: int = 8) -> Dict:
     """
     Obtiene usuarios de una nómina con paginación
@@ -176,7 +592,7 @@ async def get_users_paginated(nomina_id: int, offset: int = 0, limit: int = 8) -
     """
     # Consulta para obtener el total de usuarios
     count_query = "SELECT COUNT(*) as total FROM vista_usuarios WHERE nomina_idNomina = %s"
-    count_result, _ = db.execute_query(count_query, (nomina_id,))
+    count_result, _ = await db.execute(count_query, (nomina_id,))
     total = count_result[0]['total'] if count_result else 0
     
     # Consulta para obtener usuarios paginados
@@ -186,7 +602,7 @@ async def get_users_paginated(nomina_id: int, offset: int = 0, limit: int = 8) -
     ORDER BY lastName
     LIMIT %s OFFSET %s
     """
-    results, _ = db.execute_query(query, (nomina_id, limit, offset))
+    results, _ = await db.execute(query, (nomina_id, limit, offset))
     
     return {
         "users": results,
@@ -204,10 +620,12 @@ async def insert_user(rut: str, name: str, last_name: str, sex: str, area: str,
     (rut, name, lastName, sex, area, service, center, nomina_idNomina, nomina_idClient)
     VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
     """
-    _, last_id = db.execute_query(
+    last_id = await _logged_write(
         q,
-        (rut, name, last_name, sex, area, service, center, nomina_id, client_id)
+        (rut, name, last_name, sex, area, service, center, nomina_id, client_id),
+        nomina_id, 'user', 'upsert'
     )
+    await publish_nomina_event(nomina_id, "user_added", idUser=last_id)
     return last_id
 
 # Obtener productos segun usuario
@@ -217,20 +635,52 @@ async def get_products(user_id: int) -> List[Dict]:
     FROM product
     WHERE user_idUser = %s
     """
-    results, _ = db.execute_query(q, (user_id,))
+    results, _ = await db.execute(q, (user_id,))
     return results
 
+# Obtener productos de varios usuarios en una sola consulta (agrupados por usuario)
+async def get_products_for_users(user_ids: List[int]) -> Dict[int, List[Dict]]:
+    products: Dict[int, List[Dict]] = {user_id: [] for user_id in user_ids}
+    for chunk in _chunked_list(list(products), 1000):
+        q = """
+        SELECT idProduct, sku, name, color, quantity, size, user_idUser
+        FROM product
+        WHERE user_idUser IN ({})
+        ORDER BY user_idUser, idProduct
+        """.format(','.join(['%s'] * len(chunk)))
+        results, _ = await db.execute(q, tuple(chunk))
+        for row in results:
+            products[row.pop('user_idUser')].append(row)
+    return products
+
 # Obtener todos los productos
 async def get_all_products() -> List[Dict]:
     q = """
     SELECT idProduct, sku, name, color, quantity, size
     FROM product
     """
-    results, _ = db.execute_query(q)
+    results, _ = await db.execute(q)
     return results
 
-# Actualizar comentario y firma
-async def update_user_comment_signature(id_user: int, comment: str, signature: Optional[str], performed_by: str, signatureDate: str) -> None:
+# Rollup de firmas por hora/empleado/nómina (ver migrations/versions/0006_signature_rollup.sql).
+# Cuenta usuarios firmados, como la carga inicial: solo suma la primera firma, no las
+# re-firmas ni los comentarios que reenvían la firma
+_SIGNATURE_ROLLUP_INCREMENT = """
+INSERT INTO signature_rollup (client_id, hour, employee, nomina_id, signatures)
+SELECT nomina_idClient, TIMESTAMP(DATE(d), MAKETIME(HOUR(d), 0, 0)), COALESCE(employee, ''), nomina_idNomina, 1
+FROM (SELECT nomina_idClient, nomina_idNomina, employee, COALESCE(signatureDate, NOW()) AS d
+      FROM app_user WHERE idUser = %s AND last_submission_us = %s) u
+ON DUPLICATE KEY UPDATE signatures = signatures + 1
+"""
+
+# Sentencias de un comentario con o sin firma (las comparte el journal de firmas).
+# submitted_us es el momento del envío en microsegundos: un envío más antiguo que el último
+# aplicado no pisa al más nuevo (los journals de distintos workers se aplican en cualquier
+# orden), y la firma solo suma en el rollup si el UPDATE se aplicó y el usuario no estaba
+# firmado (was_signed, leído con la fila bloqueada).
+def _comment_signature_statements(id_user: int, comment: str, signature: Optional[str], performed_by: str,
+                                  signatureDate: str, submitted_us: int,
+                                  was_signed: bool) -> Tuple[str, tuple, List[Tuple[str, tuple]]]:
     if signature:
         q = """
         UPDATE app_user
@@ -238,45 +688,151 @@ async def update_user_comment_signature(id_user: int, comment: str, signature: O
             comment = %s,
             signature = %s,
             employee = %s,
-            signatureDate = %s
-        WHERE idUser = %s
+            signatureDate = %s,
+            last_submission_us = %s
+        WHERE idUser = %s AND (last_submission_us IS NULL OR last_submission_us <= %s)
         """
-        params = (comment, signature, performed_by, signatureDate, id_user)
+        params = (comment, signature, performed_by, signatureDate, submitted_us, id_user, submitted_us)
+        # La primera firma suma 1 en el rollup de analítica, con los valores ya guardados
+        extra = [] if was_signed else [(_SIGNATURE_ROLLUP_INCREMENT, (id_user, submitted_us))]
     else:
         q = """
         UPDATE app_user
         SET 
             comment = %s,
-            employee = %s
-        WHERE idUser = %s
+            employee = %s,
+            last_submission_us = %s
+        WHERE idUser = %s AND (last_submission_us IS NULL OR last_submission_us <= %s)
         """
-        params = (comment, performed_by, id_user)
+        params = (comment, performed_by, submitted_us, id_user, submitted_us)
+        extra = []
+    return q, params, extra
 
-        print("Consulta SQL:", q)
-        print("Parámetros:", params)
-    
-    db.execute_query(q, params)
+# Actualizar comentario y firma
+async def update_user_comment_signature(id_user: int, comment: str, signature: Optional[str], performed_by: str, signatureDate: str) -> None:
+    async def update_user_comment_signature_tx():
+        rows, _ = await db.execute(
+            "SELECT nomina_idNomina, last_submission_us, COALESCE(signature, '') != '' AS signed "
+            'FROM app_user WHERE idUser = %s FOR UPDATE', (id_user,))
+        if not rows:
+            return None
+        # El envío sincrónico llega ahora y siempre gana: la marca se toma por encima de la
+        # guardada, así un reloj local atrasado respecto del host que la puso no deja el
+        # UPDATE sin filas (con la fila bloqueada, la condición del WHERE se cumple)
+        submitted_us = max(time.time_ns() // 1000, (rows[0]['last_submission_us'] or 0) + 1)
+        q, params, extra = _comment_signature_statements(
+            id_user, comment, signature, performed_by, signatureDate, submitted_us, bool(rows[0]['signed']))
+        await db.execute(q, params)
+        for extra_q, extra_params in extra:
+            await db.execute(extra_q, extra_params)
+        await _log_changes(rows[0]['nomina_idNomina'], 'user', [id_user], 'upsert')
+        return rows[0]['nomina_idNomina']
+
+    nomina_id = await db.run_in_transaction(update_user_comment_signature_tx)
+    if nomina_id is None:
+        # El usuario no existe: nada que registrar ni anunciar
+        return
+    await publish_nomina_event(
+        nomina_id,
+        "user_signed" if signature else "user_commented",
+        idUser=id_user, employee=performed_by,
+    )
+
+# Aplicar un lote del journal de firmas (write-behind)
+async def apply_signature_batch(journal: str, entries: List[Dict]) -> Dict[str, Any]:
+    """
+    Aplica en una transacción las entradas (en orden de seq) con la misma semántica que
+    update_user_comment_signature, y guarda en signature_journal el último seq aplicado.
+    Las entradas con seq <= al guardado ya se aplicaron antes de un reinicio y se omiten,
+    así reprocesar el journal después de una caída no duplica firmas en el rollup.
+    Las entradas más antiguas (por ts) que el último envío aplicado al usuario, desde
+    cualquier journal o en modo sincrónico, se omiten como obsoletas.
+    """
+    async def apply_signature_batch_tx():
+        rows, _ = await db.execute(
+            'SELECT seq FROM signature_journal WHERE name = %s FOR UPDATE', (journal,))
+        applied_seq = rows[0]['seq'] if rows else 0
+        todo = [e for e in entries if e['seq'] > applied_seq]
+        nominas: Dict[int, int] = {}
+        last_us: Dict[int, Optional[int]] = {}
+        signed: Dict[int, bool] = {}
+        ids = sorted({e['idUser'] for e in todo})
+        for chunk in _chunked_list(ids, 1000):
+            q = f"SELECT idUser, nomina_idNomina, last_submission_us, COALESCE(signature, '') != '' AS signed FROM app_user WHERE idUser IN ({','.join(['%s'] * len(chunk))}) ORDER BY idUser FOR UPDATE"
+            found, _ = await db.execute(q, tuple(chunk))
+            nominas.update({r['idUser']: r['nomina_idNomina'] for r in found})
+            last_us.update({r['idUser']: r['last_submission_us'] for r in found})
+            signed.update({r['idUser']: bool(r['signed']) for r in found})
+        applied = []
+        stale = 0
+        for e in todo:
+            if e['idUser'] not in nominas:
+                # El usuario se eliminó antes de aplicar la entrada
+                continue
+            submitted_us = int(e['ts'] * 1000000)
+            if last_us[e['idUser']] is not None and last_us[e['idUser']] > submitted_us:
+                # Otro worker ya aplicó un envío más nuevo para este usuario
+                stale += 1
+                continue
+            last_us[e['idUser']] = submitted_us
+            q, params, extra = _comment_signature_statements(
+                e['idUser'], e['comment'], e['signature'], e['performedBy'], e['signatureDate'], submitted_us,
+                signed[e['idUser']])
+            signed[e['idUser']] = signed[e['idUser']] or bool(e['signature'])
+            await db.execute(q, params)
+            for extra_q, extra_params in extra:
+                await db.execute(extra_q, extra_params)
+            applied.append({**e, 'nomina_id': nominas[e['idUser']]})
+        by_nomina: Dict[int, List[int]] = {}
+        for e in applied:
+            by_nomina.setdefault(e['nomina_id'], []).append(e['idUser'])
+        for nomina_id, user_ids in by_nomina.items():
+            await _log_changes(nomina_id, 'user', list(dict.fromkeys(user_ids)), 'upsert')
+        last_seq = max((e['seq'] for e in entries), default=applied_seq)
+        await db.execute(
+            'INSERT INTO signature_journal (name, seq) VALUES (%s, %s) '
+            'ON DUPLICATE KEY UPDATE seq = GREATEST(seq, VALUES(seq))', (journal, last_seq))
+        return applied, len(entries) - len(todo), stale
+
+    applied, skipped, stale = await db.run_in_transaction(apply_signature_batch_tx)
+    for e in applied:
+        await publish_nomina_event(
+            e['nomina_id'],
+            "user_signed" if e['signature'] else "user_commented",
+            idUser=e['idUser'], employee=e['performedBy'],
+        )
+    return {"applied": len(applied), "replayed": skipped, "stale": stale,
+            "missing": len(entries) - skipped - stale - len(applied)}
 
 # Eliminar usuario y sus productos
 async def delete_user(id_user: int) -> None:
-    try:
-        db.begin_transaction()
-        
-        # 1) Borrar productos asociados
+    nomina_id = await _nomina_of_user(id_user)
+
+    async def delete_user_tx():
+        # Orden de las cascadas: el usuario (padre) se bloquea antes que sus productos
+        await db.execute('SELECT idUser FROM app_user WHERE idUser = %s FOR UPDATE', (id_user,))
+
+        # 1) Lápidas de los productos asociados
+        q_log = """
+        INSERT INTO nomina_change (nomina_id, entity, entity_id, op)
+        SELECT user_nomina_idNomina, 'product', idProduct, 'delete' FROM product WHERE user_idUser = %s
+        """
+        await db.execute(q_log, (id_user,))
+
+        # 2) Borrar productos asociados
         q_prod = 'DELETE FROM product WHERE user_idUser = %s'
-        db.execute_query(q_prod, (id_user,))
+        await db.execute(q_prod, (id_user,))
         
-        # 2) Borrar usuario
+        # 3) Borrar usuario
         q_user = 'DELETE FROM app_user WHERE idUser = %s'
-        db.execute_query(q_user, (id_user,))
-        
-        db.commit()
-    except Exception as e:
-        db.rollback()
-        raise e
+        await db.execute(q_user, (id_user,))
+        await _log_changes(nomina_id, 'user', [id_user], 'delete')
+
+    await db.run_in_transaction(delete_user_tx)
+    await publish_nomina_event(nomina_id, "user_deleted", idUser=id_user)
 
 # Exportar a Excel
-async def export_excel_query(nomina_id: int) -> List[Dict]:
+async def export_excel_query(nomina_id: int, use_primary: bool = False) -> List[Dict]:
     query = """
     SELECT 
         u.rut, u.name AS username, u.lastName, u.area, u.signature, u.employee, u.signatureDate, u.sex, u.center, u.service,
@@ -286,13 +842,21 @@ async def export_excel_query(nomina_id: int) -> List[Dict]:
     WHERE u.nomina_idNomina = %s
     ORDER BY u.rut
     """
-    results, _ = db.execute_query(query, (nomina_id,))
+    results, _ = await db.execute(query, (nomina_id,), use_primary=use_primary)
     return results
 
+# Versión de la nómina para los snapshots de exportación (último cambio registrado)
+async def get_nomina_version(nomina_id: int) -> int:
+    q = 'SELECT id FROM nomina_change WHERE nomina_id = %s ORDER BY id DESC LIMIT 1'
+    # Del primario: con una réplica atrasada se serviría un snapshot anterior a la escritura
+    rows, _ = await db.execute(q, (nomina_id,), use_primary=True)
+    return rows[0]['id'] if rows else 0
+
 # Insertar nueva nómina
 async def insert_nomina(name: str, client_id: int) -> Dict:
     q = 'INSERT INTO nomina (name, client_idClient) VALUES (%s, %s)'
-    _, last_id = db.execute_query(q, (name, client_id))
+    _, last_id = await db.execute(q, (name, client_id))
+    await invalidate_reads("nominas")
     return {"insertId": last_id}
 
 # Insertar usuario de Excel
@@ -302,7 +866,7 @@ async def insert_excel_user(user: Dict) -> Dict:
     (rut, name, lastName, sex, area, service, center, nomina_idNomina, nomina_idClient)
     VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
     """
-    _, last_id = db.execute_query(
+    last_id = await _logged_write(
         q,
         (
             user['rut'], 
@@ -314,8 +878,10 @@ async def insert_excel_user(user: Dict) -> Dict:
             user['center'], 
             user['nomina_idNomina'], 
             user['nomina_idClient']
-        )
+        ),
+        user['nomina_idNomina'], 'user', 'upsert'
     )
+    await publish_nomina_event(user['nomina_idNomina'], "user_added", idUser=last_id)
     return {"insertId": last_id}
 
 # Insertar producto
@@ -325,7 +891,7 @@ async def insert_product(product: Dict) -> None:
     (name, color, quantity, size, sku, user_idUser, user_nomina_idNomina, user_nomina_idClient)
     VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
     """
-    db.execute_query(
+    last_id = await _logged_write(
         q,
         (
             product['name'],
@@ -336,13 +902,21 @@ async def insert_product(product: Dict) -> None:
             product['user_idUser'],
             product['user_nomina_idNomina'],
             product['user_nomina_idClient']
-        )
+        ),
+        product['user_nomina_idNomina'], 'product', 'upsert'
     )
+    await publish_nomina_event(product['user_nomina_idNomina'], "product_added",
+                               idProduct=last_id, idUser=product['user_idUser'])
 
 # Actualizar cantidad de producto
 async def update_product_quantity(id_product: int, quantity: int) -> None:
+    owner = await _product_owner(id_product)
     q = 'UPDATE product SET quantity = %s WHERE idProduct = %s'
-    db.execute_query(q, (quantity, id_product))
+    await _logged_write(q, (quantity, id_product), owner and owner['user_nomina_idNomina'],
+                        'product', 'upsert', id_product)
+    if owner:
+        await publish_nomina_event(owner['user_nomina_idNomina'], "product_updated",
+                                   idProduct=id_product, idUser=owner['user_idUser'], quantity=quantity)
 
 # Buscar todos los usuarios por nombre, apellido o rut
 async def search_all_users(query: str) -> List[Dict]:
@@ -363,35 +937,51 @@ async def search_all_users(query: str) -> List[Dict]:
     WHERE au.rut LIKE %s OR CONCAT(au.name, ' ', au.lastName) LIKE %s
     LIMIT 3
     """
-    results, _ = db.execute_query(sql, (like, like))
+    results, _ = await db.execute(sql, (like, like))
     return results
 
 # Eliminar cliente y todas sus dependencias
 async def delete_client(client_id: int) -> None:
-    try:
-        db.begin_transaction()
+    nominas, _ = await db.execute('SELECT idNomina FROM nomina WHERE client_idClient = %s', (client_id,), use_primary=True)
+
+    async def delete_client_tx():
+        # Orden de las cascadas: cliente, nóminas por id, usuarios por idUser, productos
+        await db.execute('SELECT idClient FROM client WHERE idClient = %s FOR UPDATE', (client_id,))
+        await db.execute('SELECT idNomina FROM nomina WHERE client_idClient = %s ORDER BY idNomina FOR UPDATE', (client_id,))
+        await db.execute('SELECT idUser FROM app_user WHERE nomina_idClient = %s ORDER BY idUser FOR UPDATE', (client_id,))
+
+        # Una lápida por cada nómina del cliente
+        q_log = """
+        INSERT INTO nomina_change (nomina_id, entity, entity_id, op)
+        SELECT idNomina, 'nomina', idNomina, 'delete' FROM nomina WHERE client_idClient = %s
+        """
+        await db.execute(q_log, (client_id,))
         
         q_prod = 'DELETE FROM product WHERE user_nomina_idClient = %s'
-        db.execute_query(q_prod, (client_id,))
+        await db.execute(q_prod, (client_id,))
         
         q_user = 'DELETE FROM app_user WHERE nomina_idClient = %s'
-        db.execute_query(q_user, (client_id,))
+        await db.execute(q_user, (client_id,))
         
         q_nom = 'DELETE FROM nomina WHERE client_idClient = %s'
-        db.execute_query(q_nom, (client_id,))
+        await db.execute(q_nom, (client_id,))
         
         q_client = 'DELETE FROM client WHERE idClient = %s'
-        db.execute_query(q_client, (client_id,))
-        
-        db.commit()
-    except Exception as e:
-        db.rollback()
-        raise e
+        await db.execute(q_client, (client_id,))
+
+        await db.execute('DELETE FROM signature_rollup WHERE client_id = %s', (client_id,))
+
+    await db.run_in_transaction(delete_client_tx)
+    for row in nominas:
+        await publish_nomina_event(row['idNomina'], "nomina_deleted")
+    await invalidate_reads("nominas")
+    await invalidate_reads("clients")
 
 # Actualizar nombre de cliente
 async def update_client(id_client: int, name: str) -> None:
     q = 'UPDATE client SET name = %s WHERE idClient = %s'
-    db.execute_query(q, (name, id_client))
+    await db.execute(q, (name, id_client))
+    await invalidate_reads("clients")
 
 # Cambiar nombre de nómina
 async def changeNominaName(id_nomina: int, new_name: str) -> None:
@@ -399,17 +989,29 @@ async def changeNominaName(id_nomina: int, new_name: str) -> None:
     Actualiza el campo name de la nómina especificada.
     """
     q = 'UPDATE nomina SET name = %s WHERE idNomina = %s'
-    db.execute_query(q, (new_name, id_nomina))
+    await db.execute(q, (new_name, id_nomina))
+    await publish_nomina_event(id_nomina, "nomina_renamed", name=new_name)
+    await invalidate_reads("nominas")
 
 # Eliminar un producto
 async def delete_product(id_product: int) -> None:
+    owner = await _product_owner(id_product)
     q = 'DELETE FROM product WHERE idProduct = %s'
-    db.execute_query(q, (id_product,))
+    await _logged_write(q, (id_product,), owner and owner['user_nomina_idNomina'],
+                        'product', 'delete', id_product)
+    if owner:
+        await publish_nomina_event(owner['user_nomina_idNomina'], "product_deleted",
+                                   idProduct=id_product, idUser=owner['user_idUser'])
 
 # Actualizar talla de un producto
 async def update_product_size(id_product: int, size: str) -> None:
+    owner = await _product_owner(id_product)
     q = 'UPDATE product SET size = %s WHERE idProduct = %s'
-    db.execute_query(q, (size, id_product))
+    await _logged_write(q, (size, id_product), owner and owner['user_nomina_idNomina'],
+                        'product', 'upsert', id_product)
+    if owner:
+        await publish_nomina_event(owner['user_nomina_idNomina'], "product_updated",
+                                   idProduct=id_product, idUser=owner['user_idUser'], size=size)
 
 # Añadir un producto
 async def insert_product_return_id(product: Dict[str, Any]) -> int:
@@ -434,33 +1036,194 @@ async def insert_product_return_id(product: Dict[str, Any]) -> int:
         product['user_nomina_idClient']
     )
     # Ejecuta y captura el lastrowid
-    _, last_id = db.execute_query(q, params)
+    last_id = await _logged_write(q, params, product['user_nomina_idNomina'], 'product', 'upsert')
+    await publish_nomina_event(product['user_nomina_idNomina'], "product_added",
+                               idProduct=last_id, idUser=product['user_idUser'])
     return last_id
 
 # Reporte
+@coalesced(tag=lambda nomina_id: f"nomina:{nomina_id}")
 async def get_report_counts(nomina_id: int) -> Dict[str, int]:
     q_total = "SELECT COUNT(*) as total FROM app_user WHERE nomina_idNomina = %s"
-    total, _ = db.execute_query(q_total, (nomina_id,))
+    total, _ = await db.execute(q_total, (nomina_id,))
     q_signed = "SELECT COUNT(*) as signed FROM app_user WHERE nomina_idNomina = %s AND signature IS NOT NULL AND signature != ''"
-    signed, _ = db.execute_query(q_signed, (nomina_id,))
+    signed, _ = await db.execute(q_signed, (nomina_id,))
     return {
         "total": total[0]['total'],
         "signed": signed[0]['signed']
     }
 
+# Agrupaciones admitidas por get_signature_stats
+SIGNATURE_STATS_GRANULARITIES = {"hour": "hour", "day": "DATE(hour)"}
+SIGNATURE_STATS_GROUPS = {"employee": "employee", "nomina": "nomina_id"}
+
+# Firmas por hora o por día de un cliente, leídas del rollup (sin recorrer app_user)
+async def get_signature_stats(client_id: int, since: datetime, until: datetime, granularity: str = "day",
+                              group_by: Optional[str] = None, nomina_id: Optional[int] = None) -> List[Dict]:
+    """
+    Devuelve [{bucket, signatures}] en [since, until), más employee o nomina_id según
+    group_by. La consulta es un rango sobre la clave primaria (client_id, hour).
+    """
+    bucket = SIGNATURE_STATS_GRANULARITIES[granularity]
+    columns = [f"{bucket} AS bucket"]
+    group = ["bucket"]
+    if group_by is not None:
+        columns.append(SIGNATURE_STATS_GROUPS[group_by])
+        group.append(SIGNATURE_STATS_GROUPS[group_by])
+    q = f"""
+    SELECT {', '.join(columns)}, SUM(signatures) AS signatures
+    FROM signature_rollup
+    WHERE client_id = %s AND hour >= %s AND hour < %s
+    """
+    params = [client_id, since, until]
+    if nomina_id is not None:
+        q += " AND nomina_id = %s"
+        params.append(nomina_id)
+    q += f" GROUP BY {', '.join(group)} ORDER BY {', '.join(group)}"
+    rows, _ = await db.execute(q, tuple(params))
+    for r in rows:
+        r['signatures'] = int(r['signatures'])
+    return rows
+
 # Inserción masiva de usuarios y productos
 def _chunked_list(lst, size):
     """Yield successive chunks from lst."""
     for i in range(0, len(lst), size):
         yield lst[i:i+size]
 
+# Longitudes máximas de columnas (ver migrations/versions/0001_baseline.sql)
+_BULK_USER_LIMITS = {"name": 100, "lastName": 100, "sex": 20, "area": 255, "service": 255, "center": 255}
+_BULK_PRODUCT_LIMITS = {"name": 255, "color": 64, "size": 32, "sku": 64}
+
+# Cantidad máxima aceptada por producto en la carga masiva
+BULK_MAX_PRODUCT_QUANTITY = int(os.getenv("BULK_MAX_PRODUCT_QUANTITY", "1000"))
+
+# Errores que se informan como máximo (el resto solo se cuenta)
+_BULK_MAX_REPORTED_ERRORS = 1000
+
+class BulkValidationError(ValueError):
+    """La carga masiva no pasó la validación previa; report trae el detalle por fila."""
+
+    def __init__(self, report: Dict):
+        super().__init__(f"Carga masiva inválida: {report['error_count']} errores")
+        self.report = report
+
+# 12345678-5 -> 12.345.678-5 (forma con puntos, como suelen venir de planillas)
+def _dotted_rut(rut: str) -> str:
+    number, sep, digit = rut.partition("-")
+    if not sep or not number.isdigit():
+        return rut
+    return f"{int(number):,}".replace(",", ".") + "-" + digit
+
+# Formas en que un RUT puede estar guardado (tal cual, canónica, con puntos, k minúscula):
+# para buscarlo con IN y comparar después en forma canónica
+def _rut_lookup_forms(rut: str) -> set:
+    canonical = normalize_rut(rut) or rut
+    forms = {rut, canonical, _dotted_rut(canonical)}
+    return forms | {form.lower() for form in forms}
+
+# Validación previa de la carga masiva (sin escribir)
+async def preflight_bulk_users_products(payload: dict) -> Dict:
+    """
+    Valida toda la carga antes de escribir: formato y dígito verificador de cada RUT,
+    RUT repetidos dentro de la carga, RUT ya presentes en la nómina (consultas IN por el
+    índice (nomina_idNomina, rut)) y campos de usuarios y productos.
+    Devuelve {valid, users, products, error_count, errors}; cada error indica row (índice
+    en users), product (índice dentro del usuario, si aplica), rut, field y error.
+    """
+    nomina_id = payload.get("nomina_idNomina")
+    client_id = payload.get("nomina_idClient")
+    users = payload.get("users") or []
+    errors: List[Dict] = []
+    error_count = 0
+
+    def fail(row, rut, field, message, product=None):
+        nonlocal error_count
+        error_count += 1
+        if len(errors) < _BULK_MAX_REPORTED_ERRORS:
+            entry = {"row": row, "rut": rut, "field": field, "error": message}
+            if product is not None:
+                entry["product"] = product
+            errors.append(entry)
+
+    # La nómina debe existir y pertenecer al cliente
+    nominas, _ = await db.execute(
+        'SELECT idNomina FROM nomina WHERE idNomina = %s AND client_idClient = %s',
+        (nomina_id, client_id), use_primary=True)
+    if not nominas:
+        fail(None, None, "nomina_idNomina", "La nómina no existe para el cliente indicado")
+
+    first_row: Dict[str, int] = {}
+    product_count = 0
+    for i, u in enumerate(users):
+        rut = u.get("rut")
+        canonical = normalize_rut(rut) if rut else None
+        if not rut:
+            fail(i, rut, "rut", "Falta el RUT")
+        elif canonical is None:
+            fail(i, rut, "rut", "Formato de RUT inválido")
+        elif not is_valid_rut(rut):
+            fail(i, rut, "rut", "Dígito verificador incorrecto")
+        elif canonical in first_row:
+            fail(i, rut, "rut", f"RUT repetido en la carga (fila {first_row[canonical]})")
+        else:
+            first_row[canonical] = i
+
+        for field in ("name", "lastName"):
+            if not str(u.get(field) or "").strip():
+                fail(i, rut, field, "Campo obligatorio vacío")
+        for field, limit in _BULK_USER_LIMITS.items():
+            if len(str(u.get(field) or "")) > limit:
+                fail(i, rut, field, f"Supera {limit} caracteres")
+
+        for j, p in enumerate(u.get("products") or []):
+            product_count += 1
+            if not str(p.get("name") or "").strip():
+                fail(i, rut, "name", "Producto sin nombre", j)
+            quantity = p.get("quantity", 0)
+            if not isinstance(quantity, int) or isinstance(quantity, bool) or not 0 <= quantity <= BULK_MAX_PRODUCT_QUANTITY:
+                fail(i, rut, "quantity", f"Cantidad debe ser un entero entre 0 y {BULK_MAX_PRODUCT_QUANTITY}", j)
+            for field, limit in _BULK_PRODUCT_LIMITS.items():
+                if len(str(p.get(field) or "")) > limit:
+                    fail(i, rut, field, f"Supera {limit} caracteres", j)
+
+    # RUT ya presentes en la nómina, guardados en cualquiera de sus formas
+    candidates = set()
+    for u in users:
+        rut = u.get("rut")
+        if rut and normalize_rut(rut) in first_row:
+            candidates.update(_rut_lookup_forms(rut))
+    for chunk in _chunked_list(sorted(candidates), 1000):
+        q = "SELECT idUser, rut FROM app_user WHERE nomina_idNomina = %s AND rut IN ({})".format(
+            ','.join(['%s'] * len(chunk)))
+        existing, _ = await db.execute(q, (nomina_id,) + tuple(chunk), use_primary=True)
+        for row in existing:
+            canonical = normalize_rut(row['rut']) or row['rut']
+            if canonical in first_row:
+                i = first_row.pop(canonical)
+                fail(i, users[i].get("rut"), "rut", f"El RUT ya existe en la nómina (idUser {row['idUser']})")
+
+    errors.sort(key=lambda e: (e["row"] is not None, e["row"] or 0))
+    return {
+        "valid": error_count == 0,
+        "users": len(users),
+        "products": product_count,
+        "error_count": error_count,
+        "errors": errors,
+    }
+
+# idUser de los RUT recién insertados por la carga masiva (también lo verifica migrations/plans.py)
+_BULK_IDS_BY_RUT = "SELECT idUser, rut FROM app_user WHERE rut IN ({}) AND nomina_idNomina = %s AND nomina_idClient = %s"
+
 # Inserción masiva de usuarios y productos
-async def insert_bulk_users_products(payload: dict) -> dict:
+async def insert_bulk_users_products(payload: dict, dry_run: bool = False) -> dict:
     """
     Espera payload con keys:
       - nomina_idNomina (int)
       - nomina_idClient (int)
       - users: List[ { rut, name, lastName, sex?, area?, service?, center?, products?: [ {name, color, quantity, size, sku} ] } ]
+    Antes de escribir valida toda la carga (preflight_bulk_users_products) y lanza
+    BulkValidationError con el reporte si hay errores; con dry_run=True solo devuelve el reporte.
     Hace inserts por lotes y en una sola transacción.
     Devuelve dict con conteos.
     """
@@ -471,9 +1234,15 @@ async def insert_bulk_users_products(payload: dict) -> dict:
     if not isinstance(users, list) or not nomina_id or not client_id:
         raise ValueError("Payload inválido: falta nomina_idNomina, nomina_idClient o users")
 
-    if len(users) == 0:
+    if len(users) == 0 and not dry_run:
         return {"inserted_users": 0, "inserted_products": 0}
 
+    report = await preflight_bulk_users_products(payload)
+    if dry_run:
+        return report
+    if not report["valid"]:
+        raise BulkValidationError(report)
+
     # Queries
     user_insert_q = """
     INSERT INTO app_user
@@ -509,76 +1278,92 @@ async def insert_bulk_users_products(payload: dict) -> dict:
 
     product_values = []  # se llenará después de obtener los idUser
 
-    # Conectar y ejecutar en transacción usando la conexión existente
-    db.connect()  # asegura que db.connection exista
-    try:
-        db.begin_transaction()
-        # 1) Insertar usuarios por lotes (batch)
-        cursor = db.connection.cursor()
-        try:
-            BATCH_USERS = 500
-            for chunk in _chunked_list(user_values, BATCH_USERS):
-                cursor.executemany(user_insert_q, chunk)
-            # NOTA: no commit aquí; lo haremos al final de la transacción
-        finally:
-            cursor.close()
-
-        # 2) Recuperar idUser por rut (hacemos SELECTs por batch si ruts muy grandes)
-        rut_to_id = {}
-        BATCH_SELECT = 1000
-        # usar cursores con dictionary=True para obtener rut y idUser
-        for chunk in _chunked_list(ruts, BATCH_SELECT):
-            placeholders = ",".join(["%s"] * len(chunk))
-            sel_q = f"SELECT idUser, rut FROM app_user WHERE rut IN ({placeholders}) AND nomina_idNomina = %s AND nomina_idClient = %s"
-            sel_params = tuple(chunk) + (nomina_id, client_id)
-            sel_cursor = db.connection.cursor(dictionary=True)
-            try:
-                sel_cursor.execute(sel_q, sel_params)
-                rows = sel_cursor.fetchall()
-                for row in rows:
-                    rut_to_id[row["rut"]] = row["idUser"]
-            finally:
-                sel_cursor.close()
-
-        # 3) Preparar productos con los idUser encontrados
-        for u in users:
-            rut = u["rut"]
-            idUser = rut_to_id.get(rut)
-            if not idUser:
-                # Si por alguna razón no se encontró el id (duplica rut en otra nomina, etc.), lanzar
-                raise Exception(f"No se encontró idUser para rut {rut} — verifica la inserción o existencia previa.")
-            for p in u.get("products", []) or []:
-                product_values.append((
-                    p.get("name", ""),
-                    p.get("color", ""),
-                    p.get("quantity", 0),
-                    p.get("size", ""),
-                    p.get("sku", ""),
-                    idUser,
-                    nomina_id,
-                    client_id
-                ))
-
-        # 4) Insertar productos por lotes
-        if product_values:
-            cursor2 = db.connection.cursor()
+    # Ejecutar en transacción sobre una conexión del pool (se repite completa ante deadlock)
+    async def insert_bulk_tx():
+        # Orden de las cascadas: la nómina antes que sus usuarios y productos
+        await db.execute('SELECT idNomina FROM nomina WHERE idNomina = %s FOR SHARE', (nomina_id,))
+
+        # Los pasos 1-4 usan cursores propios sobre la conexión de la transacción
+        # y corren fuera del event loop
+        def _write_rows():
+            product_values.clear()
+            # 1) Insertar usuarios por lotes (batch)
+            cursor = db.connection.cursor()
             try:
-                BATCH_PRODUCTS = 1000
-                for chunk in _chunked_list(product_values, BATCH_PRODUCTS):
-                    cursor2.executemany(product_insert_q, chunk)
+                BATCH_USERS = 500
+                for chunk in _chunked_list(user_values, BATCH_USERS):
+                    cursor.executemany(user_insert_q, chunk)
+                # NOTA: no commit aquí; lo haremos al final de la transacción
             finally:
-                cursor2.close()
+                cursor.close()
 
-        # 5) Commit único y devolver conteos
-        db.commit()
-        return {"inserted_users": len(user_values), "inserted_products": len(product_values)}
-    except Exception as e:
-        try:
-            db.rollback()
-        except Exception:
-            pass
-        raise e
+            # 2) Recuperar idUser por rut (hacemos SELECTs por batch si ruts muy grandes)
+            rut_to_id = {}
+            BATCH_SELECT = 1000
+            # usar cursores con dictionary=True para obtener rut y idUser
+            for chunk in _chunked_list(ruts, BATCH_SELECT):
+                placeholders = ",".join(["%s"] * len(chunk))
+                sel_q = _BULK_IDS_BY_RUT.format(placeholders)
+                sel_params = tuple(chunk) + (nomina_id, client_id)
+                sel_cursor = db.connection.cursor(dictionary=True)
+                try:
+                    sel_cursor.execute(sel_q, sel_params)
+                    rows = sel_cursor.fetchall()
+                    for row in rows:
+                        rut_to_id[row["rut"]] = row["idUser"]
+                finally:
+                    sel_cursor.close()
+
+            # 3) Preparar productos con los idUser encontrados
+            for u in users:
+                rut = u["rut"]
+                idUser = rut_to_id.get(rut)
+                if not idUser:
+                    # Si por alguna razón no se encontró el id (duplica rut en otra nomina, etc.), lanzar
+                    raise Exception(f"No se encontró idUser para rut {rut} — verifica la inserción o existencia previa.")
+                for p in u.get("products", []) or []:
+                    product_values.append((
+                        p.get("name", ""),
+                        p.get("color", ""),
+                        p.get("quantity", 0),
+                        p.get("size", ""),
+                        p.get("sku", ""),
+                        idUser,
+                        nomina_id,
+                        client_id
+                    ))
+
+            # 4) Insertar productos por lotes
+            if product_values:
+                cursor2 = db.connection.cursor()
+                try:
+                    BATCH_PRODUCTS = 1000
+                    for chunk in _chunked_list(product_values, BATCH_PRODUCTS):
+                        cursor2.executemany(product_insert_q, chunk)
+                finally:
+                    cursor2.close()
+
+            return list(rut_to_id.values())
+
+        user_ids = await db.run_sync(_write_rows)
+
+        # Registro de cambios: usuarios por id y sus productos (todos nuevos) en bloque
+        await _log_changes(nomina_id, 'user', user_ids, 'upsert')
+        for chunk in _chunked_list(user_ids, 1000):
+            q_log = """
+            INSERT INTO nomina_change (nomina_id, entity, entity_id, op)
+            SELECT user_nomina_idNomina, 'product', idProduct, 'upsert' FROM product WHERE user_idUser IN ({})
+            """.format(','.join(['%s'] * len(chunk)))
+            await db.execute(q_log, tuple(chunk))
+
+    # 5) Commit único y devolver conteos
+    await db.run_in_transaction(insert_bulk_tx)
+    await publish_nomina_event(nomina_id, "users_imported",
+                               users=len(user_values), products=len(product_values))
+    return {"inserted_users": len(user_values), "inserted_products": len(product_values)}
     
+# Nóminas completas con firmas: no se guardan para servir obsoletos
+@coalesced(tag=lambda nomina_id: f"nomina:{nomina_id}", stale=False)
 async def get_users_with_products(nomina_id: int) -> list:
     """
     Devuelve lista de usuarios con un campo 'products' que es lista de productos.
@@ -602,7 +1387,7 @@ async def get_users_with_products(nomina_id: int) -> list:
     WHERE u.nomina_idNomina = %s
     ORDER BY u.rut, u.idUser
     """
-    rows, _ = db.execute_query(q, (nomina_id,))
+    rows, _ = await db.execute(q, (nomina_id,))
     users_map = {}
     for r in rows:
         uid = r['idUser']
@@ -643,9 +1428,22 @@ async def get_user_by_id_db(user_id: int) -> Optional[Dict]:
     q = """
     SELECT * FROM vista_usuarios WHERE idUser = %s LIMIT 1
     """
-    results, _ = db.execute_query(q, (user_id,))
+    results, _ = await db.execute(q, (user_id,))
     return results[0] if results else None
 
+# Obtener varios usuarios por ID (consultas IN por lotes)
+async def get_users_by_ids(user_ids: List[int]) -> Dict[int, Dict]:
+    """
+    Devuelve {idUser: usuario} con los usuarios encontrados; los IDs inexistentes no aparecen.
+    """
+    users: Dict[int, Dict] = {}
+    for chunk in _chunked_list(list(dict.fromkeys(user_ids)), 1000):
+        q = "SELECT * FROM vista_usuarios WHERE idUser IN ({})".format(','.join(['%s'] * len(chunk)))
+        results, _ = await db.execute(q, tuple(chunk))
+        for row in results:
+            users[row['idUser']] = row
+    return users
+
 # Buscar usuarios dentro de una nómina específica por nombre, apellido o rut
 async def search_users_in_nomina(nomina_id: int, query: str) -> List[Dict]:
     """
@@ -671,5 +1469,464 @@ async def search_users_in_nomina(nomina_id: int, query: str) -> List[Dict]:
     ORDER BY lastName
     LIMIT 8
     """
-    results, _ = db.execute_query(sql, (nomina_id, like, like))
-    return results
\ No newline at end of file
+    results, _ = await db.execute(sql, (nomina_id, like, like))
+    return results
+# Columnas que la sincronización entrega por usuario y por producto
+_SYNC_USER_COLUMNS = """
+    idUser, rut, name, lastName, sex, area, service, center, comment, employee, signatureDate,
+    (signature IS NOT NULL AND signature != '') AS signed, nomina_idNomina
+"""
+_SYNC_PRODUCT_COLUMNS = "idProduct, sku, name, color, quantity, size, user_idUser"
+
+# Token desde el que una nómina se puede sincronizar completa sin perder cambios en vuelo
+async def _settled_token(nomina_id: int) -> int:
+    q = """
+    SELECT id FROM nomina_change
+    WHERE nomina_id = %s AND created_at < NOW() - INTERVAL %s SECOND
+    ORDER BY id DESC
+    LIMIT 1
+    """
+    rows, _ = await db.execute(q, (nomina_id, CHANGE_SYNC_OVERLAP_SECONDS))
+    return rows[0]['id'] if rows else 0
+
+# Cambios de una nómina desde un token (sincronización incremental de tablets)
+async def get_nomina_changes(nomina_id: int, since: Optional[int] = None, limit: int = 5000) -> Dict:
+    """
+    Devuelve los usuarios y productos insertados/actualizados desde `since` con su estado
+    actual, y las lápidas de los eliminados. Sin token, o con uno anterior a lo purgado del
+    registro, entrega la nómina completa con reset=True. El costo es proporcional a los
+    cambios: se leen `limit` entradas del registro como máximo (has_more indica que quedan).
+    Todo se lee del primario para que el token y las filas sean coherentes entre sí.
+    """
+    with primary():
+        state, _ = await db.execute('SELECT pruned_through FROM change_log_state WHERE id = 1')
+        pruned_through = state[0]['pruned_through'] if state else 0
+
+        if not since or since < pruned_through:
+            token = await _settled_token(nomina_id)
+            users, _ = await db.execute(
+                f"SELECT {_SYNC_USER_COLUMNS} FROM app_user WHERE nomina_idNomina = %s", (nomina_id,))
+            products, _ = await db.execute(
+                f"SELECT {_SYNC_PRODUCT_COLUMNS} FROM product WHERE user_nomina_idNomina = %s", (nomina_id,))
+            return {
+                "token": token, "reset": True, "has_more": False, "nomina_deleted": False,
+                "users": users, "products": products, "deleted": {"users": [], "products": []},
+            }
+
+        q = """
+        SELECT id, entity, entity_id, op, created_at < NOW() - INTERVAL %s SECOND AS settled
+        FROM nomina_change
+        WHERE nomina_id = %s AND id > %s
+        ORDER BY id
+        LIMIT %s
+        """
+        log, _ = await db.execute(q, (CHANGE_SYNC_OVERLAP_SECONDS, nomina_id, since, limit))
+        has_more = len(log) == limit
+
+        # Se conserva solo la última operación de cada entidad
+        latest: Dict[Tuple[str, int], str] = {}
+        token = since
+        for row in log:
+            latest[(row['entity'], row['entity_id'])] = row['op']
+            if row['settled'] or has_more:
+                token = row['id']
+
+        if latest.get(('nomina', nomina_id)) == 'delete':
+            return {
+                "token": token, "reset": False, "has_more": False, "nomina_deleted": True,
+                "users": [], "products": [], "deleted": {"users": [], "products": []},
+            }
+
+        async def current(table: str, columns: str, key: str, owner: str, ids: List[int]) -> List[Dict]:
+            rows = []
+            for chunk in _chunked_list(ids, 1000):
+                q = f"SELECT {columns} FROM {table} WHERE {key} IN ({','.join(['%s'] * len(chunk))}) AND {owner} = %s"
+                found, _ = await db.execute(q, tuple(chunk) + (nomina_id,), statement="get_nomina_changes")
+                rows.extend(found)
+            return rows
+
+        changed = {
+            entity: [entity_id for (e, entity_id), op in latest.items() if e == entity and op == 'upsert']
+            for entity in ('user', 'product')
+        }
+        users = await current('app_user', _SYNC_USER_COLUMNS, 'idUser', 'nomina_idNomina', changed['user'])
+        products = await current('product', _SYNC_PRODUCT_COLUMNS, 'idProduct', 'user_nomina_idNomina', changed['product'])
+
+    # Lo que ya no existe en la nómina (borrado después o movido) también es una lápida
+    present_users = {u['idUser'] for u in users}
+    present_products = {p['idProduct'] for p in products}
+    deleted_users = [i for (e, i), op in latest.items()
+                     if e == 'user' and (op == 'delete' or i not in present_users)]
+    deleted_products = [i for (e, i), op in latest.items()
+                        if e == 'product' and (op == 'delete' or i not in present_products)]
+    return {
+        "token": token, "reset": False, "has_more": has_more, "nomina_deleted": False,
+        "users": users, "products": products,
+        "deleted": {"users": deleted_users, "products": deleted_products},
+    }
+
+# Sentencias de prune_change_log (también las verifica migrations/plans.py)
+_PRUNE_THROUGH = """
+SELECT id FROM nomina_change
+WHERE created_at < NOW() - INTERVAL %s DAY
+ORDER BY created_at DESC
+LIMIT 1
+"""
+_PRUNE_DELETE = 'DELETE FROM nomina_change WHERE id <= %s LIMIT 5000'
+_PRUNE_LEFT = 'SELECT id FROM nomina_change WHERE id <= %s LIMIT 1'
+
+# Purgar el registro de cambios más antiguo que la retención
+async def prune_change_log(retention_days: int = CHANGE_LOG_RETENTION_DAYS) -> int:
+    """
+    Marca primero hasta qué token se purga (los clientes con un token menor pasan a
+    resincronizar completo) y luego borra por lotes. Devuelve ese token (0 si no hubo nada).
+    """
+    rows, _ = await db.execute(_PRUNE_THROUGH, (retention_days,), use_primary=True)
+    if not rows:
+        return 0
+    through = rows[0]['id']
+    await db.execute(
+        'UPDATE change_log_state SET pruned_through = GREATEST(pruned_through, %s) WHERE id = 1', (through,))
+    while True:
+        await db.execute(_PRUNE_DELETE, (through,))
+        left, _ = await db.execute(_PRUNE_LEFT, (through,), use_primary=True)
+        if not left:
+            return through
+
+# Columnas que se guardan al archivar una nómina (ver archive.py)
+ARCHIVE_USER_COLUMNS = [
+    "idUser", "rut", "name", "lastName", "sex", "area", "service", "center", "signature",
+    "comment", "employee", "signatureDate", "nomina_idNomina", "nomina_idClient",
+]
+ARCHIVE_PRODUCT_COLUMNS = [
+    "idProduct", "sku", "name", "color", "quantity", "size",
+    "user_idUser", "user_nomina_idNomina", "user_nomina_idClient",
+]
+
+# Archivar una nómina: leerla bloqueada, persistirla con `store` y quitarla de las tablas calientes
+async def archive_nomina_rows(nomina_id: int, store) -> Optional[Dict]:
+    """
+    En una transacción: lee la nómina con FOR UPDATE (nadie la modifica mientras tanto),
+    llama `await store(nomina, users, products)`, que debe dejar el archivo escrito y
+    verificado, y recién entonces borra usuarios y productos y marca archived_at.
+    Devuelve lo que devuelva store, o None si la nómina no existe.
+    """
+    try:
+        await db.begin_transaction()
+        nominas, _ = await db.execute(
+            'SELECT idNomina, name, client_idClient, archived_at FROM nomina WHERE idNomina = %s FOR UPDATE',
+            (nomina_id,))
+        if not nominas:
+            await db.rollback()
+            return None
+        users, _ = await db.execute(
+            f"SELECT {', '.join(ARCHIVE_USER_COLUMNS)} FROM app_user WHERE nomina_idNomina = %s ORDER BY rut, idUser FOR UPDATE",
+            (nomina_id,))
+        products, _ = await db.execute(
+            f"SELECT {', '.join(ARCHIVE_PRODUCT_COLUMNS)} FROM product WHERE user_nomina_idNomina = %s ORDER BY idProduct FOR UPDATE",
+            (nomina_id,))
+        result = await store(nominas[0], users, products)
+
+        await db.execute('DELETE FROM product WHERE user_nomina_idNomina = %s', (nomina_id,))
+        await db.execute('DELETE FROM app_user WHERE nomina_idNomina = %s', (nomina_id,))
+        await db.execute('UPDATE nomina SET archived_at = NOW() WHERE idNomina = %s', (nomina_id,))
+        # Para la sincronización la nómina deja de existir en las tablas calientes
+        await _log_changes(nomina_id, 'nomina', [nomina_id], 'delete')
+        await db.commit()
+    except Exception as e:
+        await db.rollback()
+        raise e
+    await publish_nomina_event(nomina_id, "nomina_archived")
+    await invalidate_reads("nominas")
+    return result
+
+# Devolver a las tablas calientes una nómina archivada (con sus IDs originales)
+async def restore_archived_nomina(nomina_id: int, users: List[Dict], products: List[Dict]) -> None:
+    user_q = "INSERT INTO app_user ({}) VALUES ({})".format(
+        ', '.join(ARCHIVE_USER_COLUMNS), ', '.join(['%s'] * len(ARCHIVE_USER_COLUMNS)))
+    product_q = "INSERT INTO product ({}) VALUES ({})".format(
+        ', '.join(ARCHIVE_PRODUCT_COLUMNS), ', '.join(['%s'] * len(ARCHIVE_PRODUCT_COLUMNS)))
+    user_values = [tuple(u[c] for c in ARCHIVE_USER_COLUMNS) for u in users]
+    product_values = [tuple(p[c] for c in ARCHIVE_PRODUCT_COLUMNS) for p in products]
+
+    try:
+        await db.begin_transaction()
+
+        def _write_rows():
+            cursor = db.connection.cursor()
+            try:
+                for chunk in _chunked_list(user_values, 500):
+                    cursor.executemany(user_q, chunk)
+                for chunk in _chunked_list(product_values, 1000):
+                    cursor.executemany(product_q, chunk)
+            finally:
+                cursor.close()
+
+        await db.run_sync(_write_rows)
+        await db.execute('UPDATE nomina SET archived_at = NULL WHERE idNomina = %s', (nomina_id,))
+        await _log_changes(nomina_id, 'user', [u['idUser'] for u in users], 'upsert')
+        await _log_changes(nomina_id, 'product', [p['idProduct'] for p in products], 'upsert')
+        await db.commit()
+    except Exception as e:
+        await db.rollback()
+        raise e
+    await publish_nomina_event(nomina_id, "nomina_restored", users=len(users), products=len(products))
+    await invalidate_reads("nominas")
+
+# Clonar una nómina (usuarios y productos) dentro de MySQL, sin pasar filas por la aplicación
+async def clone_nomina(nomina_id: int, name: Optional[str] = None, reset_signatures: bool = True,
+                       reset_comments: bool = True) -> Optional[Dict]:
+    """
+    Crea una nómina nueva del mismo cliente y copia sus usuarios y productos con
+    INSERT ... SELECT. reset_signatures deja sin firma (ni fecha ni empleado que la tomó)
+    a los usuarios copiados; reset_comments borra los comentarios. Devuelve conteos y
+    tiempos, o None si la nómina no existe. Una nómina archivada no se puede clonar.
+    """
+    start = time.perf_counter()
+    try:
+        await db.begin_transaction()
+        # FOR SHARE: la nómina de origen no se archiva ni elimina durante la copia
+        nominas, _ = await db.execute(
+            'SELECT idNomina, name, client_idClient, archived_at FROM nomina WHERE idNomina = %s FOR SHARE',
+            (nomina_id,))
+        if not nominas:
+            await db.rollback()
+            return None
+        source = nominas[0]
+        if source['archived_at'] is not None:
+            raise ValueError(f"La nómina {nomina_id} está archivada; restáurela antes de clonarla")
+        client_id = source['client_idClient']
+
+        _, new_id = await db.execute(
+            'INSERT INTO nomina (name, client_idClient) VALUES (%s, %s)',
+            (name or f"{source['name']} (copia)", client_id))
+
+        q_users = f"""
+        INSERT INTO app_user
+        (rut, name, lastName, sex, area, service, center, signature, comment, employee, signatureDate,
+         nomina_idNomina, nomina_idClient)
+        SELECT rut, name, lastName, sex, area, service, center,
+            {'NULL' if reset_signatures else 'signature'},
+            {'NULL' if reset_comments else 'comment'},
+            {'NULL' if reset_signatures else 'employee'},
+            {'NULL' if reset_signatures else 'signatureDate'},
+            %s, %s
+        FROM app_user
+        WHERE nomina_idNomina = %s
+        ORDER BY idUser
+        """
+        await db.execute(q_users, (new_id, client_id, nomina_id))
+
+        # Un INSERT ... SELECT asigna ids crecientes en el orden del SELECT: el k-ésimo
+        # usuario con un RUT en la copia corresponde al k-ésimo con ese RUT en el origen
+        q_products = """
+        INSERT INTO product
+        (sku, name, color, quantity, size, user_idUser, user_nomina_idNomina, user_nomina_idClient)
+        SELECT p.sku, p.name, p.color, p.quantity, p.size, n.idUser, %s, %s
+        FROM product p
+        JOIN (
+            SELECT idUser, rut, ROW_NUMBER() OVER (PARTITION BY rut ORDER BY idUser) AS k
+            FROM app_user WHERE nomina_idNomina = %s
+        ) o ON o.idUser = p.user_idUser
+        JOIN (
+            SELECT idUser, rut, ROW_NUMBER() OVER (PARTITION BY rut ORDER BY idUser) AS k
+            FROM app_user WHERE nomina_idNomina = %s
+        ) n ON n.rut <=> o.rut AND n.k = o.k
+        WHERE p.user_nomina_idNomina = %s
+        ORDER BY p.idProduct
+        """
+        await db.execute(q_products, (new_id, client_id, nomina_id, new_id, nomina_id))
+        counts, _ = await db.execute(
+            'SELECT (SELECT COUNT(*) FROM app_user WHERE nomina_idNomina = %s) AS users, '
+            '(SELECT COUNT(*) FROM product WHERE user_nomina_idNomina = %s) AS products',
+            (new_id, new_id))
+
+        q_log = """
+        INSERT INTO nomina_change (nomina_id, entity, entity_id, op)
+        SELECT nomina_idNomina, 'user', idUser, 'upsert' FROM app_user WHERE nomina_idNomina = %s
+        """
+        await db.execute(q_log, (new_id,))
+        q_log = """
+        INSERT INTO nomina_change (nomina_id, entity, entity_id, op)
+        SELECT user_nomina_idNomina, 'product', idProduct, 'upsert' FROM product WHERE user_nomina_idNomina = %s
+        """
+        await db.execute(q_log, (new_id,))
+        await db.commit()
+    except Exception as e:
+        await db.rollback()
+        raise e
+    await invalidate_reads("nominas")
+    await publish_nomina_event(new_id, "nomina_cloned", source=nomina_id)
+    return {
+        "idNomina": new_id,
+        "source": nomina_id,
+        "users": counts[0]['users'],
+        "products": counts[0]['products'],
+        "reset_signatures": reset_signatures,
+        "reset_comments": reset_comments,
+        "elapsed_ms": round((time.perf_counter() - start) * 1000, 1),
+    }
+
+# Política ante RUTs repetidos al mover usuarios: fail = no se mueve nada,
+# skip = los repetidos se quedan en su nómina, replace = se eliminan los del destino
+MOVE_CONFLICT_POLICIES = ("fail", "skip", "replace")
+
+class MoveConflictError(ValueError):
+    """El movimiento choca con RUTs del destino (política fail); conflicts trae el detalle."""
+
+    def __init__(self, conflicts: List[Dict]):
+        super().__init__(f"{len(conflicts)} usuarios tienen un RUT que ya existe en la nómina destino")
+        self.conflicts = conflicts
+
+async def _move_users(target_nomina_id: int, user_filter: str, filter_params: tuple,
+                      source_nomina_ids: List[int], on_conflict: str) -> Dict:
+    """
+    Mueve los usuarios que cumplen user_filter (y sus productos) a la nómina destino en
+    una sola transacción. Las nóminas se bloquean en orden de id para no cruzarse con
+    otro movimiento en sentido contrario.
+    """
+    if on_conflict not in MOVE_CONFLICT_POLICIES:
+        raise ValueError(f"on_conflict debe ser uno de: {', '.join(MOVE_CONFLICT_POLICIES)}")
+    try:
+        await db.begin_transaction()
+        nomina_ids = sorted(set(source_nomina_ids) | {target_nomina_id})
+        nominas, _ = await db.execute(
+            f"SELECT idNomina, client_idClient, archived_at FROM nomina WHERE idNomina IN ({', '.join(['%s'] * len(nomina_ids))}) "
+            "ORDER BY idNomina FOR UPDATE",
+            tuple(nomina_ids))
+        by_id = {n['idNomina']: n for n in nominas}
+        target = by_id.get(target_nomina_id)
+        if target is None:
+            raise ValueError(f"La nómina destino {target_nomina_id} no existe")
+        missing = [i for i in source_nomina_ids if i not in by_id]
+        if missing:
+            raise ValueError(f"La nómina de origen {missing[0]} no existe")
+        archived = [n['idNomina'] for n in nominas if n['archived_at'] is not None]
+        if archived:
+            raise ValueError(f"Nóminas archivadas no se pueden modificar: {archived}")
+        client_id = target['client_idClient']
+
+        users, _ = await db.execute(
+            f"SELECT idUser, rut, nomina_idNomina FROM app_user WHERE {user_filter} ORDER BY idUser FOR UPDATE",
+            filter_params)
+        already = [u['idUser'] for u in users if u['nomina_idNomina'] == target_nomina_id]
+        candidates = [u for u in users if u['nomina_idNomina'] != target_nomina_id]
+
+        # Los RUT se comparan en forma canónica (12.345.678-5 y 12345678-5 son el mismo);
+        # en el destino se busca lo guardado tal cual, su forma canónica y con puntos
+        def canonical(rut):
+            return normalize_rut(rut) or rut
+
+        existing: Dict[str, List[int]] = {}
+        ruts = set()
+        for u in candidates:
+            if u['rut']:
+                ruts.update(_rut_lookup_forms(u['rut']))
+        for chunk in _chunked_list(sorted(ruts), 1000):
+            rows, _ = await db.execute(
+                f"SELECT idUser, rut FROM app_user WHERE nomina_idNomina = %s AND rut IN ({', '.join(['%s'] * len(chunk))}) FOR UPDATE",
+                (target_nomina_id, *chunk))
+            for r in rows:
+                ids = existing.setdefault(canonical(r['rut']), [])
+                if r['idUser'] not in ids:
+                    ids.append(r['idUser'])
+
+        # RUTs repetidos que llegan de nóminas distintas chocarían en el destino: se mueve
+        # el primero (nunca se reemplazan entre sí). Si ya convivían en el mismo origen, se mueven todos
+        conflicts, moving, replaced, taken = [], [], [], {}
+        for u in candidates:
+            key = canonical(u['rut']) if u['rut'] else None
+            if key and taken.get(key, u['nomina_idNomina']) != u['nomina_idNomina']:
+                conflicts.append({"idUser": u['idUser'], "rut": u['rut'], "conflict": "duplicado en el lote"})
+                continue
+            if key in existing:
+                if on_conflict == "replace":
+                    if key not in taken:
+                        replaced.extend(existing[key])
+                else:
+                    conflicts.append({"idUser": u['idUser'], "rut": u['rut'], "conflict_with": existing[key][0]})
+                    continue
+            if key:
+                taken[key] = u['nomina_idNomina']
+            moving.append(u['idUser'])
+        if conflicts and on_conflict == "fail":
+            raise MoveConflictError(conflicts)
+
+        for chunk in _chunked_list(replaced, 1000):
+            marks = ', '.join(['%s'] * len(chunk))
+            await db.execute(f"""
+            INSERT INTO nomina_change (nomina_id, entity, entity_id, op)
+            SELECT user_nomina_idNomina, 'product', idProduct, 'delete' FROM product WHERE user_idUser IN ({marks})
+            """, tuple(chunk))
+            await db.execute(f'DELETE FROM product WHERE user_idUser IN ({marks})', tuple(chunk))
+            await db.execute(f'DELETE FROM app_user WHERE idUser IN ({marks})', tuple(chunk))
+            await _log_changes(target_nomina_id, 'user', chunk, 'delete')
+
+        for chunk in _chunked_list(moving, 1000):
+            marks = ', '.join(['%s'] * len(chunk))
+            params = tuple(chunk)
+            # Para la sincronización el usuario desaparece del origen y aparece en el destino
+            await db.execute(f"""
+            INSERT INTO nomina_change (nomina_id, entity, entity_id, op)
+            SELECT user_nomina_idNomina, 'product', idProduct, 'delete' FROM product WHERE user_idUser IN ({marks})
+            """, params)
+            await db.execute(f"""
+            INSERT INTO nomina_change (nomina_id, entity, entity_id, op)
+            SELECT nomina_idNomina, 'user', idUser, 'delete' FROM app_user WHERE idUser IN ({marks})
+            """, params)
+            await db.execute(
+                f'UPDATE app_user SET nomina_idNomina = %s, nomina_idClient = %s WHERE idUser IN ({marks})',
+                (target_nomina_id, client_id, *params))
+            await db.execute(
+                f'UPDATE product SET user_nomina_idNomina = %s, user_nomina_idClient = %s WHERE user_idUser IN ({marks})',
+                (target_nomina_id, client_id, *params))
+            await _log_changes(target_nomina_id, 'user', chunk, 'upsert')
+            await db.execute(f"""
+            INSERT INTO nomina_change (nomina_id, entity, entity_id, op)
+            SELECT user_nomina_idNomina, 'product', idProduct, 'upsert' FROM product WHERE user_idUser IN ({marks})
+            """, params)
+        await db.commit()
+    except Exception as e:
+        await db.rollback()
+        raise e
+
+    moved = set(moving)
+    sources = sorted({u['nomina_idNomina'] for u in candidates if u['idUser'] in moved})
+    for nomina_id in sources:
+        await publish_nomina_event(nomina_id, "users_moved_out", target=target_nomina_id)
+    if moving or replaced:
+        await publish_nomina_event(target_nomina_id, "users_moved_in", users=len(moving), replaced=len(replaced))
+    return {
+        "target": target_nomina_id,
+        "moved": moving,
+        "replaced": replaced,
+        "skipped": conflicts,
+        "already_in_target": already,
+    }
+
+# Mover una lista de usuarios (con sus productos) a otra nómina
+async def move_users(user_ids: List[int], target_nomina_id: int, on_conflict: str = "fail") -> Dict:
+    ids = sorted(set(user_ids))
+    if not ids:
+        return {"target": target_nomina_id, "moved": [], "replaced": [], "skipped": [], "already_in_target": [], "missing": []}
+    sources: List[int] = []
+    found: set = set()
+    for chunk in _chunked_list(ids, 1000):
+        rows, _ = await db.execute(
+            f"SELECT idUser, nomina_idNomina FROM app_user WHERE idUser IN ({', '.join(['%s'] * len(chunk))})",
+            tuple(chunk), use_primary=True)
+        found.update(r['idUser'] for r in rows)
+        sources.extend(r['nomina_idNomina'] for r in rows)
+    user_filter = f"idUser IN ({', '.join(['%s'] * len(ids))})"
+    result = await _move_users(target_nomina_id, user_filter, tuple(ids), sorted(set(sources)), on_conflict)
+    result["missing"] = [i for i in ids if i not in found]
+    return result
+
+# Fusionar una nómina completa en otra
+async def merge_nomina(source_nomina_id: int, target_nomina_id: int, on_conflict: str = "fail") -> Dict:
+    if source_nomina_id == target_nomina_id:
+        raise ValueError("La nómina de origen y la de destino son la misma")
+    result = await _move_users(target_nomina_id, "nomina_idNomina = %s", (source_nomina_id,),
+                               [source_nomina_id], on_conflict)
+    result["source"] = source_nomina_id
+    return result
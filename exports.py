@@ -0,0 +1,303 @@
+import os
+import csv
+import tempfile
+import json
+import asyncio
+import logging
+import zipfile
+from datetime import date, datetime
+from typing import Any, Dict, List, Optional, Tuple
+from xml.sax.saxutils import escape
+
+from metrics import registry
+from invalidation import channel
+from push import TOPIC as NOMINA_EVENT_TOPIC
+from db import export_excel_query, get_nomina_version
+import archive
+
+# Snapshots de exportación por versión de nómina.
+# La versión es el último id de nomina_change de la nómina: mientras no cambie, las
+# descargas se sirven como archivos estáticos (con soporte de Range) desde EXPORT_DIR.
+# Un worker en segundo plano genera JSON, CSV y XLSX con una sola consulta; los eventos
+# de nómina borran sus snapshots y el directorio se mantiene bajo EXPORT_CACHE_MAX_BYTES
+# eliminando los menos usados.
+
+EXPORT_DIR = os.getenv("EXPORT_DIR", "exports")
+EXPORT_CACHE_MAX_BYTES = int(os.getenv("EXPORT_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+EXPORT_WORKERS = int(os.getenv("EXPORT_WORKERS", "1"))
+
+FORMATS = {
+    "json": "application/json",
+    "csv": "text/csv; charset=utf-8",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+}
+
+# Columnas en el orden de export_excel_query
+COLUMNS = [
+    "rut", "username", "lastName", "area", "signature", "employee", "signatureDate", "sex",
+    "center", "service", "sku", "productName", "color", "quantity", "size",
+]
+
+SNAPSHOT_REQUESTS = registry.counter(
+    "export_snapshot_requests_total", "Descargas de exportación (hit = servida desde disco)", ("format", "outcome"))
+SNAPSHOT_GENERATIONS = registry.counter(
+    "export_snapshot_generations_total", "Snapshots generados (los tres formatos)")
+SNAPSHOT_EVICTIONS = registry.counter(
+    "export_snapshot_evictions_total", "Archivos eliminados por tamaño o por cambios en la nómina", ("reason",))
+SNAPSHOT_BYTES = registry.gauge(
+    "export_snapshot_bytes", "Tamaño del directorio de snapshots")
+
+logger = logging.getLogger("exports")
+
+
+def _path(nomina_id: int, version: str, fmt: str) -> str:
+    return os.path.join(EXPORT_DIR, f"nomina-{int(nomina_id)}-v{version}.{fmt}")
+
+
+def _json_default(value: Any) -> Any:
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return str(value)
+
+
+def _write_json(path: str, rows: List[Dict]) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(rows, f, ensure_ascii=False, separators=(",", ":"), default=_json_default)
+
+
+def _write_csv(path: str, rows: List[Dict]) -> None:
+    # BOM para que Excel reconozca UTF-8 al abrir el CSV
+    with open(path, "w", encoding="utf-8-sig", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(COLUMNS)
+        for row in rows:
+            writer.writerow([_csv_value(row.get(c)) for c in COLUMNS])
+
+
+def _csv_value(value: Any) -> Any:
+    if value is None:
+        return ""
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+def _cell_ref(col: int, row: int) -> str:
+    letters = ""
+    col += 1
+    while col:
+        col, rem = divmod(col - 1, 26)
+        letters = chr(65 + rem) + letters
+    return f"{letters}{row}"
+
+
+def _xml_text(value: str) -> str:
+    # XML 1.0 no admite caracteres de control
+    return escape("".join(ch for ch in value if ch in "\t\n\r" or ord(ch) >= 32))
+
+
+def _write_xlsx(path: str, rows: List[Dict]) -> None:
+    """XLSX mínimo (una hoja, strings inline). Excel no admite celdas de más de 32767
+    caracteres, así que la firma se exporta como Sí/No."""
+    columns = ["signed" if c == "signature" else c for c in COLUMNS]
+
+    def cells(values, r):
+        out = []
+        for c, value in enumerate(values):
+            ref = _cell_ref(c, r)
+            if value is None or value == "":
+                continue
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                out.append(f'<c r="{ref}"><v>{value}</v></c>')
+            else:
+                text = value.strftime("%Y-%m-%d %H:%M:%S") if isinstance(value, datetime) else str(value)
+                out.append(f'<c r="{ref}" t="inlineStr"><is><t xml:space="preserve">{_xml_text(text)}</t></is></c>')
+        return f'<row r="{r}">{"".join(out)}</row>'
+
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr("[Content_Types].xml", (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+            '</Types>'))
+        z.writestr("_rels/.rels", (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+            '</Relationships>'))
+        z.writestr("xl/workbook.xml", (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+            '<sheets><sheet name="Nomina" sheetId="1" r:id="rId1"/></sheets></workbook>'))
+        z.writestr("xl/_rels/workbook.xml.rels", (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+            '</Relationships>'))
+        with z.open("xl/worksheets/sheet1.xml", "w") as sheet:
+            sheet.write(('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                         '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+                         + cells(columns, 1)).encode("utf-8"))
+            for r, row in enumerate(rows, start=2):
+                values = [("Sí" if row.get("signature") else "No") if c == "signed" else row.get(c) for c in columns]
+                sheet.write(cells(values, r).encode("utf-8"))
+            sheet.write(b"</sheetData></worksheet>")
+
+
+_WRITERS = {"json": _write_json, "csv": _write_csv, "xlsx": _write_xlsx}
+
+
+def _write_snapshot(nomina_id: int, version: str, rows: List[Dict]) -> None:
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    for fmt, writer in _WRITERS.items():
+        path = _path(nomina_id, version, fmt)
+        tmp = f"{path}.tmp-{os.getpid()}"
+        writer(tmp, rows)
+        os.replace(tmp, path)
+
+
+def _remove_nomina(nomina_id: int, keep: Optional[str] = None) -> None:
+    """Borra los snapshots de la nómina (salvo la versión `keep`)."""
+    prefix = f"nomina-{int(nomina_id)}-v"
+    try:
+        names = os.listdir(EXPORT_DIR)
+    except FileNotFoundError:
+        return
+    for name in names:
+        if name.startswith(prefix) and ".tmp-" not in name and (keep is None or not name.startswith(f"{prefix}{keep}.")):
+            try:
+                os.remove(os.path.join(EXPORT_DIR, name))
+                SNAPSHOT_EVICTIONS.inc("changed")
+            except FileNotFoundError:
+                pass
+
+
+def _enforce_size_limit() -> None:
+    """Elimina los snapshots menos usados (mtime se actualiza en cada descarga)."""
+    try:
+        entries = [e for e in os.scandir(EXPORT_DIR) if e.is_file() and ".tmp-" not in e.name]
+    except FileNotFoundError:
+        return
+    stats = sorted(((e.stat().st_mtime, e.stat().st_size, e.path) for e in entries))
+    total = sum(size for _, size, _ in stats)
+    for _, size, path in stats:
+        if total <= EXPORT_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+            total -= size
+            SNAPSHOT_EVICTIONS.inc("size")
+        except FileNotFoundError:
+            pass
+    SNAPSHOT_BYTES.set(value=total)
+
+
+class SnapshotWorker:
+    """Cola de generación: una sola generación por (nómina, versión) aunque la pidan muchos."""
+
+    def __init__(self, workers: int = EXPORT_WORKERS):
+        self.workers = workers
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._pending: Dict[Tuple[int, str], asyncio.Future] = {}
+        # Cambios vistos por nómina: un snapshot que empezó antes de un cambio se descarta
+        self._generation: Dict[int, int] = {}
+
+    def invalidate(self, nomina_id: int) -> None:
+        self._generation[nomina_id] = self._generation.get(nomina_id, 0) + 1
+        _remove_nomina(nomina_id)
+
+    def request(self, nomina_id: int, version: str) -> asyncio.Future:
+        key = (nomina_id, version)
+        future = self._pending.get(key)
+        if future is None:
+            if self._queue is None:
+                self._queue = asyncio.Queue()
+                self._tasks = [asyncio.get_running_loop().create_task(self._run()) for _ in range(self.workers)]
+            future = asyncio.get_running_loop().create_future()
+            self._pending[key] = future
+            self._queue.put_nowait(key)
+        return future
+
+    async def _run(self) -> None:
+        while True:
+            nomina_id, version = key = await self._queue.get()
+            future = self._pending[key]
+            try:
+                generation = self._generation.get(nomina_id, 0)
+                if version.startswith("a"):
+                    rows = await archive.export_rows(nomina_id)
+                else:
+                    # Del primario, como la versión: filas de una réplica atrasada quedarían
+                    # guardadas bajo una versión posterior a ellas
+                    rows = await export_excel_query(nomina_id, use_primary=True)
+                await asyncio.to_thread(_write_snapshot, nomina_id, version, rows)
+                if self._generation.get(nomina_id, 0) != generation:
+                    # La nómina cambió mientras se generaba: no se deja en disco
+                    await asyncio.to_thread(_remove_nomina, nomina_id)
+                else:
+                    await asyncio.to_thread(_remove_nomina, nomina_id, version)
+                await asyncio.to_thread(_enforce_size_limit)
+                SNAPSHOT_GENERATIONS.inc()
+                if not future.done():
+                    future.set_result(rows)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("No se pudo generar el snapshot de la nómina %s: %s", nomina_id, e)
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                self._pending.pop(key, None)
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks, self._queue = [], None
+
+
+worker = SnapshotWorker()
+channel.subscribe(NOMINA_EVENT_TOPIC, lambda key, payload: worker.invalidate(int(key)))
+
+
+async def current_version(nomina_id: int) -> str:
+    """Versión de la nómina: último cambio registrado, o el checksum si está archivada."""
+    if archive.is_archived(nomina_id):
+        return "a" + archive.index.get(nomina_id)["files"]["users.csv.gz"][:16]
+    return str(await get_nomina_version(nomina_id))
+
+
+async def snapshot(nomina_id: int, fmt: str) -> Tuple[str, Optional[List[Dict]]]:
+    """
+    Devuelve (ruta, filas). Si el snapshot vigente existe, filas es None y solo hay que
+    servir el archivo; si no, se espera al worker (la generación sigue aunque el request
+    se cancele) y se devuelven también las filas por si el archivo ya no estuviera.
+    """
+    version = await current_version(nomina_id)
+    path = _path(nomina_id, version, fmt)
+    try:
+        os.utime(path)
+        SNAPSHOT_REQUESTS.inc(fmt, "hit")
+        return path, None
+    except FileNotFoundError:
+        pass
+    SNAPSHOT_REQUESTS.inc(fmt, "miss")
+    rows = await asyncio.shield(worker.request(nomina_id, version))
+    return path, rows
+
+
+def render_temp(fmt: str, rows: List[Dict]) -> str:
+    """Escribe las filas en un archivo temporal (cuando el snapshot ya no está en disco)."""
+    fd, path = tempfile.mkstemp(suffix=f".{fmt}")
+    os.close(fd)
+    _WRITERS[fmt](path, rows)
+    return path
@@ -0,0 +1,69 @@
+import os
+import multiprocessing
+
+# Servidor de producción: gunicorn pre-fork con workers uvicorn.
+#   gunicorn -c gunicorn.conf.py main:app
+# Recarga sin cortar requests: kill -HUP <pid del master> (los workers viejos terminan
+# lo que están atendiendo, hasta graceful_timeout, mientras los nuevos ya reciben tráfico).
+
+bind = f"0.0.0.0:{os.getenv('PORT', '3000')}"
+worker_class = "uvicorn_worker.UvicornWorker"
+
+# Un worker por núcleo salvo que WEB_CONCURRENCY diga otra cosa
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = 5
+
+# Reciclar workers de a poco para acotar crecimiento de memoria
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", "5000"))
+max_requests_jitter = max_requests // 10
+
+accesslog = "-"
+
+
+def _max_connections() -> int:
+    """max_connections de MySQL: DB_MAX_CONNECTIONS o consultado al servidor."""
+    if os.getenv("DB_MAX_CONNECTIONS"):
+        return int(os.getenv("DB_MAX_CONNECTIONS"))
+    try:
+        import mysql.connector
+        from dotenv import load_dotenv
+
+        load_dotenv()
+        connection = mysql.connector.connect(
+            host=os.getenv("DB_HOST"),
+            port=int(os.getenv("DB_PORT", "3306")),
+            user=os.getenv("DB_USER"),
+            password=os.getenv("DB_PASSWORD"),
+            database=os.getenv("DB_NAME"),
+            connection_timeout=5,
+        )
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT @@max_connections")
+            return int(cursor.fetchone()[0])
+        finally:
+            connection.close()
+    except Exception:
+        # Valor por defecto de MySQL
+        return 151
+
+
+def on_starting(server):
+    # El master fija el tamaño del pool antes del fork; los workers lo heredan por entorno.
+    # pool se importa aquí: el archivo de configuración se carga antes de este hook
+    from pool import per_worker_pool_size
+
+    if not os.getenv("DB_POOL_SIZE"):
+        size = per_worker_pool_size(
+            _max_connections(),
+            server.cfg.workers,
+            instances=int(os.getenv("WEB_INSTANCES", "1")),
+            share=float(os.getenv("DB_CONNECTION_SHARE", "0.8")),
+            reserved=int(os.getenv("DB_RESERVED_CONNECTIONS", "5")),
+            cap=int(os.getenv("DB_POOL_MAX", "20")),
+        )
+        os.environ["DB_POOL_SIZE"] = str(size)
+    server.log.info("Workers: %s, DB_POOL_SIZE por worker: %s", server.cfg.workers, os.environ["DB_POOL_SIZE"])
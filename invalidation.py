@@ -0,0 +1,149 @@
+import os
+import json
+import socket
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional
+
+from metrics import registry
+
+# Canal de invalidación compartido entre workers.
+# publish() avisa de inmediato a los suscriptores del proceso y deja una fila en la
+# tabla cache_invalidation; cada worker la consulta cada INVALIDATION_POLL_SECONDS
+# y reenvía a sus suscriptores los mensajes publicados por otros procesos.
+
+# mysql = compartido entre workers/dynos; local = solo dentro del proceso
+INVALIDATION_BACKEND = os.getenv("INVALIDATION_BACKEND", "mysql")
+INVALIDATION_POLL_SECONDS = float(os.getenv("INVALIDATION_POLL_SECONDS", "1"))
+INVALIDATION_RETENTION_MINUTES = int(os.getenv("INVALIDATION_RETENTION_MINUTES", "60"))
+
+# Los autoincrementales pueden confirmarse fuera de orden: se relee esta ventana hacia atrás
+_LOOKBACK_IDS = 200
+_CLEANUP_EVERY = 300
+
+PUBLISHED = registry.counter(
+    "invalidation_published_total", "Mensajes publicados por este proceso", ("topic",))
+RECEIVED = registry.counter(
+    "invalidation_received_total", "Mensajes recibidos de otros procesos", ("topic",))
+POLL_ERRORS = registry.counter(
+    "invalidation_poll_errors_total", "Errores consultando el canal")
+
+logger = logging.getLogger("invalidation")
+
+Subscriber = Callable[[str, Optional[Dict[str, Any]]], None]
+
+
+class InvalidationChannel:
+    def __init__(self):
+        self.origin = None
+        self._db = None
+        self._subscribers: Dict[str, List[Subscriber]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._last_id: Optional[int] = None
+        self._seen = deque(maxlen=_LOOKBACK_IDS + 2000)
+        self._seen_set = set()
+
+    def subscribe(self, topic: str, callback: Subscriber) -> None:
+        """Registra callback(key, payload); se invoca en el event loop."""
+        self._subscribers.setdefault(topic, []).append(callback)
+
+    def _dispatch(self, topic: str, key: str, payload: Optional[Dict[str, Any]]) -> None:
+        for callback in self._subscribers.get(topic, ()):
+            try:
+                callback(key, payload)
+            except Exception:
+                logger.exception("Suscriptor de %s falló", topic)
+
+    async def publish(self, topic: str, key: Any, payload: Optional[Dict[str, Any]] = None) -> None:
+        """
+        Publica un mensaje. Si hay una transacción abierta la fila viaja en ella, así los
+        demás workers solo la ven si la escritura se confirma.
+        """
+        key = str(key)
+        PUBLISHED.inc(topic)
+        self._dispatch(topic, key, payload)
+        if self._db is None or INVALIDATION_BACKEND != "mysql":
+            return
+        try:
+            await self._db.execute(
+                "INSERT INTO cache_invalidation (topic, item_key, payload, origin) VALUES (%s, %s, %s, %s)",
+                (topic, key, json.dumps(payload, default=str) if payload is not None else None, self.origin),
+            )
+        except Exception as e:
+            # Un fallo del canal no debe romper la escritura que lo originó
+            logger.warning("No se pudo publicar invalidación %s/%s: %s", topic, key, e)
+
+    def start(self, database) -> None:
+        """Comienza a escuchar (se llama en el lifespan de cada worker, después del fork)."""
+        self._db = database
+        self.origin = f"{socket.gethostname()}:{os.getpid()}"
+        if INVALIDATION_BACKEND == "mysql" and self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._poll())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _mark_seen(self, row_id: int) -> bool:
+        if row_id in self._seen_set:
+            return False
+        if len(self._seen) == self._seen.maxlen:
+            self._seen_set.discard(self._seen[0])
+        self._seen.append(row_id)
+        self._seen_set.add(row_id)
+        return True
+
+    async def _poll(self) -> None:
+        delay = INVALIDATION_POLL_SECONDS
+        polls = 0
+        while True:
+            try:
+                await asyncio.sleep(delay)
+                if self._last_id is None:
+                    # Al arrancar se ignora lo publicado antes
+                    rows, _ = await self._db.execute(
+                        "SELECT COALESCE(MAX(id), 0) AS last_id FROM cache_invalidation", use_primary=True)
+                    self._last_id = rows[0]["last_id"] or 0
+                    for row_id in range(max(self._last_id - _LOOKBACK_IDS, 0) + 1, self._last_id + 1):
+                        self._mark_seen(row_id)
+                rows, _ = await self._db.execute(
+                    """
+                    SELECT id, topic, item_key, payload, origin
+                    FROM cache_invalidation
+                    WHERE id > %s
+                    ORDER BY id
+                    LIMIT 1000
+                    """,
+                    (max(self._last_id - _LOOKBACK_IDS, 0),),
+                    use_primary=True,
+                )
+                for row in rows:
+                    self._last_id = max(self._last_id, row["id"])
+                    if not self._mark_seen(row["id"]) or row["origin"] == self.origin:
+                        continue
+                    RECEIVED.inc(row["topic"])
+                    payload = json.loads(row["payload"]) if row["payload"] else None
+                    self._dispatch(row["topic"], row["item_key"], payload)
+                polls += 1
+                if polls % _CLEANUP_EVERY == 0:
+                    await self._db.execute(
+                        "DELETE FROM cache_invalidation WHERE created_at < NOW() - INTERVAL %s MINUTE LIMIT 5000",
+                        (INVALIDATION_RETENTION_MINUTES,),
+                    )
+                delay = INVALIDATION_POLL_SECONDS
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                POLL_ERRORS.inc()
+                delay = min(delay * 2, 30)
+                logger.warning("Error consultando el canal de invalidación: %s", e)
+
+
+# Canal global del proceso
+channel = InvalidationChannel()
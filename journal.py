@@ -0,0 +1,358 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+from itertools import islice
+from typing import Any, Dict, List, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: un solo proceso por directorio
+    fcntl = None
+
+from mysql.connector import Error
+
+from metrics import registry
+from breaker import is_unavailable
+from invalidation import channel
+
+# Write-behind de firmas y comentarios (PUT /user/{id}/comment con SIGNATURE_WRITE_BEHIND=1).
+# El envío se agrega a un journal local (una línea JSON por entrada, con fsync antes de
+# responder) y un applier en segundo plano lo lleva a app_user en lotes con
+# apply_signature_batch, que guarda el último seq aplicado en la misma transacción.
+# Al arrancar se reprocesa lo que quedó en el journal; las entradas que ya estaban
+# confirmadas en la base se omiten por ese seq, así una caída no duplica firmas.
+# Mientras una entrada está pendiente las lecturas de usuarios la superponen (overlay) y
+# se anuncia a los demás workers por el canal de invalidación (sin la imagen de la firma:
+# en esos workers se ve el comentario y la fecha, y la imagen al aplicarse).
+# Cada proceso toma con flock un archivo libre de SIGNATURE_JOURNAL_DIR (signatures-N.log),
+# y el de un proceso caído lo retoma el siguiente que arranque. Igual que ARCHIVE_DIR,
+# el directorio debe estar en un volumen persistente.
+
+SIGNATURE_WRITE_BEHIND = os.getenv("SIGNATURE_WRITE_BEHIND", "0") == "1"
+SIGNATURE_JOURNAL_DIR = os.getenv("SIGNATURE_JOURNAL_DIR", "journal")
+SIGNATURE_JOURNAL_BATCH = int(os.getenv("SIGNATURE_JOURNAL_BATCH", "200"))
+# Espera tras la primera entrada para juntar un lote
+SIGNATURE_JOURNAL_FLUSH_MS = float(os.getenv("SIGNATURE_JOURNAL_FLUSH_MS", "20"))
+# Con todo aplicado, el journal se trunca al pasar este tamaño
+SIGNATURE_JOURNAL_COMPACT_BYTES = int(os.getenv("SIGNATURE_JOURNAL_COMPACT_BYTES", str(4 * 1024 * 1024)))
+SIGNATURE_JOURNAL_SLOTS = 64
+# Entradas anunciadas por otros workers que nunca se confirmaron (worker caído)
+_REMOTE_TTL_SECONDS = 300
+
+# Errores de datos: la entrada nunca se podrá aplicar y se descarta
+_DATA_ERRNOS = {
+    1048,  # ER_BAD_NULL_ERROR
+    1292,  # ER_TRUNCATED_WRONG_VALUE
+    1366,  # ER_TRUNCATED_WRONG_VALUE_FOR_FIELD
+    1406,  # ER_DATA_TOO_LONG
+}
+
+PENDING_TOPIC = "signature_pending"
+APPLIED_TOPIC = "signature_applied"
+
+JOURNAL_APPENDS = registry.counter(
+    "signature_journal_appends_total", "Entradas agregadas al journal de firmas")
+JOURNAL_ENTRIES = registry.counter(
+    "signature_journal_entries_total", "Entradas del journal procesadas por el applier", ("outcome",))
+JOURNAL_PENDING = registry.gauge(
+    "signature_journal_pending", "Entradas del journal aún no aplicadas en la base")
+JOURNAL_FSYNC_SECONDS = registry.histogram(
+    "signature_journal_fsync_seconds", "Duración del fsync del journal",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25))
+JOURNAL_LAG_SECONDS = registry.histogram(
+    "signature_journal_lag_seconds", "Tiempo entre el envío y su aplicación en la base",
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+
+logger = logging.getLogger("journal")
+
+
+class PendingOverlay:
+    """Último envío pendiente por usuario (de este worker o anunciado por otro)."""
+
+    def __init__(self):
+        self._entries: Dict[int, Dict] = {}
+        self._lock = threading.Lock()
+
+    def put(self, record: Dict) -> None:
+        with self._lock:
+            current = self._entries.get(record["idUser"])
+            if current is None or current["ts"] <= record["ts"]:
+                self._entries[record["idUser"]] = record
+
+    def drop(self, id_user: int, journal: str, seq: int) -> None:
+        with self._lock:
+            current = self._entries.get(id_user)
+            if current is not None and current["journal"] == journal and current["seq"] <= seq:
+                del self._entries[id_user]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def apply(self, users: List[Dict]) -> List[Dict]:
+        """Copias de los usuarios con los valores pendientes (misma semántica que el UPDATE)."""
+        if not self._entries:
+            return users
+        now = time.time()
+        result = []
+        for user in users:
+            record = self._entries.get(user.get("idUser"))
+            if record is None or (record.get("remote") and now - record["ts"] > _REMOTE_TTL_SECONDS):
+                result.append(user)
+                continue
+            merged = {**user, "comment": record["comment"], "employee": record["performedBy"]}
+            if record["signature"] or record.get("signed"):
+                if record["signature"]:
+                    merged["signature"] = record["signature"]
+                merged["signatureDate"] = record["signatureDate"]
+            result.append(merged)
+        return result
+
+    def apply_one(self, user: Optional[Dict]) -> Optional[Dict]:
+        return self.apply([user])[0] if user else user
+
+
+pending = PendingOverlay()
+
+
+class SignatureJournal:
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.name: Optional[str] = None
+        self._file = None
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._seq = 0
+        self._written = 0
+        self._synced = 0
+        # seq -> entrada, en orden de seq (se insertan bajo _lock)
+        self._pending: Dict[int, Dict] = {}
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._background = set()
+
+    def _open(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        for slot in range(SIGNATURE_JOURNAL_SLOTS):
+            path = os.path.join(self.directory, f"signatures-{slot}.log")
+            f = open(path, "a+b")
+            if fcntl is not None:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    f.close()
+                    continue
+            self._file, self.name = f, f"signatures-{slot}"
+            return
+        raise RuntimeError(f"No hay journals libres en {self.directory}")
+
+    def _replay(self) -> None:
+        f = self._file
+        f.seek(0)
+        offset = 0
+        for line in f:
+            try:
+                if not line.endswith(b"\n"):
+                    raise ValueError("línea incompleta")
+                entry = json.loads(line)
+            except ValueError:
+                # Escritura cortada por la caída: se descarta desde aquí
+                logger.warning("Journal %s: entrada incompleta en el byte %s, se trunca", self.name, offset)
+                f.truncate(offset)
+                break
+            offset += len(line)
+            if "applied" in entry:
+                for seq in [s for s in self._pending if s <= entry["applied"]]:
+                    del self._pending[seq]
+                self._seq = max(self._seq, entry["applied"])
+            elif "dropped" in entry:
+                self._pending.pop(entry["dropped"], None)
+            else:
+                self._pending[entry["seq"]] = {**entry, "journal": self.name}
+                self._seq = max(self._seq, entry["seq"])
+        f.seek(0, os.SEEK_END)
+        for entry in self._pending.values():
+            pending.put(entry)
+
+    async def start(self) -> None:
+        await asyncio.to_thread(self._open)
+        await asyncio.to_thread(self._replay)
+        JOURNAL_PENDING.set(value=len(self._pending))
+        if self._pending:
+            logger.warning("Journal %s: %s entradas pendientes a reprocesar", self.name, len(self._pending))
+        self._wake = asyncio.Event()
+        if self._pending:
+            self._wake.set()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self, timeout: float = 5) -> None:
+        if self._task is None:
+            return
+        # Se intenta vaciar; lo que no alcance queda en el journal para el próximo arranque
+        deadline = time.monotonic() + timeout
+        while self._pending and time.monotonic() < deadline:
+            self._wake.set()
+            await asyncio.sleep(0.05)
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        self._file.close()
+        self._file = None
+
+    def _write(self, entry: Dict) -> int:
+        # Llamar con _lock tomado
+        self._file.write(json.dumps(entry, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n")
+        self._written += 1
+        return self._written
+
+    def _sync(self, mark: int) -> None:
+        # Group commit: un fsync cubre todas las entradas escritas hasta ese momento
+        with self._sync_lock:
+            if self._synced >= mark:
+                return
+            target = self._written
+            start = time.perf_counter()
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            JOURNAL_FSYNC_SECONDS.observe(time.perf_counter() - start)
+            self._synced = target
+
+    def _append(self, fields: Dict[str, Any]) -> Dict:
+        with self._lock:
+            # Microsegundos: el seq sigue creciendo aunque el journal se trunque o se pierda
+            self._seq = max(self._seq + 1, time.time_ns() // 1000)
+            entry = {"seq": self._seq, "ts": time.time(), **fields}
+            mark = self._write(entry)
+            record = {**entry, "journal": self.name}
+            self._pending[entry["seq"]] = record
+            pending.put(record)
+        self._sync(mark)
+        return record
+
+    async def submit(self, id_user: int, comment: str, signature: Optional[str], performed_by: str,
+                     signatureDate: str) -> Dict:
+        """Agrega el envío al journal (con fsync) y vuelve; el applier lo lleva a la base."""
+        if self._task is None:
+            raise RuntimeError("El journal de firmas no está iniciado")
+        record = await asyncio.to_thread(self._append, {
+            "idUser": id_user, "comment": comment, "signature": signature,
+            "performedBy": performed_by, "signatureDate": signatureDate,
+        })
+        JOURNAL_APPENDS.inc()
+        JOURNAL_PENDING.set(value=len(self._pending))
+        self._wake.set()
+        # Sin la imagen: cada worker relee el payload del canal en cada poll, y en un pico
+        # de firmas eso sería cargar la base justo cuando el write-behind debe aliviarla
+        announced = {**record, "signature": None, "signed": bool(signature), "remote": True}
+        self._publish(PENDING_TOPIC, id_user, announced)
+        return record
+
+    def _publish(self, topic: str, key: Any, payload: Dict) -> None:
+        # Sin esperar: el envío ya está confirmado en el journal
+        task = asyncio.get_running_loop().create_task(channel.publish(topic, key, payload))
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    def _batch(self) -> List[Dict]:
+        with self._lock:
+            return list(islice(self._pending.values(), SIGNATURE_JOURNAL_BATCH))
+
+    def _mark(self, batch: List[Dict], marker: str) -> None:
+        with self._lock:
+            for entry in batch:
+                self._pending.pop(entry["seq"], None)
+            # Sin fsync: si se pierde, el seq guardado en la base evita reaplicar
+            if marker == "applied":
+                self._write({"applied": max(e["seq"] for e in batch)})
+            else:
+                for entry in batch:
+                    self._write({"dropped": entry["seq"]})
+            self._file.flush()
+
+    def _compact(self) -> None:
+        with self._lock:
+            if self._pending or self._file.tell() < SIGNATURE_JOURNAL_COMPACT_BYTES:
+                return
+            self._file.truncate(0)
+            self._write({"applied": self._seq})
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def _done(self, batch: List[Dict], marker: str) -> None:
+        now = time.time()
+        for entry in batch:
+            pending.drop(entry["idUser"], self.name, entry["seq"])
+            if marker == "applied":
+                JOURNAL_LAG_SECONDS.observe(now - entry["ts"])
+        JOURNAL_PENDING.set(value=len(self._pending))
+        self._publish(APPLIED_TOPIC, self.name, {"users": {str(e["idUser"]): e["seq"] for e in batch}})
+
+    async def _apply(self, batch: List[Dict]) -> None:
+        from db import apply_signature_batch
+        try:
+            result = await apply_signature_batch(self.name, batch)
+        except Error as e:
+            if e.errno not in _DATA_ERRNOS:
+                raise
+            if len(batch) > 1:
+                # Una entrada inválida no debe frenar el lote: se aplican de a una
+                for entry in batch:
+                    await self._apply([entry])
+                return
+            logger.error("Journal %s: entrada %s de usuario %s descartada: %s",
+                         self.name, batch[0]["seq"], batch[0]["idUser"], e)
+            JOURNAL_ENTRIES.inc("dropped")
+            await asyncio.to_thread(self._mark, batch, "dropped")
+            self._done(batch, "dropped")
+            return
+        for outcome in ("applied", "replayed", "stale", "missing"):
+            if result[outcome]:
+                JOURNAL_ENTRIES.inc(outcome, amount=result[outcome])
+        await asyncio.to_thread(self._mark, batch, "applied")
+        self._done(batch, "applied")
+
+    async def _run(self) -> None:
+        failures = 0
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            await asyncio.sleep(SIGNATURE_JOURNAL_FLUSH_MS / 1000)
+            while True:
+                batch = self._batch()
+                if not batch:
+                    break
+                try:
+                    await self._apply(batch)
+                    failures = 0
+                except Exception as e:
+                    # Base caída u otro error: se reintenta todo el lote más tarde
+                    failures += 1
+                    delay = min(30.0, 0.5 * 2 ** min(failures, 6))
+                    log = logger.warning if is_unavailable(e) else logger.error
+                    log("Journal %s: no se pudieron aplicar %s entradas (reintento en %.1f s): %s",
+                        self.name, len(batch), delay, e)
+                    await asyncio.sleep(delay)
+            await asyncio.to_thread(self._compact)
+
+
+signatures = SignatureJournal(SIGNATURE_JOURNAL_DIR)
+
+
+def _remote_pending(key: str, payload: Optional[Dict]) -> None:
+    if payload and payload.get("journal") != signatures.name:
+        pending.put(payload)
+
+
+def _remote_applied(key: str, payload: Optional[Dict]) -> None:
+    if payload and key != signatures.name:
+        for id_user, seq in payload["users"].items():
+            pending.drop(int(id_user), key, seq)
+
+
+channel.subscribe(PENDING_TOPIC, _remote_pending)
+channel.subscribe(APPLIED_TOPIC, _remote_applied)
@@ -1,16 +1,65 @@
 from fastapi import FastAPI, HTTPException, Request, status, APIRouter, Depends, Security
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse, FileResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
 from typing import Optional, List, Dict, Any, Union
+from datetime import datetime, timedelta
 from fastapi.security.api_key import APIKeyHeader
+from contextlib import asynccontextmanager
 import os
+import asyncio
+import logging
 import uvicorn
 from dotenv import load_dotenv
 
 load_dotenv()
 
+from timing import RouteTimingMiddleware, TimedJSONResponse
+from replication import ReadRoutingMiddleware
+from admission import admit
+from cancellation import DisconnectMiddleware, statement_budget
+from breaker import DegradedModeMiddleware
+import profiling
+
+logger = logging.getLogger("main")
+
+# Cada cuánto (s) se purga el registro de cambios de la sincronización incremental
+CHANGE_LOG_PRUNE_SECONDS = float(os.getenv("CHANGE_LOG_PRUNE_SECONDS", "3600"))
+
+async def prune_change_log_periodically():
+    while True:
+        try:
+            await prune_change_log()
+        except Exception as e:
+            logger.warning("No se pudo purgar el registro de cambios: %s", e)
+        await asyncio.sleep(CHANGE_LOG_PRUNE_SECONDS)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Verificación de planes de consulta al arrancar (CHECK_QUERY_PLANS=1)
+    if os.getenv("CHECK_QUERY_PLANS") == "1":
+        from migrations.plans import check_plans, report
+        try:
+            findings = await check_plans()
+            for line in report([f for f in findings if not f["allowed"]]):
+                logger.warning(line)
+        except Exception as e:
+            logger.error("No se pudo verificar planes de consulta: %s", e)
+    # Canal de invalidación entre workers
+    channel.start(db)
+    pruner = asyncio.create_task(prune_change_log_periodically())
+    # Write-behind de firmas: reprocesa lo pendiente del journal antes de aceptar requests
+    if journal.SIGNATURE_WRITE_BEHIND:
+        await journal.signatures.start()
+    yield
+    pruner.cancel()
+    await journal.signatures.stop()
+    await exports.worker.stop()
+    await channel.stop()
+    db.close()
+
 app = FastAPI(
     docs_url=None,
     redoc_url=None,
@@ -18,6 +67,8 @@ app = FastAPI(
     title="Mike's APIs",
     description="APIs en produccion de Mike's",
     version="1.0.0",
+    default_response_class=TimedJSONResponse,
+    lifespan=lifespan,
 )
 
 # Importamos todas las funciones de db.py
@@ -25,12 +76,25 @@ from db import (
     authenticate, add_client, get_client, get_employee, delete_employee,
     update_employee, add_employee, get_nominas, delete_nomina, get_users,
     get_users_paginated, insert_user, get_products, update_user_comment_signature, delete_user,
-    export_excel_query, insert_nomina, insert_excel_user, insert_product,
+    insert_nomina, insert_excel_user, insert_product,
     update_product_quantity, search_all_users, delete_client, update_client,
     changeNominaName, delete_product, update_product_size, insert_product_return_id,
     get_report_counts, insert_bulk_users_products, get_users_with_products, get_all_products,
-    get_user_by_id_db, search_users_in_nomina,
+    get_user_by_id_db, search_users_in_nomina, get_nomina_changes, prune_change_log,
+    get_products_for_users, get_users_by_ids, clone_nomina, move_users, merge_nomina,
+    get_signature_stats, SIGNATURE_STATS_GRANULARITIES, SIGNATURE_STATS_GROUPS,
+    BulkValidationError, MoveConflictError, MOVE_CONFLICT_POLICIES, db,
 )
+from metrics import registry, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from invalidation import channel
+from push import hub, stream_token, verify_stream_token
+import archive
+import exports
+import batch
+import journal
+
+# Cancela los GET cuyo cliente se desconectó (y su consulta en MySQL)
+app.add_middleware(DisconnectMiddleware)
 
 # Configuración de CORS
 app.add_middleware(
@@ -39,8 +103,18 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],  # Permitir todos los métodos
     allow_headers=["*"],  # Permitir todos los headers
+    expose_headers=["Server-Timing", "X-Data-Stale", "X-Profile-Id", "X-Last-Write"],
 )
 
+# Latencia por ruta con desglose Server-Timing (ROUTE_TIMING_SAMPLE_RATE controla el muestreo)
+app.add_middleware(RouteTimingMiddleware)
+
+# Identidad del cliente para read-your-writes y header X-Read-Primary
+app.add_middleware(ReadRoutingMiddleware)
+
+# Base caída: marca las respuestas obsoletas (X-Data-Stale) y responde 503 al fallar rápido
+app.add_middleware(DegradedModeMiddleware)
+
 # --- Carga de API Keys desde variable de entorno ---
 API_KEY = os.getenv("API_KEY")
 
@@ -53,10 +127,46 @@ async def require_api_key(api_key: str = Security(api_key_header)):
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="No autorizado")
     return api_key
 
+# EventSource no permite headers propios: los streams aceptan también ?token=, un token
+# firmado de corta duración para esa nómina (la API key no debe ir en la URL: queda en
+# los logs de acceso). Se obtiene con GET /nomina/{id}/events/token.
+async def require_stream_auth(nomina_id: int, token: Optional[str] = None, api_key: str = Security(api_key_header)):
+    if api_key or not token:
+        return await require_api_key(api_key)
+    if not API_KEY:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="API no configurada")
+    if not verify_stream_token(API_KEY, nomina_id, token):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Token de stream inválido o vencido")
+
+# Profiler bajo demanda (PROFILING_ENABLED=1): X-Profile: 1 o disparadores de /admin/profile
+if profiling.PROFILING_ENABLED:
+    app.add_middleware(profiling.ProfilingMiddleware,
+                       authorize=lambda key: bool(API_KEY and key and key in API_KEY))
+
+# include=products: anida los productos de todos los usuarios con una sola consulta
+INCLUDE_OPTIONS = {"products"}
+
+def parse_include(include: Optional[str]) -> set:
+    requested = {item.strip() for item in (include or "").split(",") if item.strip()}
+    unknown = requested - INCLUDE_OPTIONS
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"include no soportado: {', '.join(sorted(unknown))}")
+    return requested
+
+async def embed_products(users: List[Dict]) -> List[Dict]:
+    # Copias: las lecturas con @coalesced comparten sus resultados y no se deben modificar
+    products = await get_products_for_users([u["idUser"] for u in users])
+    return [{**user, "products": products.get(user["idUser"], [])} for user in users]
+
 @app.get("/hello")
 async def hello(api_key: str = Depends(require_api_key)):
     return {"message": "Hola desde la API protegida"}
 
+# Métricas en formato Prometheus
+@app.get("/metrics", tags=["Monitoreo"])
+async def metrics(api_key: str = Depends(require_api_key)):
+    return PlainTextResponse(registry.render(), media_type=METRICS_CONTENT_TYPE)
+
 # Rutas estáticas para cuando sea necesario servir archivos estáticos
 if os.path.exists("../public"):
     app.mount("/static", StaticFiles(directory="../public"), name="static")
@@ -87,6 +197,20 @@ class NominaData(BaseModel):
     name: str
     client_idClient: int
 
+class NominaCloneData(BaseModel):
+    name: Optional[str] = None
+    reset_signatures: bool = True
+    reset_comments: bool = True
+
+class UserMoveData(BaseModel):
+    ids: List[int]
+    target_nomina_id: int
+    on_conflict: str = "fail"
+
+class NominaMergeData(BaseModel):
+    target_nomina_id: int
+    on_conflict: str = "fail"
+
 class ProductQuantityData(BaseModel):
     quantity: int
 
@@ -154,6 +278,18 @@ class BulkImportData(BaseModel):
 class SizeData(BaseModel):
     size: str
 
+class UserIdsData(BaseModel):
+    ids: List[int]
+
+class BatchOperation(BaseModel):
+    method: str = "GET"
+    path: str
+    body: Optional[Any] = None
+
+class BatchData(BaseModel):
+    operations: List[BatchOperation]
+    stop_on_error: bool = False
+
 # Login
 @app.post("/login", tags=["Empleados"])
 async def login(data: LoginData, api_key: str = Depends(require_api_key)):
@@ -261,13 +397,14 @@ async def user_list(nominaId: int, api_key: str = Depends(require_api_key)):
     
     try:
         results = await get_users(nominaId)
-        return results
+        return journal.pending.apply(results)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al obtener usuarios: {str(e)}")
 
 # Obtener usuarios con paginación
 @app.get("/users/paginated", tags=["Usuarios"])
-async def user_list_paginated(nominaId: int, page: int = 1, limit: int = 8, api_key: str = Depends(require_api_key)):
+async def user_list_paginated(nominaId: int, page: int = 1, limit: int = 8, include: Optional[str] = None, api_key: str = Depends(require_api_key)):
+    includes = parse_include(include)
     if not nominaId:
         raise HTTPException(status_code=400, detail="Falta nominaId en la query")
     
@@ -278,6 +415,9 @@ async def user_list_paginated(nominaId: int, page: int = 1, limit: int = 8, api_
     
     try:
         result = await get_users_paginated(nominaId, offset, limit)
+        result = {**result, "users": journal.pending.apply(result["users"])}
+        if "products" in includes:
+            result = {**result, "users": await embed_products(result["users"])}
         return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al obtener usuarios: {str(e)}")
@@ -328,6 +468,10 @@ async def user_update_comment(id: int, data: CommentData, api_key: str = Depends
         raise HTTPException(status_code=400, detail="Datos incompletos")
     
     try:
+        if journal.SIGNATURE_WRITE_BEHIND:
+            # Confirmado en el journal local; la base se actualiza en segundo plano
+            await journal.signatures.submit(id, data.comment, data.signature, data.performedBy, data.signatureDate)
+            return {"success": True, "pending": True}
         await update_user_comment_signature(id, data.comment, data.signature, data.performedBy, data.signatureDate)
         return {"success": True}
     except Exception as e:
@@ -344,15 +488,27 @@ async def user_delete(id: int, api_key: str = Depends(require_api_key)):
 
 # Exportar a Excel
 @app.get("/exportExcel", tags=["Excel"])
-async def export_excel(nominaId: int, api_key: str = Depends(require_api_key)):
+async def export_excel(nominaId: int, format: str = "json", api_key: str = Depends(require_api_key),
+                       _slot: None = Depends(admit("export")), _budget: None = Depends(statement_budget(60000))):
     if not nominaId:
         raise HTTPException(status_code=400, detail="Falta el parámetro nominaId")
+    if format not in exports.FORMATS:
+        raise HTTPException(status_code=400, detail=f"Formato inválido; opciones: {', '.join(exports.FORMATS)}")
     
     try:
-        results = await export_excel_query(nominaId)
-        return results
+        # Snapshot por versión de la nómina (las archivadas se leen del archivo)
+        path, rows = await exports.snapshot(nominaId, format)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al exportar datos: {str(e)}")
+    filename = None if format == "json" else f"nomina-{nominaId}.{format}"
+    background = None
+    if rows is not None and not os.path.exists(path):
+        # La nómina cambió o se desalojó el archivo mientras se generaba
+        if format == "json":
+            return rows
+        path = await asyncio.to_thread(exports.render_temp, format, rows)
+        background = BackgroundTask(os.remove, path)
+    return FileResponse(path, media_type=exports.FORMATS[format], filename=filename, background=background)
 
 # Agregar nómina
 @app.post("/nomina", tags=["Excel"])
@@ -395,19 +551,22 @@ async def product_update_quantity(id: int, data: ProductQuantityData, api_key: s
 
 # Buscar usuarios
 @app.get("/users/search", tags=["Usuarios"])
-async def users_search(q: Optional[str] = None, api_key: str = Depends(require_api_key)):
+async def users_search(q: Optional[str] = None, api_key: str = Depends(require_api_key),
+                       _budget: None = Depends(statement_budget(2000))):
     if not q:
         return []
     
     try:
         users = await search_all_users(q)
-        return users
+        return journal.pending.apply(users)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error interno al buscar usuarios: {str(e)}")
 
 # Buscar usuarios dentro de una nómina específica
 @app.get("/nomina/{nomina_id}/users/search", tags=["Usuarios"])
-async def nomina_users_search(nomina_id: int, q: Optional[str] = None, api_key: str = Depends(require_api_key)):
+async def nomina_users_search(nomina_id: int, q: Optional[str] = None, include: Optional[str] = None, api_key: str = Depends(require_api_key),
+                              _budget: None = Depends(statement_budget(2000))):
+    includes = parse_include(include)
     if not nomina_id:
         raise HTTPException(status_code=400, detail="ID de nómina requerido")
     
@@ -415,7 +574,9 @@ async def nomina_users_search(nomina_id: int, q: Optional[str] = None, api_key:
         return []
     
     try:
-        users = await search_users_in_nomina(nomina_id, q)
+        users = journal.pending.apply(await search_users_in_nomina(nomina_id, q))
+        if "products" in includes:
+            users = await embed_products(users)
         return users
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error interno al buscar usuarios en nómina: {str(e)}")
@@ -501,22 +662,58 @@ async def report(nominaId: int, api_key: str = Depends(require_api_key)):
         raise HTTPException(status_code=400, detail="Falta nominaId")
     try:
         result = await get_report_counts(nominaId)
+        if not result["total"]:
+            result = archive.report_counts(nominaId) or result
         return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al obtener reporte: {str(e)}")
 
-# Importación masiva de usuarios y productos
+# Firmas por hora/día de un cliente, opcionalmente por empleado o nómina
+@app.get("/analytics/signatures", tags=["Reporte"])
+async def signature_analytics(clientId: int, granularity: str = "day", group_by: Optional[str] = None,
+                              since: Optional[datetime] = None, until: Optional[datetime] = None,
+                              nominaId: Optional[int] = None, api_key: str = Depends(require_api_key)):
+    """
+    Uso: /analytics/signatures?clientId=3&granularity=day&group_by=employee (por defecto los
+    últimos 30 días). Se lee del rollup signature_rollup, no de app_user.
+    """
+    if granularity not in SIGNATURE_STATS_GRANULARITIES:
+        raise HTTPException(status_code=400, detail=f"granularity inválida; opciones: {', '.join(SIGNATURE_STATS_GRANULARITIES)}")
+    if group_by is not None and group_by not in SIGNATURE_STATS_GROUPS:
+        raise HTTPException(status_code=400, detail=f"group_by inválido; opciones: {', '.join(SIGNATURE_STATS_GROUPS)}")
+    until = until or datetime.now()
+    since = since or until - timedelta(days=30)
+    if since >= until:
+        raise HTTPException(status_code=400, detail="since debe ser anterior a until")
+    if until - since > timedelta(days=400):
+        raise HTTPException(status_code=400, detail="El rango máximo es de 400 días")
+    try:
+        series = await get_signature_stats(clientId, since, until, granularity, group_by, nominaId)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error al obtener estadísticas: {str(e)}")
+    return {
+        "clientId": clientId,
+        "granularity": granularity,
+        "since": since,
+        "until": until,
+        "total": sum(r["signatures"] for r in series),
+        "series": series,
+    }
+
+# Importación masiva de usuarios y productos (?dry_run=true solo valida y devuelve el reporte por fila)
 @app.post("/import_bulk", tags=["Excel"])
-async def import_bulk(data: BulkImportData, api_key: str = Depends(require_api_key)):
+async def import_bulk(data: BulkImportData, dry_run: bool = False, api_key: str = Depends(require_api_key), _slot: None = Depends(admit("bulk"))):
     try:
-        result = await insert_bulk_users_products(data.dict())
+        result = await insert_bulk_users_products(data.dict(), dry_run=dry_run)
         return result
+    except BulkValidationError as e:
+        raise HTTPException(status_code=422, detail=e.report)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error interno al importar: {str(e)}")
 
 # Obtener usuarios con productos
 @app.get("/users_with_products", tags=["Usuarios"])
-async def users_with_products(nominaId: int, api_key: str = Depends(require_api_key)):
+async def users_with_products(nominaId: int, api_key: str = Depends(require_api_key), _slot: None = Depends(admit("export"))):
     """
     Devuelve todos los usuarios de una nómina con sus productos incluidos (en 'products').
     Uso: /users_with_products?nominaId=123
@@ -525,10 +722,159 @@ async def users_with_products(nominaId: int, api_key: str = Depends(require_api_
         raise HTTPException(status_code=400, detail="Falta nominaId en la query")
     try:
         results = await get_users_with_products(nominaId)
-        return results
+        return journal.pending.apply(results)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error interno al obtener usuarios con productos: {str(e)}")
 
+# Token para abrir el stream con EventSource: /nomina/{id}/events?token=...
+@app.get("/nomina/{nomina_id}/events/token", tags=["Nominas"])
+async def nomina_events_token(nomina_id: int, api_key: str = Depends(require_api_key)):
+    return stream_token(API_KEY, nomina_id)
+
+# Eventos en vivo de una nómina (Server-Sent Events): firmas, cambios de productos, altas y bajas
+@app.get("/nomina/{nomina_id}/events", tags=["Nominas"])
+async def nomina_events(nomina_id: int, _auth: None = Depends(require_stream_auth)):
+    subscription = hub.subscribe(nomina_id)
+    return StreamingResponse(
+        hub.stream(subscription),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# Sincronización incremental para tablets: usuarios y productos cambiados desde un token
+@app.get("/nomina/{nomina_id}/changes", tags=["Nominas"])
+async def nomina_changes(nomina_id: int, since: Optional[int] = None, limit: int = 5000, api_key: str = Depends(require_api_key)):
+    """
+    Uso: /nomina/123/changes?since=<token>. Sin since (o con un token demasiado antiguo)
+    devuelve la nómina completa con reset=true; en ambos casos hay que guardar el token
+    devuelto y pedir de nuevo mientras has_more sea true.
+    """
+    if limit < 1 or limit > 20000:
+        raise HTTPException(status_code=400, detail="limit debe estar entre 1 y 20000")
+    try:
+        return await get_nomina_changes(nomina_id, since, limit)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error interno al obtener cambios: {str(e)}")
+
+# Archivar una nómina cerrada (usuarios, productos y firmas pasan a archivos comprimidos)
+@app.post("/nomina/{nomina_id}/archive", tags=["Nominas"])
+async def nomina_archive(nomina_id: int, api_key: str = Depends(require_api_key), _slot: None = Depends(admit("bulk"))):
+    try:
+        return await archive.archive_nomina(nomina_id)
+    except archive.ArchiveError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error interno al archivar nómina: {str(e)}")
+
+# Devolver una nómina archivada a las tablas calientes
+@app.post("/nomina/{nomina_id}/restore", tags=["Nominas"])
+async def nomina_restore(nomina_id: int, api_key: str = Depends(require_api_key), _slot: None = Depends(admit("bulk"))):
+    try:
+        return await archive.restore_nomina(nomina_id)
+    except archive.ArchiveError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error interno al restaurar nómina: {str(e)}")
+
+# Clonar una nómina para una nueva temporada (la copia se hace dentro de MySQL)
+@app.post("/nomina/{nomina_id}/clone", tags=["Nominas"])
+async def nomina_clone(nomina_id: int, data: Optional[NominaCloneData] = None, api_key: str = Depends(require_api_key),
+                       _slot: None = Depends(admit("bulk"))):
+    data = data or NominaCloneData()
+    try:
+        result = await clone_nomina(nomina_id, data.name, data.reset_signatures, data.reset_comments)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error interno al clonar nómina: {str(e)}")
+    if result is None:
+        raise HTTPException(status_code=404, detail="Nómina no encontrada")
+    return result
+
+# Mover usuarios (con sus productos) a otra nómina en una sola transacción
+@app.post("/users/move", tags=["Usuarios"])
+async def users_move(data: UserMoveData, api_key: str = Depends(require_api_key), _slot: None = Depends(admit("bulk"))):
+    """
+    on_conflict decide qué pasa si un RUT ya existe en la nómina destino: fail (409, no se
+    mueve nada), skip (esos usuarios se quedan donde están) o replace (se eliminan los del destino).
+    """
+    if data.on_conflict not in MOVE_CONFLICT_POLICIES:
+        raise HTTPException(status_code=400, detail=f"on_conflict inválido; opciones: {', '.join(MOVE_CONFLICT_POLICIES)}")
+    if len(data.ids) > MAX_BATCH_IDS:
+        raise HTTPException(status_code=400, detail=f"Máximo {MAX_BATCH_IDS} usuarios por solicitud")
+    return await _run_move(move_users(data.ids, data.target_nomina_id, data.on_conflict))
+
+# Fusionar una nómina completa en otra
+@app.post("/nomina/{nomina_id}/merge", tags=["Nominas"])
+async def nomina_merge(nomina_id: int, data: NominaMergeData, api_key: str = Depends(require_api_key),
+                       _slot: None = Depends(admit("bulk"))):
+    if data.on_conflict not in MOVE_CONFLICT_POLICIES:
+        raise HTTPException(status_code=400, detail=f"on_conflict inválido; opciones: {', '.join(MOVE_CONFLICT_POLICIES)}")
+    return await _run_move(merge_nomina(nomina_id, data.target_nomina_id, data.on_conflict))
+
+async def _run_move(operation):
+    try:
+        return await operation
+    except MoveConflictError as e:
+        raise HTTPException(status_code=409, detail={"message": str(e), "conflicts": e.conflicts})
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error interno al mover usuarios: {str(e)}")
+
+# Índice de nóminas archivadas
+@app.get("/archive", tags=["Nominas"])
+async def archive_list(api_key: str = Depends(require_api_key)):
+    return archive.index.all()
+
+class ProfileArmData(BaseModel):
+    path: str
+    count: int = 1
+    query: Optional[str] = None
+    method: Optional[str] = None
+
+def require_profiling():
+    if not profiling.PROFILING_ENABLED:
+        raise HTTPException(status_code=404, detail="Profiler deshabilitado (PROFILING_ENABLED=1)")
+
+# Perfilar los próximos N requests a un path (p. ej. /users/search con query "nominaId=42")
+@app.post("/admin/profile", tags=["Monitoreo"])
+async def profile_arm(data: ProfileArmData, api_key: str = Depends(require_api_key), _enabled: None = Depends(require_profiling)):
+    if not data.path.startswith("/"):
+        raise HTTPException(status_code=400, detail="path inválido")
+    if not 1 <= data.count <= 100:
+        raise HTTPException(status_code=400, detail="count debe estar entre 1 y 100")
+    return await profiling.arm(data.path, data.count, data.query, data.method)
+
+@app.get("/admin/profile", tags=["Monitoreo"])
+async def profile_armed(api_key: str = Depends(require_api_key), _enabled: None = Depends(require_profiling)):
+    return profiling.armed()
+
+@app.delete("/admin/profile/{trigger_id}", tags=["Monitoreo"])
+async def profile_disarm(trigger_id: str, api_key: str = Depends(require_api_key), _enabled: None = Depends(require_profiling)):
+    if not await profiling.disarm(trigger_id):
+        raise HTTPException(status_code=404, detail="Disparador no encontrado")
+    return {"message": "Disparador eliminado"}
+
+# Perfiles guardados: resumen, SQL con tiempos y pilas colapsadas para el flame graph
+@app.get("/admin/profiles", tags=["Monitoreo"])
+async def profile_list(api_key: str = Depends(require_api_key), _enabled: None = Depends(require_profiling)):
+    return await asyncio.to_thread(profiling.list_profiles)
+
+@app.get("/admin/profiles/{profile_id}", tags=["Monitoreo"])
+async def profile_detail(profile_id: str, api_key: str = Depends(require_api_key), _enabled: None = Depends(require_profiling)):
+    data = await asyncio.to_thread(profiling.load_profile, profile_id)
+    if data is None:
+        raise HTTPException(status_code=404, detail="Perfil no encontrado")
+    return data
+
+@app.get("/admin/profiles/{profile_id}/collapsed", tags=["Monitoreo"])
+async def profile_collapsed(profile_id: str, api_key: str = Depends(require_api_key), _enabled: None = Depends(require_profiling)):
+    path = profiling.collapsed_path(profile_id)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Perfil no encontrado")
+    return FileResponse(path, media_type="text/plain; charset=utf-8", filename=f"{profile_id}.collapsed")
+
 # Manejo de errores 404
 @app.exception_handler(404)
 async def not_found_handler(request, exc):
@@ -544,13 +890,60 @@ async def get_user_by_id(user_id: int, api_key: str = Depends(require_api_key)):
         user = await get_user_by_id_db(user_id)
         if not user:
             raise HTTPException(status_code=404, detail="Usuario no encontrado")
-        return user
+        return journal.pending.apply_one(user)
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al obtener usuario: {str(e)}")
 
-# Ejecutar la aplicación
+# Máximo de IDs por consulta a /users/batch
+MAX_BATCH_IDS = int(os.getenv("MAX_BATCH_IDS", "5000"))
+
+async def resolve_user_batch(ids: List[int]) -> Dict[str, Any]:
+    if not ids:
+        raise HTTPException(status_code=400, detail="Faltan IDs de usuario")
+    ids = list(dict.fromkeys(ids))
+    if len(ids) > MAX_BATCH_IDS:
+        raise HTTPException(status_code=400, detail=f"Máximo {MAX_BATCH_IDS} IDs por consulta")
+    try:
+        found = await get_users_by_ids(ids)
+        found = {i: journal.pending.apply_one(u) for i, u in found.items()}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error al obtener usuarios: {str(e)}")
+    # En el orden pedido, y los que no existen reportados aparte
+    return {
+        "users": [found[i] for i in ids if i in found],
+        "missing": [i for i in ids if i not in found],
+    }
+
+# Obtener varios usuarios por ID: /users/batch?ids=1,2,3
+@app.get("/users/batch", tags=["Usuarios"])
+async def users_batch(ids: str = "", api_key: str = Depends(require_api_key)):
+    try:
+        parsed = [int(i) for i in ids.split(",") if i.strip()]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="ids debe ser una lista de enteros separados por coma")
+    return await resolve_user_batch(parsed)
+
+# Variante POST para listas largas: {"ids": [1, 2, 3]}
+@app.post("/users/batch", tags=["Usuarios"])
+async def users_batch_post(data: UserIdsData, api_key: str = Depends(require_api_key)):
+    return await resolve_user_batch(data.ids)
+
+# Varias operaciones en un solo request (lecturas en paralelo, escrituras en orden)
+@app.post("/batch", tags=["Batch"])
+async def batch_run(data: BatchData, request: Request, api_key: str = Depends(require_api_key)):
+    """
+    Cuerpo: {"operations": [{"method": "GET", "path": "/nomina?clientId=3"},
+    {"method": "POST", "path": "/product", "body": {...}}], "stop_on_error": false}.
+    Responde {"results": [{"status", "body"}, ...]} en el mismo orden, con gzip si se acepta.
+    """
+    operations = [op.dict() for op in data.operations]
+    batch.validate(operations)
+    results = await batch.run(request.app, request.scope, operations, data.stop_on_error)
+    return batch.respond(results, request.headers.get("accept-encoding", ""))
+
+# Ejecutar la aplicación en desarrollo (en producción: gunicorn -c gunicorn.conf.py main:app)
 if __name__ == "__main__":
     port = int(os.getenv("PORT", 3000))
-    uvicorn.run("main:app", host="0.0.0.0", port=port, reload=True)
\ No newline at end of file
+    uvicorn.run("main:app", host="0.0.0.0", port=port, reload=os.getenv("RELOAD") == "1")
\ No newline at end of file
@@ -0,0 +1,118 @@
+import os
+import re
+import time
+import logging
+from typing import Dict, List, Tuple
+
+import mysql.connector
+from mysql.connector import Error, errorcode
+from dotenv import load_dotenv
+
+# Migraciones versionadas del esquema.
+# Cada archivo versions/NNNN_nombre.sql se aplica una sola vez y queda registrado
+# en la tabla schema_migrations.
+
+load_dotenv()
+
+logger = logging.getLogger("migrations")
+
+VERSIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "versions")
+
+_FILENAME = re.compile(r"^(\d{4})_([\w-]+)\.sql$")
+_STATEMENT_END = re.compile(r";\s*$", re.MULTILINE)
+
+# Errores que indican que el objeto ya existe (índice, columna, tabla/vista).
+# Permiten registrar migraciones sobre una base que ya tenía esos cambios aplicados a mano.
+_ALREADY_APPLIED = {
+    errorcode.ER_DUP_KEYNAME,
+    errorcode.ER_DUP_FIELDNAME,
+    errorcode.ER_TABLE_EXISTS_ERROR,
+}
+
+_CREATE_TRACKING_TABLE = """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+  version INT NOT NULL,
+  name VARCHAR(255) NOT NULL,
+  applied_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  duration_ms INT NOT NULL DEFAULT 0,
+  PRIMARY KEY (version)
+)
+"""
+
+
+def connect(database: str = None):
+    """Abre una conexión con la misma configuración de entorno que db.py."""
+    return mysql.connector.connect(
+        host=os.getenv("DB_HOST"),
+        port=int(os.getenv("DB_PORT", "3306")),
+        user=os.getenv("DB_USER"),
+        password=os.getenv("DB_PASSWORD"),
+        database=database or os.getenv("DB_NAME"),
+    )
+
+
+def available() -> List[Tuple[int, str, str]]:
+    """Lista (versión, nombre, ruta) de las migraciones en disco, ordenadas."""
+    found = []
+    for filename in os.listdir(VERSIONS_DIR):
+        match = _FILENAME.match(filename)
+        if match:
+            found.append((int(match.group(1)), match.group(2), os.path.join(VERSIONS_DIR, filename)))
+    return sorted(found)
+
+
+def split_statements(sql: str) -> List[str]:
+    """Separa un script en sentencias (terminadas en ';' al final de línea), sin comentarios."""
+    statements = []
+    for chunk in _STATEMENT_END.split(sql):
+        lines = [line for line in chunk.splitlines() if not line.strip().startswith("--")]
+        statement = "\n".join(lines).strip()
+        if statement:
+            statements.append(statement)
+    return statements
+
+
+def applied(connection) -> Dict[int, Dict]:
+    cursor = connection.cursor(dictionary=True)
+    try:
+        cursor.execute(_CREATE_TRACKING_TABLE)
+        cursor.execute("SELECT version, name, applied_at, duration_ms FROM schema_migrations")
+        return {row["version"]: row for row in cursor.fetchall()}
+    finally:
+        cursor.close()
+
+
+def pending(connection) -> List[Tuple[int, str, str]]:
+    done = applied(connection)
+    return [m for m in available() if m[0] not in done]
+
+
+def upgrade(connection, target: int = None) -> List[int]:
+    """Aplica las migraciones pendientes hasta `target` (inclusive). Devuelve las versiones aplicadas."""
+    done = []
+    for version, name, path in pending(connection):
+        if target is not None and version > target:
+            break
+        with open(path, encoding="utf-8") as f:
+            statements = split_statements(f.read())
+        start = time.perf_counter()
+        cursor = connection.cursor()
+        try:
+            for statement in statements:
+                try:
+                    cursor.execute(statement)
+                except Error as e:
+                    if e.errno not in _ALREADY_APPLIED:
+                        raise
+                    logger.info("Migración %04d: objeto ya existente, se omite (%s)", version, e.msg)
+            duration_ms = int((time.perf_counter() - start) * 1000)
+            cursor.execute(
+                "INSERT INTO schema_migrations (version, name, duration_ms) VALUES (%s, %s, %s)",
+                (version, name, duration_ms),
+            )
+            connection.commit()
+        finally:
+            cursor.close()
+        logger.info("Migración %04d_%s aplicada en %d ms", version, name, duration_ms)
+        done.append(version)
+    return done
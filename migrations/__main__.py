@@ -0,0 +1,57 @@
+import argparse
+import asyncio
+import logging
+import sys
+
+import migrations
+
+
+def cmd_status(args) -> None:
+    connection = migrations.connect()
+    try:
+        done = migrations.applied(connection)
+        for version, name, _ in migrations.available():
+            row = done.get(version)
+            state = f"aplicada {row['applied_at']} ({row['duration_ms']} ms)" if row else "pendiente"
+            print(f"{version:04d}_{name}: {state}")
+    finally:
+        connection.close()
+
+
+def cmd_upgrade(args) -> None:
+    connection = migrations.connect()
+    try:
+        done = migrations.upgrade(connection, args.target)
+        print(f"{len(done)} migraciones aplicadas" + (f": {', '.join(f'{v:04d}' for v in done)}" if done else ""))
+    finally:
+        connection.close()
+
+
+def cmd_check_plans(args) -> None:
+    from migrations.plans import check_plans, report
+
+    findings = asyncio.run(check_plans())
+    for line in report(findings):
+        print(line)
+    problems = [f for f in findings if not f["allowed"]]
+    print(f"{len(problems)} problemas, {len(findings) - len(problems)} permitidos")
+    if problems:
+        sys.exit(1)
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    parser = argparse.ArgumentParser(prog="python -m migrations", description="Migraciones y verificación de planes")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("status", help="Lista migraciones aplicadas y pendientes").set_defaults(func=cmd_status)
+    p_up = sub.add_parser("upgrade", help="Aplica migraciones pendientes")
+    p_up.add_argument("--target", type=int, help="Última versión a aplicar")
+    p_up.set_defaults(func=cmd_upgrade)
+    sub.add_parser("check-plans", help="EXPLAIN de cada consulta de db.py; falla si hay full scans o filesorts") \
+        .set_defaults(func=cmd_check_plans)
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
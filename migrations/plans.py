@@ -0,0 +1,239 @@
+import inspect
+import logging
+import re
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Tuple
+
+import db as dbmod
+from db import db, _fingerprint
+
+# Verificación de planes: ejecuta EXPLAIN sobre cada consulta de db.py y marca
+# full scans y filesorts. Las funciones se llaman con argumentos de muestra; los
+# SELECT se ejecutan de verdad (solo lectura) y las escrituras se capturan sin ejecutarse.
+
+logger = logging.getLogger("migrations.plans")
+
+_HAS_WHERE = re.compile(r"\bWHERE\b", re.IGNORECASE)
+
+# Hallazgos aceptados a conciencia, con el motivo
+ALLOWED = {
+    "search_all_users": "LIKE con comodín inicial sobre todas las nóminas; acotado por LIMIT 3",
+    "clone_nomina": "ROW_NUMBER por RUT ordena los usuarios de una sola nómina para emparejar productos",
+    "get_signature_stats": "agrupa por día/empleado las filas del rollup ya acotadas por (client_id, hour)",
+}
+
+# Funciones que no se pueden ejecutar en modo captura
+SKIP = {
+    "authenticate": "envuelve get_user_by_name",
+    "insert_bulk_users_products": "usa cursores propios; su SELECT se verifica en _extra_statements",
+    "prune_change_log": "su bucle de borrado no termina si el DELETE no se ejecuta; se verifica en _extra_statements",
+}
+
+
+async def _fail_store(*rows):
+    # Corta archive_nomina_rows antes de sus escrituras (quedan capturados los SELECT)
+    raise RuntimeError("modo captura")
+
+
+def _catalog(s: Dict[str, Any]) -> Dict[str, Callable[[], Tuple]]:
+    """Argumentos de muestra por función de db.py."""
+    product = {
+        "sku": "X", "name": "X", "color": "X", "quantity": 1, "size": "M",
+        "user_idUser": s["user_id"], "user_nomina_idNomina": s["nomina_id"],
+        "user_nomina_idClient": s["client_id"],
+    }
+    user = {
+        "rut": s["rut"], "name": "X", "lastName": "X", "sex": "X", "area": "X", "service": "X",
+        "center": "X", "nomina_idNomina": s["nomina_id"], "nomina_idClient": s["client_id"],
+    }
+    return {
+        "get_user_by_name": (s["employee"],),
+        "get_client": (),
+        "add_client": ("X",),
+        "get_employee": (),
+        "delete_employee": (s["employee_id"],),
+        "update_employee": (s["employee_id"], "X", "X", "X"),
+        "add_employee": ("X", "X", "X"),
+        "get_nominas": (s["client_id"],),
+        "delete_nomina": (s["nomina_id"], s["client_id"]),
+        "get_users": (s["nomina_id"],),
+        "get_users_paginated": (s["nomina_id"], 40, 8),
+        "insert_user": (s["rut"], "X", "X", "X", "X", "X", "X", s["nomina_id"], s["client_id"]),
+        "get_products": (s["user_id"],),
+        "get_products_for_users": ([s["user_id"], s["user_id"] - 1],),
+        "get_all_products": (),
+        "update_user_comment_signature": (s["user_id"], "X", "X", "X", "2024-01-01 00:00:00"),
+        "delete_user": (s["user_id"],),
+        "export_excel_query": (s["nomina_id"],),
+        "insert_nomina": ("X", s["client_id"]),
+        "insert_excel_user": (user,),
+        "insert_product": (product,),
+        "update_product_quantity": (s["product_id"], 1),
+        "search_all_users": (s["last_name"][:3],),
+        "delete_client": (s["client_id"],),
+        "update_client": (s["client_id"], "X"),
+        "changeNominaName": (s["nomina_id"], "X"),
+        "delete_product": (s["product_id"],),
+        "update_product_size": (s["product_id"], "M"),
+        "insert_product_return_id": (product,),
+        "get_report_counts": (s["nomina_id"],),
+        "get_users_with_products": (s["nomina_id"],),
+        "get_user_by_id_db": (s["user_id"],),
+        "get_users_by_ids": ([s["user_id"], s["user_id"] - 1],),
+        "search_users_in_nomina": (s["nomina_id"], s["last_name"][:3]),
+        "preflight_bulk_users_products": ({
+            "nomina_idNomina": s["nomina_id"], "nomina_idClient": s["client_id"],
+            "users": [{"rut": s["rut"], "name": "X", "lastName": "X"}],
+        },),
+        "get_nomina_changes": (s["nomina_id"], 1, 100),
+        "get_nomina_version": (s["nomina_id"],),
+        "archive_nomina_rows": (s["nomina_id"], _fail_store),
+        "restore_archived_nomina": (s["nomina_id"], [], []),
+        "clone_nomina": (s["nomina_id"],),
+        "move_users": ([s["user_id"]], s["nomina_id"], "skip"),
+        "merge_nomina": (s["nomina_id"], s["nomina_id"] - 1, "skip"),
+        "get_signature_stats": (s["client_id"], datetime.now() - timedelta(days=30), datetime.now(), "day", "employee"),
+        "apply_signature_batch": ("plans", [{
+            "seq": 1, "ts": 0, "idUser": s["user_id"], "comment": "X", "signature": "X",
+            "performedBy": "X", "signatureDate": "2024-01-01 00:00:00",
+        }]),
+    }
+
+
+def _extra_statements(s: Dict[str, Any]) -> List[Tuple[str, str, tuple]]:
+    # Las mismas constantes que usa db.py: si cambian allá, se verifica lo nuevo
+    return [(
+        "insert_bulk_users_products",
+        dbmod._BULK_IDS_BY_RUT.format("%s, %s"),
+        (s["rut"], s["rut"], s["nomina_id"], s["client_id"]),
+    ), (
+        "prune_change_log",
+        dbmod._PRUNE_THROUGH,
+        (dbmod.CHANGE_LOG_RETENTION_DAYS,),
+    ), (
+        "prune_change_log",
+        dbmod._PRUNE_DELETE,
+        (1,),
+    ), (
+        "prune_change_log",
+        dbmod._PRUNE_LEFT,
+        (1,),
+    )]
+
+
+def _samples() -> Dict[str, Any]:
+    def first(query: str) -> Dict:
+        rows, _ = db.execute_query(query)
+        return rows[0] if rows else {}
+
+    user = first("SELECT idUser, rut, lastName, nomina_idNomina, nomina_idClient FROM app_user ORDER BY idUser DESC LIMIT 1")
+    product = first("SELECT idProduct FROM product ORDER BY idProduct DESC LIMIT 1")
+    employee = first("SELECT idEmployee, name FROM employee LIMIT 1")
+    return {
+        "user_id": user.get("idUser", 1),
+        "rut": user.get("rut", "1-9"),
+        "last_name": user.get("lastName") or "Gon",
+        "nomina_id": user.get("nomina_idNomina", 1),
+        "client_id": user.get("nomina_idClient", 1),
+        "product_id": product.get("idProduct", 1),
+        "employee_id": employee.get("idEmployee", 1),
+        "employee": employee.get("name", "X"),
+    }
+
+
+async def _capture(samples: Dict[str, Any]) -> List[Tuple[str, str, tuple]]:
+    """Llama cada función del catálogo registrando (función, sql, params) de cada sentencia."""
+    captured: List[Tuple[str, str, tuple]] = []
+    current = {"name": None}
+    original = db.execute
+
+    async def capturing(query, params=None, **kwargs):
+        captured.append((current["name"], query, params or ()))
+        if _fingerprint(query)[1] == "SELECT":
+            return await original(query, params, **kwargs)
+        return [], None
+
+    db.execute = capturing
+    try:
+        for name, args in _catalog(samples).items():
+            current["name"] = name
+            try:
+                await getattr(dbmod, name)(*args)
+            except Exception as e:
+                # Las sentencias previas al error ya quedaron capturadas
+                logger.debug("%s terminó con error en modo captura: %s", name, e)
+    finally:
+        del db.execute
+    return captured
+
+
+def _explain(query: str, params: tuple) -> List[Dict]:
+    with db.primary.connection() as connection:
+        cursor = connection.cursor(dictionary=True)
+        try:
+            cursor.execute("EXPLAIN " + query.strip().rstrip(";"), params)
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+
+
+async def check_plans() -> List[Dict]:
+    """Devuelve la lista de hallazgos; cada uno indica si está permitido."""
+    db.connect()
+    samples = _samples()
+    statements = await _capture(samples) + _extra_statements(samples)
+
+    findings: List[Dict] = []
+    catalog = _catalog(samples)
+    for name, fn in inspect.getmembers(dbmod, inspect.iscoroutinefunction):
+        # Los helpers privados se cubren a través de las funciones que los llaman
+        if (fn.__module__ == dbmod.__name__ and not name.startswith("_")
+                and name not in catalog and name not in SKIP):
+            findings.append({"function": name, "problem": "sin cobertura en plans._catalog", "allowed": False})
+
+    seen = set()
+    for name, query, params in statements:
+        normalized, op = _fingerprint(query)
+        if (name, normalized) in seen:
+            continue
+        seen.add((name, normalized))
+        if op == "INSERT" and "SELECT" not in normalized.upper():
+            continue
+        try:
+            rows = _explain(query, params)
+        except Exception as e:
+            findings.append({"function": name, "statement": normalized[:200], "problem": f"EXPLAIN falló: {e}", "allowed": False})
+            continue
+        has_where = bool(_HAS_WHERE.search(normalized))
+        for row in rows:
+            extra = row.get("Extra") or ""
+            problems = []
+            if row.get("type") == "ALL" and has_where:
+                problems.append("full scan")
+            if "Using filesort" in extra:
+                problems.append("filesort")
+            for problem in problems:
+                findings.append({
+                    "function": name,
+                    "statement": normalized[:200],
+                    "table": row.get("table"),
+                    "type": row.get("type"),
+                    "key": row.get("key"),
+                    "rows": row.get("rows"),
+                    "extra": extra,
+                    "problem": problem,
+                    "allowed": name in ALLOWED,
+                    "reason": ALLOWED.get(name),
+                })
+    return findings
+
+
+def report(findings: List[Dict]) -> List[str]:
+    lines = []
+    for f in findings:
+        status = "OK (permitido)" if f["allowed"] else "REVISAR"
+        where = f" tabla={f['table']} type={f['type']} key={f['key']} rows={f['rows']}" if "table" in f else ""
+        lines.append(f"[{status}] {f['function']}: {f['problem']}{where}")
+        if f.get("statement"):
+            lines.append(f"    {f['statement']}")
+    return lines
@@ -0,0 +1,63 @@
+-- Esquema base: tablas y vista que usa db.py.
+-- Usa IF NOT EXISTS para poder registrarse sobre una base de producción existente.
+
+CREATE TABLE IF NOT EXISTS client (
+  idClient INT NOT NULL AUTO_INCREMENT,
+  name VARCHAR(255) NOT NULL,
+  PRIMARY KEY (idClient)
+);
+
+CREATE TABLE IF NOT EXISTS employee (
+  idEmployee INT NOT NULL AUTO_INCREMENT,
+  name VARCHAR(100) NOT NULL,
+  password VARCHAR(255) NOT NULL,
+  role VARCHAR(45) NOT NULL,
+  PRIMARY KEY (idEmployee)
+);
+
+CREATE TABLE IF NOT EXISTS nomina (
+  idNomina INT NOT NULL AUTO_INCREMENT,
+  name VARCHAR(255) NOT NULL,
+  client_idClient INT NOT NULL,
+  PRIMARY KEY (idNomina, client_idClient),
+  KEY fk_nomina_client_idx (client_idClient)
+);
+
+CREATE TABLE IF NOT EXISTS app_user (
+  idUser INT NOT NULL AUTO_INCREMENT,
+  rut VARCHAR(20) NOT NULL,
+  name VARCHAR(100) NOT NULL,
+  lastName VARCHAR(100) NOT NULL,
+  sex VARCHAR(20) NULL,
+  area VARCHAR(255) NULL,
+  service VARCHAR(255) NULL,
+  center VARCHAR(255) NULL,
+  signature LONGTEXT NULL,
+  comment TEXT NULL,
+  employee VARCHAR(100) NULL,
+  signatureDate DATETIME NULL,
+  nomina_idNomina INT NOT NULL,
+  nomina_idClient INT NOT NULL,
+  PRIMARY KEY (idUser),
+  KEY fk_app_user_nomina_idx (nomina_idNomina, nomina_idClient)
+);
+
+CREATE TABLE IF NOT EXISTS product (
+  idProduct INT NOT NULL AUTO_INCREMENT,
+  sku VARCHAR(64) NULL,
+  name VARCHAR(255) NOT NULL,
+  color VARCHAR(64) NULL,
+  quantity INT NOT NULL DEFAULT 0,
+  size VARCHAR(32) NULL,
+  user_idUser INT NOT NULL,
+  user_nomina_idNomina INT NOT NULL,
+  user_nomina_idClient INT NOT NULL,
+  PRIMARY KEY (idProduct),
+  KEY fk_product_app_user_idx (user_idUser, user_nomina_idNomina, user_nomina_idClient)
+);
+
+CREATE VIEW vista_usuarios AS
+SELECT
+  idUser, rut, name, lastName, sex, area, service, center, signature, comment,
+  employee, signatureDate, nomina_idNomina, nomina_idClient
+FROM app_user;
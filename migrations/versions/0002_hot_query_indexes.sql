@@ -0,0 +1,22 @@
+-- Índices compuestos para las consultas calientes de db.py.
+
+-- get_users_paginated / search_users_in_nomina: filtro por nómina ordenado por apellido
+CREATE INDEX idx_app_user_nomina_lastname ON app_user (nomina_idNomina, lastName);
+
+-- export_excel_query / get_users_with_products (ORDER BY rut) y lookup por rut del import masivo
+CREATE INDEX idx_app_user_nomina_rut ON app_user (nomina_idNomina, rut);
+
+-- Búsquedas exactas de rut entre nóminas
+CREATE INDEX idx_app_user_rut ON app_user (rut);
+
+-- Cascada de delete_client
+CREATE INDEX idx_app_user_client ON app_user (nomina_idClient);
+
+-- get_products / delete_user / delete_nomina
+CREATE INDEX idx_product_user ON product (user_idUser);
+
+-- Cascada de delete_client
+CREATE INDEX idx_product_client ON product (user_nomina_idClient);
+
+-- authenticate → get_user_by_name
+CREATE INDEX idx_employee_name ON employee (name);
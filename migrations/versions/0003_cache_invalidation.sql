@@ -0,0 +1,12 @@
+-- Canal de invalidación compartido entre workers (ver invalidation.py).
+
+CREATE TABLE IF NOT EXISTS cache_invalidation (
+  id BIGINT NOT NULL AUTO_INCREMENT,
+  topic VARCHAR(64) NOT NULL,
+  item_key VARCHAR(255) NOT NULL,
+  payload TEXT NULL,
+  origin VARCHAR(64) NOT NULL,
+  created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (id),
+  KEY idx_cache_invalidation_created (created_at)
+);
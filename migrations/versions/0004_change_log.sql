@@ -0,0 +1,26 @@
+-- Registro de cambios por nómina para la sincronización incremental de tablets
+-- (GET /nomina/{id}/changes). El id es el token de cambio monotónico.
+
+CREATE TABLE IF NOT EXISTS nomina_change (
+  id BIGINT NOT NULL AUTO_INCREMENT,
+  nomina_id INT NOT NULL,
+  entity ENUM('user', 'product', 'nomina') NOT NULL,
+  entity_id INT NOT NULL,
+  op ENUM('upsert', 'delete') NOT NULL,
+  created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (id),
+  KEY idx_nomina_change_nomina (nomina_id, id),
+  KEY idx_nomina_change_created (created_at)
+);
+
+-- Hasta qué token se purgó el registro; un cliente con un token menor debe resincronizar completo
+CREATE TABLE IF NOT EXISTS change_log_state (
+  id TINYINT NOT NULL,
+  pruned_through BIGINT NOT NULL DEFAULT 0,
+  PRIMARY KEY (id)
+);
+
+INSERT IGNORE INTO change_log_state (id, pruned_through) VALUES (1, 0);
+
+-- Snapshot completo de la sincronización (productos de una nómina)
+CREATE INDEX idx_product_nomina ON product (user_nomina_idNomina);
@@ -0,0 +1,4 @@
+-- Nóminas archivadas en almacenamiento frío (ver archive.py): sus usuarios y productos
+-- ya no están en las tablas calientes.
+
+ALTER TABLE nomina ADD COLUMN archived_at DATETIME NULL;
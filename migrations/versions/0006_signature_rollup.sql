@@ -0,0 +1,22 @@
+-- Firmas por hora, empleado y nómina de cada cliente (GET /analytics/signatures).
+-- Se mantiene de forma incremental desde update_user_comment_signature: cada firma
+-- registrada suma 1 en la hora de su signatureDate. Es un registro de actividad, por lo
+-- que borrar, archivar o mover usuarios no descuenta firmas ya contadas.
+
+CREATE TABLE IF NOT EXISTS signature_rollup (
+  client_id INT NOT NULL,
+  hour DATETIME NOT NULL,
+  employee VARCHAR(100) NOT NULL DEFAULT '',
+  nomina_id INT NOT NULL,
+  signatures INT NOT NULL DEFAULT 0,
+  PRIMARY KEY (client_id, hour, employee, nomina_id)
+);
+
+-- Carga inicial con las firmas existentes
+INSERT INTO signature_rollup (client_id, hour, employee, nomina_id, signatures)
+SELECT nomina_idClient, TIMESTAMP(DATE(signatureDate), MAKETIME(HOUR(signatureDate), 0, 0)),
+       COALESCE(employee, ''), nomina_idNomina, COUNT(*)
+FROM app_user
+WHERE signature IS NOT NULL AND signature != '' AND signatureDate IS NOT NULL
+GROUP BY 1, 2, 3, 4
+ON DUPLICATE KEY UPDATE signatures = VALUES(signatures);
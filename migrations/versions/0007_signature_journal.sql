@@ -0,0 +1,9 @@
+-- Último seq aplicado de cada journal de firmas (write-behind de PUT /user/{id}/comment).
+-- apply_signature_batch lo actualiza en la misma transacción que las firmas, de modo que
+-- al reprocesar un journal tras una caída se omiten las entradas ya confirmadas.
+
+CREATE TABLE IF NOT EXISTS signature_journal (
+  name VARCHAR(100) NOT NULL PRIMARY KEY,
+  seq BIGINT NOT NULL DEFAULT 0,
+  updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+);
@@ -0,0 +1,5 @@
+-- Momento (en microsegundos) del último comentario/firma aplicado a cada usuario.
+-- Con el write-behind de firmas cada worker aplica su propio journal; esta marca impide
+-- que un envío más antiguo, aplicado después, pise al más nuevo (ver apply_signature_batch).
+
+ALTER TABLE app_user ADD COLUMN last_submission_us BIGINT NULL;
@@ -0,0 +1,156 @@
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Dict, Optional
+
+import mysql.connector
+from mysql.connector import Error
+
+from metrics import registry
+from breaker import CircuitBreaker
+
+# Pool de conexiones MySQL por proceso.
+# Con varios workers (ver gunicorn.conf.py) cada uno tiene su propio pool de
+# DB_POOL_SIZE conexiones, dimensionado para que workers × pool quede bajo max_connections.
+
+def db_pool_size() -> int:
+    # Se lee al construir cada pool: gunicorn fija DB_POOL_SIZE en on_starting, después
+    # de importar este módulo en el master
+    return int(os.getenv("DB_POOL_SIZE", "5"))
+
+# Espera máxima (s) por una conexión libre
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+
+# Una conexión ociosa por más de esto (s) se verifica con ping antes de reutilizarla
+DB_POOL_PING_AFTER = float(os.getenv("DB_POOL_PING_AFTER", "30"))
+
+# Tiempo máximo (s) para abrir una conexión; con la base caída cada intento cuesta esto
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", "5"))
+
+POOL_WAIT_SECONDS = registry.histogram(
+    "db_pool_wait_seconds", "Espera para obtener una conexión del pool", ("pool",))
+POOL_TIMEOUTS = registry.counter(
+    "db_pool_timeouts_total", "Esperas por conexión que superaron DB_POOL_TIMEOUT", ("pool",))
+POOL_IN_USE = registry.gauge(
+    "db_pool_in_use", "Conexiones prestadas", ("pool",))
+POOL_SIZE = registry.gauge(
+    "db_pool_size", "Tamaño máximo del pool", ("pool",))
+CONNECT_SECONDS = registry.histogram(
+    "db_connect_duration_seconds", "Tiempo para abrir una conexión a MySQL", ("target",))
+CONNECT_ERRORS = registry.counter(
+    "db_connect_errors_total", "Intentos de conexión fallidos", ("target",))
+
+
+def per_worker_pool_size(max_connections: int, workers: int, instances: int = 1,
+                         share: float = 0.8, reserved: int = 5, cap: int = 20) -> int:
+    """
+    Conexiones por worker para que workers × instancias × pool no supere `share` de
+    max_connections, dejando `reserved` libres para migraciones, KILL QUERY y consola.
+    """
+    budget = int(max_connections * share) - reserved
+    return max(1, min(cap, budget // max(workers * instances, 1)))
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """Pool acotado y thread-safe; las conexiones se abren de forma perezosa."""
+
+    def __init__(self, name: str, config: Dict[str, Any], size: Optional[int] = None,
+                 timeout: float = DB_POOL_TIMEOUT):
+        self.name = name
+        self.config = config
+        self.size = max(db_pool_size() if size is None else size, 1)
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(self.size)
+        self._idle = deque()
+        self._lock = threading.Lock()
+        self._in_use = 0
+        self.breaker = CircuitBreaker(name, self._probe)
+        POOL_SIZE.set(name, value=self.size)
+
+    def _connect(self):
+        start = time.perf_counter()
+        try:
+            connection = mysql.connector.connect(connection_timeout=DB_CONNECT_TIMEOUT, **self.config)
+        except Error as e:
+            CONNECT_ERRORS.inc(self.name)
+            self.breaker.record_failure(e)
+            raise
+        CONNECT_SECONDS.observe(time.perf_counter() - start, self.name)
+        self.breaker.record_success()
+        return connection
+
+    def _probe(self) -> None:
+        connection = mysql.connector.connect(connection_timeout=DB_CONNECT_TIMEOUT, **self.config)
+        try:
+            connection.ping()
+        finally:
+            self._close(connection)
+
+    def acquire(self, timeout: float = None):
+        self.breaker.check()
+        start = time.perf_counter()
+        if not self._slots.acquire(timeout=self.timeout if timeout is None else timeout):
+            POOL_TIMEOUTS.inc(self.name)
+            raise PoolTimeout(f"Sin conexiones libres en el pool {self.name} ({self.size})")
+        POOL_WAIT_SECONDS.observe(time.perf_counter() - start, self.name)
+        try:
+            connection = None
+            while connection is None:
+                with self._lock:
+                    item = self._idle.pop() if self._idle else None
+                if item is None:
+                    connection = self._connect()
+                    break
+                candidate, last_used = item
+                if time.monotonic() - last_used < DB_POOL_PING_AFTER or candidate.is_connected():
+                    connection = candidate
+                else:
+                    self._close(candidate)
+        except BaseException:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._in_use += 1
+            POOL_IN_USE.set(self.name, value=self._in_use)
+        return connection
+
+    def release(self, connection, discard: bool = False) -> None:
+        if discard:
+            self._close(connection)
+        with self._lock:
+            if not discard:
+                self._idle.append((connection, time.monotonic()))
+            self._in_use -= 1
+            POOL_IN_USE.set(self.name, value=self._in_use)
+        self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        connection = self.acquire()
+        discard = False
+        try:
+            yield connection
+        except Error:
+            discard = not connection.is_connected()
+            raise
+        finally:
+            self.release(connection, discard)
+
+    def close_idle(self) -> None:
+        with self._lock:
+            idle, self._idle = list(self._idle), deque()
+        for connection, _ in idle:
+            self._close(connection)
+
+    @staticmethod
+    def _close(connection) -> None:
+        try:
+            connection.close()
+        except Error:
+            pass
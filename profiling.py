@@ -0,0 +1,347 @@
+import os
+import sys
+import json
+import time
+import uuid
+import asyncio
+import threading
+from collections import Counter
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional
+
+from metrics import registry
+from invalidation import channel
+
+# Perfilado bajo demanda de requests en producción (opt-in con PROFILING_ENABLED=1).
+# Se activa para un request con el header X-Profile: 1 (con API key válida) o se arma
+# con POST /admin/profile, en todos los workers, para los próximos N requests que coincidan con un path (y,
+# opcionalmente, un texto del query string, p. ej. nominaId=42). Mientras el request
+# corre, un hilo muestrea cada PROFILE_SAMPLE_MS las pilas del event loop y de los hilos
+# que ejecutan sus consultas, y execute_query anota cada sentencia con su duración.
+# El resultado queda en PROFILE_DIR como <id>.collapsed (formato de flamegraph.pl /
+# speedscope) y <id>.json (SQL y tiempos). Sin PROFILING_ENABLED no se instala nada:
+# el único costo es leer current_profile en cada consulta.
+# El event loop es compartido: las muestras pueden incluir otros requests concurrentes.
+
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "0") == "1"
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_SAMPLE_MS = float(os.getenv("PROFILE_SAMPLE_MS", "5"))
+# Un request perfilado deja de muestrearse pasado este tiempo
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+# Perfiles que se conservan en disco (se borran los más antiguos)
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "50"))
+
+TRIGGER_TOPIC = "profile_trigger"
+
+_MAX_DEPTH = 128
+_MAX_QUERIES = 5000
+
+PROFILED = registry.counter(
+    "profiled_requests_total", "Requests ejecutados bajo el profiler", ("trigger",))
+
+current_profile: ContextVar[Optional["Profile"]] = ContextVar("current_profile", default=None)
+
+
+class Profile:
+    def __init__(self, method: str, path: str, query: str, trigger: str):
+        self.id = time.strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:8]
+        self.method = method
+        self.path = path
+        self.query = query
+        self.trigger = trigger
+        self.started = time.time()
+        self.duration_ms: Optional[float] = None
+        self.status: Optional[int] = None
+        self.queries: List[Dict] = []
+        self.samples: Counter = Counter()
+        self._threads: Dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    def enter_thread(self) -> None:
+        tid = threading.get_ident()
+        with self._lock:
+            self._threads[tid] = self._threads.get(tid, 0) + 1
+
+    def exit_thread(self) -> None:
+        tid = threading.get_ident()
+        with self._lock:
+            if self._threads.get(tid, 0) <= 1:
+                self._threads.pop(tid, None)
+            else:
+                self._threads[tid] -= 1
+
+    def record_query(self, statement: str, sql: str, op: str, target: str, ms: float, rows: Optional[int]) -> None:
+        with self._lock:
+            if len(self.queries) < _MAX_QUERIES:
+                self.queries.append({
+                    "statement": statement, "op": op, "target": target,
+                    "ms": round(ms, 3), "rows": rows, "sql": sql[:2000],
+                })
+
+    def sample(self, frames) -> None:
+        with self._lock:
+            tids = list(self._threads)
+        for tid in tids:
+            frame = frames.get(tid)
+            if frame is not None:
+                self.samples[_collapse(frame)] += 1
+
+    def summary(self) -> Dict:
+        by_statement: Dict[str, Dict] = {}
+        for q in self.queries:
+            entry = by_statement.setdefault(q["statement"], {"count": 0, "ms": 0.0})
+            entry["count"] += 1
+            entry["ms"] = round(entry["ms"] + q["ms"], 3)
+        return {
+            "id": self.id, "method": self.method, "path": self.path, "query": self.query,
+            "trigger": self.trigger, "status": self.status,
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+            "duration_ms": self.duration_ms,
+            "samples": sum(self.samples.values()), "sample_ms": PROFILE_SAMPLE_MS,
+            "sql_ms": round(sum(q["ms"] for q in self.queries), 3),
+            "statements": by_statement,
+            "queries": self.queries,
+        }
+
+
+def _collapse(frame) -> str:
+    stack = []
+    while frame is not None and len(stack) < _MAX_DEPTH:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+class _Sampler(threading.Thread):
+    """Un solo hilo muestrea todos los perfiles activos."""
+
+    def __init__(self):
+        super().__init__(name="profiler", daemon=True)
+        self.active: Dict[str, Profile] = {}
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+
+    def add(self, profile: Profile) -> None:
+        with self.lock:
+            self.active[profile.id] = profile
+        self.wake.set()
+
+    def remove(self, profile: Profile) -> None:
+        with self.lock:
+            self.active.pop(profile.id, None)
+
+    def run(self) -> None:
+        interval = PROFILE_SAMPLE_MS / 1000
+        while True:
+            with self.lock:
+                profiles = list(self.active.values())
+            if not profiles:
+                self.wake.wait()
+                self.wake.clear()
+                continue
+            frames = sys._current_frames()
+            now = time.time()
+            for profile in profiles:
+                if now - profile.started <= PROFILE_MAX_SECONDS:
+                    profile.sample(frames)
+            del frames
+            time.sleep(interval)
+
+
+_sampler: Optional[_Sampler] = None
+
+
+class _Trigger:
+    def __init__(self, trigger_id: str, path: str, query: Optional[str], count: int, method: Optional[str]):
+        self.id = trigger_id
+        self.path = path
+        self.query = query
+        self.method = method.upper() if method else None
+        self.remaining = count
+
+    def matches(self, method: str, path: str, query: str) -> bool:
+        return (self.remaining > 0 and path == self.path
+                and (self.method is None or method == self.method)
+                and (not self.query or self.query in query))
+
+    def as_dict(self) -> Dict:
+        return {"id": self.id, "path": self.path, "query": self.query, "method": self.method, "remaining": self.remaining}
+
+
+# Los disparadores se replican en todos los workers por el canal de invalidación: armar,
+# desarmar y cada request perfilado (los demás descuentan uno de `remaining`). Con el
+# canal de MySQL la réplica tarda hasta INVALIDATION_POLL_SECONDS, así que con tráfico
+# simultáneo en varios workers se pueden perfilar algunos requests de más.
+_triggers: Dict[str, _Trigger] = {}
+# Identifica a este proceso en los mensajes del canal
+_PROCESS = uuid.uuid4().hex
+_background = set()
+
+
+def _on_trigger_message(key: str, payload: Optional[Dict]) -> None:
+    if not payload:
+        return
+    action = payload.get("action")
+    if action == "arm":
+        if key not in _triggers:
+            _triggers[key] = _Trigger(key, payload["path"], payload.get("query"), payload["count"], payload.get("method"))
+    elif action == "disarm":
+        _triggers.pop(key, None)
+    elif action == "used" and payload.get("process") != _PROCESS:
+        trigger = _triggers.get(key)
+        if trigger is not None:
+            trigger.remaining -= 1
+            if trigger.remaining <= 0:
+                _triggers.pop(key, None)
+
+
+channel.subscribe(TRIGGER_TOPIC, _on_trigger_message)
+
+
+async def arm(path: str, count: int = 1, query: Optional[str] = None, method: Optional[str] = None) -> Dict:
+    """Perfila los próximos `count` requests a `path` cuyo query string contenga `query`."""
+    trigger_id = uuid.uuid4().hex[:8]
+    await channel.publish(TRIGGER_TOPIC, trigger_id, {
+        "action": "arm", "path": path, "query": query, "count": count, "method": method,
+    })
+    return _triggers[trigger_id].as_dict()
+
+
+def armed() -> List[Dict]:
+    return [t.as_dict() for t in _triggers.values()]
+
+
+async def disarm(trigger_id: str) -> bool:
+    if trigger_id not in _triggers:
+        return False
+    await channel.publish(TRIGGER_TOPIC, trigger_id, {"action": "disarm"})
+    return True
+
+
+def _take_trigger(method: str, path: str, query: str) -> Optional[str]:
+    for trigger in list(_triggers.values()):
+        if trigger.matches(method, path, query):
+            trigger.remaining -= 1
+            if trigger.remaining <= 0:
+                _triggers.pop(trigger.id, None)
+            return trigger.id
+    return None
+
+
+def _announce_used(trigger_id: str) -> None:
+    # Sin esperar: el request perfilado no debe pagar la escritura del canal
+    task = asyncio.get_running_loop().create_task(
+        channel.publish(TRIGGER_TOPIC, trigger_id, {"action": "used", "process": _PROCESS}))
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+
+
+def _write(profile: Profile) -> None:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    base = os.path.join(PROFILE_DIR, profile.id)
+    with open(base + ".collapsed", "w", encoding="utf-8") as f:
+        for stack, count in profile.samples.most_common():
+            f.write(f"{stack} {count}\n")
+    with open(base + ".json", "w", encoding="utf-8") as f:
+        json.dump(profile.summary(), f, ensure_ascii=False, indent=1)
+    # Se conservan los PROFILE_KEEP más recientes
+    ids = sorted({name.rsplit(".", 1)[0] for name in os.listdir(PROFILE_DIR)
+                  if name.endswith((".json", ".collapsed"))})
+    for old in ids[:-PROFILE_KEEP] if PROFILE_KEEP > 0 else []:
+        for ext in (".json", ".collapsed"):
+            try:
+                os.remove(os.path.join(PROFILE_DIR, old + ext))
+            except FileNotFoundError:
+                pass
+
+
+def _path_for(profile_id: str, ext: str) -> Optional[str]:
+    # Los ids solo tienen dígitos, letras y guiones: nada de rutas arbitrarias
+    if not profile_id.replace("-", "").isalnum():
+        return None
+    path = os.path.join(PROFILE_DIR, profile_id + ext)
+    return path if os.path.exists(path) else None
+
+
+def list_profiles() -> List[Dict]:
+    try:
+        names = sorted((n for n in os.listdir(PROFILE_DIR) if n.endswith(".json")), reverse=True)
+    except FileNotFoundError:
+        return []
+    profiles = []
+    for name in names:
+        with open(os.path.join(PROFILE_DIR, name), encoding="utf-8") as f:
+            data = json.load(f)
+        data.pop("queries", None)
+        profiles.append(data)
+    return profiles
+
+
+def load_profile(profile_id: str) -> Optional[Dict]:
+    path = _path_for(profile_id, ".json")
+    if path is None:
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def collapsed_path(profile_id: str) -> Optional[str]:
+    return _path_for(profile_id, ".collapsed")
+
+
+class ProfilingMiddleware:
+    """
+    Middleware ASGI que corre bajo el profiler los requests con X-Profile: 1 (autorizados
+    con authorize(api_key)) o que coinciden con un disparador armado. La respuesta lleva
+    X-Profile-Id con el id del perfil.
+    """
+
+    def __init__(self, app, authorize: Callable[[Optional[str]], bool]):
+        self.app = app
+        self.authorize = authorize
+
+    def _trigger(self, scope) -> Optional[str]:
+        headers = dict(scope.get("headers") or [])
+        if headers.get(b"x-profile") == b"1":
+            key = headers.get(b"x-api-key")
+            if self.authorize(key.decode("latin-1") if key else None):
+                return "header"
+        if _triggers:
+            trigger_id = _take_trigger(scope["method"], scope["path"], scope.get("query_string", b"").decode("latin-1"))
+            if trigger_id is not None:
+                _announce_used(trigger_id)
+                return "armed"
+        return None
+
+    async def __call__(self, scope, receive, send):
+        trigger = self._trigger(scope) if scope["type"] == "http" else None
+        if trigger is None:
+            await self.app(scope, receive, send)
+            return
+
+        global _sampler
+        if _sampler is None:
+            _sampler = _Sampler()
+            _sampler.start()
+        profile = Profile(scope["method"], scope["path"], scope.get("query_string", b"").decode("latin-1"), trigger)
+        PROFILED.inc(trigger)
+        token = current_profile.set(profile)
+        profile.enter_thread()  # hilo del event loop
+        _sampler.add(profile)
+
+        async def wrapped_send(message):
+            if message["type"] == "http.response.start":
+                profile.status = message["status"]
+                message = {**message, "headers": list(message.get("headers", [])) + [(b"x-profile-id", profile.id.encode())]}
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, wrapped_send)
+        finally:
+            profile.duration_ms = round((time.perf_counter() - start) * 1000, 3)
+            _sampler.remove(profile)
+            profile.exit_thread()
+            current_profile.reset(token)
+            await asyncio.to_thread(_write, profile)
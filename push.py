@@ -0,0 +1,129 @@
+import os
+import hmac
+import json
+import time
+import asyncio
+import hashlib
+from typing import Any, AsyncIterator, Dict, Optional, Set
+
+from metrics import registry
+from invalidation import channel
+
+# Push de cambios por nómina (Server-Sent Events).
+# db.py publica eventos compactos en el canal "nomina_event"; el canal los entrega a
+# este proceso de inmediato y a los demás workers por polling, y el hub los reparte a
+# cada suscriptor de la nómina con un buffer acotado por conexión.
+
+TOPIC = "nomina_event"
+
+# Eventos pendientes por conexión; si se llena, se descartan y se manda "resync"
+PUSH_BUFFER_SIZE = int(os.getenv("PUSH_BUFFER_SIZE", "100"))
+
+# Comentario keep-alive para proxies que cortan conexiones ociosas
+PUSH_KEEPALIVE_SECONDS = float(os.getenv("PUSH_KEEPALIVE_SECONDS", "15"))
+
+# Vigencia (s) del token de stream: EventSource no manda headers, así que el token va en
+# la URL (y en los logs de acceso); por eso vale para una sola nómina y poco tiempo
+PUSH_TOKEN_SECONDS = int(os.getenv("PUSH_TOKEN_SECONDS", "900"))
+
+SUBSCRIBERS = registry.gauge(
+    "push_subscribers", "Conexiones SSE abiertas")
+EVENTS_DELIVERED = registry.counter(
+    "push_events_delivered_total", "Eventos encolados a suscriptores", ("type",))
+OVERFLOWS = registry.counter(
+    "push_buffer_overflows_total", "Buffers llenos (el cliente recibe resync)")
+
+
+def _token_signature(secret: str, nomina_id: int, expires: int) -> str:
+    message = f"{nomina_id}.{expires}".encode()
+    return hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()[:32]
+
+
+def stream_token(secret: str, nomina_id: int) -> Dict[str, Any]:
+    """Token firmado para abrir el stream de una nómina: ?token=<token>."""
+    expires = int(time.time()) + PUSH_TOKEN_SECONDS
+    return {"token": f"{expires}.{_token_signature(secret, nomina_id, expires)}", "expires": expires}
+
+
+def verify_stream_token(secret: str, nomina_id: int, token: Optional[str]) -> bool:
+    expires, _, signature = (token or "").partition(".")
+    if not expires.isdigit() or int(expires) < time.time():
+        return False
+    return hmac.compare_digest(signature, _token_signature(secret, nomina_id, int(expires)))
+
+
+class Subscription:
+    __slots__ = ("nomina_id", "queue")
+
+    def __init__(self, nomina_id: int, size: int):
+        self.nomina_id = nomina_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=size)
+
+    def offer(self, event: Dict[str, Any]) -> None:
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # El cliente va atrasado: se vacía el buffer y se le pide recargar
+            OVERFLOWS.inc()
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait({"type": "resync"})
+
+
+class NominaHub:
+    def __init__(self, buffer_size: int = PUSH_BUFFER_SIZE):
+        self.buffer_size = buffer_size
+        self._subscriptions: Dict[int, Set[Subscription]] = {}
+        self._count = 0
+
+    def subscribe(self, nomina_id: int) -> Subscription:
+        subscription = Subscription(nomina_id, self.buffer_size)
+        self._subscriptions.setdefault(nomina_id, set()).add(subscription)
+        self._count += 1
+        SUBSCRIBERS.set(value=self._count)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        subscribers = self._subscriptions.get(subscription.nomina_id)
+        if subscribers and subscription in subscribers:
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._subscriptions[subscription.nomina_id]
+            self._count -= 1
+            SUBSCRIBERS.set(value=self._count)
+
+    def deliver(self, key: str, event: Optional[Dict[str, Any]]) -> None:
+        """Callback del canal: key es el id de nómina."""
+        if not event:
+            return
+        subscribers = self._subscriptions.get(int(key))
+        if not subscribers:
+            return
+        EVENTS_DELIVERED.inc(event.get("type", ""), amount=len(subscribers))
+        for subscription in subscribers:
+            subscription.offer(event)
+
+    async def stream(self, subscription: Subscription) -> AsyncIterator[str]:
+        """Genera el cuerpo text/event-stream hasta que el cliente se desconecta."""
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscription.queue.get(), PUSH_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"event: {event.get('type', 'message')}\ndata: {json.dumps(event, default=str)}\n\n"
+        finally:
+            self.unsubscribe(subscription)
+
+
+hub = NominaHub()
+channel.subscribe(TOPIC, hub.deliver)
+
+
+async def publish_nomina_event(nomina_id: Optional[int], event_type: str, **data: Any) -> None:
+    """Publica un evento de cambio para los suscriptores de la nómina."""
+    if nomina_id is None:
+        return
+    await channel.publish(TOPIC, nomina_id, {"type": event_type, "ts": time.time(), **data})
@@ -0,0 +1,163 @@
+import os
+import math
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+# Separación lectura/escritura.
+# Las réplicas se configuran con DB_REPLICA_HOSTS="host1:3306,host2:3307" (mismo usuario,
+# clave y base que el primario salvo DB_REPLICA_USER / DB_REPLICA_PASSWORD). Para probar en
+# local basta con dos instancias de MySQL, p. ej. el primario en 3306 y una réplica en 3307.
+
+# Ventana (s) en que las lecturas de un cliente van al primario después de que escribió
+DB_STICKY_SECONDS = float(os.getenv("DB_STICKY_SECONDS", "2"))
+
+# Tiempo (s) que una réplica caída queda fuera de rotación
+DB_REPLICA_RETRY_SECONDS = float(os.getenv("DB_REPLICA_RETRY_SECONDS", "10"))
+
+# Identidad del cliente del request en curso (para read-your-writes)
+current_client: ContextVar[Optional[str]] = ContextVar("current_client", default=None)
+
+# Fuerza el primario para todas las lecturas del contexto en curso
+force_primary: ContextVar[bool] = ContextVar("force_primary", default=False)
+
+
+class _ClientWrites:
+    __slots__ = ("last_write", "wrote_at")
+
+    def __init__(self, last_write: Optional[float]):
+        self.last_write = last_write
+        self.wrote_at: Optional[float] = None
+
+
+# Última escritura informada por el cliente y escrituras del request en curso. El estado
+# viaja con el cliente (X-Last-Write o cookie last_write) porque con varios workers la
+# lectura siguiente puede caer en otro proceso que no vio la escritura.
+current_writes: ContextVar[Optional[_ClientWrites]] = ContextVar("current_writes", default=None)
+
+_MAX_TRACKED_CLIENTS = 10000
+
+
+def replica_configs() -> List[Dict]:
+    """Configuraciones de conexión de las réplicas definidas en DB_REPLICA_HOSTS."""
+    configs = []
+    for item in filter(None, (h.strip() for h in os.getenv("DB_REPLICA_HOSTS", "").split(","))):
+        host, _, port = item.partition(":")
+        configs.append({
+            "host": host,
+            "port": int(port or os.getenv("DB_PORT", "3306")),
+            "user": os.getenv("DB_REPLICA_USER", os.getenv("DB_USER")),
+            "password": os.getenv("DB_REPLICA_PASSWORD", os.getenv("DB_PASSWORD")),
+            "database": os.getenv("DB_NAME"),
+        })
+    return configs
+
+
+class StickyWrites:
+    """Recuerda cuándo escribió cada cliente para mandar sus lecturas al primario un rato."""
+
+    def __init__(self, window: float = DB_STICKY_SECONDS):
+        self.window = window
+        self._last_write: Dict[str, float] = {}
+
+    def record_write(self) -> None:
+        writes = current_writes.get()
+        if writes is not None:
+            writes.wrote_at = time.time()
+        client = current_client.get()
+        if client is None or self.window <= 0:
+            return
+        now = time.monotonic()
+        if len(self._last_write) >= _MAX_TRACKED_CLIENTS:
+            self._last_write = {k: t for k, t in self._last_write.items() if now - t < self.window}
+        self._last_write[client] = now
+
+    def requires_primary(self) -> bool:
+        if force_primary.get():
+            return True
+        writes = current_writes.get()
+        if writes is not None and self.window > 0:
+            last = writes.wrote_at or writes.last_write
+            if last is not None and time.time() - last < self.window:
+                return True
+        client = current_client.get()
+        if client is None:
+            return False
+        last = self._last_write.get(client)
+        return last is not None and time.monotonic() - last < self.window
+
+
+sticky_writes = StickyWrites()
+
+
+@contextmanager
+def primary():
+    """Contexto que envía todas las lecturas al primario (override por llamada o bloque)."""
+    token = force_primary.set(True)
+    try:
+        yield
+    finally:
+        force_primary.reset(token)
+
+
+def _last_write(headers: Dict[bytes, bytes]) -> Optional[float]:
+    raw = headers.get(b"x-last-write")
+    if raw is None:
+        for part in headers.get(b"cookie", b"").split(b";"):
+            name, _, value = part.strip().partition(b"=")
+            if name == b"last_write":
+                raw = value
+                break
+    try:
+        return int(raw) / 1000 if raw else None
+    except ValueError:
+        return None
+
+
+class ReadRoutingMiddleware:
+    """
+    Middleware ASGI que identifica al cliente (header X-Client-Id, o API key + IP) para la
+    ventana read-your-writes, y permite forzar el primario con el header X-Read-Primary: 1.
+    Las respuestas de requests que escribieron llevan X-Last-Write (ms desde epoch) y la
+    cookie last_write; si el cliente los reenvía, sus lecturas van al primario durante
+    DB_STICKY_SECONDS en cualquier worker. Solo puede forzar el primario para sí mismo,
+    lo mismo que ya permite X-Read-Primary, así que no hace falta firmarlos.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope.get("headers") or [])
+        client_id = headers.get(b"x-client-id")
+        if client_id is None:
+            host = (scope.get("client") or ("", 0))[0]
+            client_id = headers.get(b"x-api-key", b"") + b"@" + host.encode()
+        client_token = current_client.set(client_id.decode("latin-1"))
+        primary_token = force_primary.set(headers.get(b"x-read-primary") == b"1")
+        # Las operaciones de /batch pasan de nuevo por aquí: comparten el estado del request
+        # externo, que es el que responde al cliente
+        nested = current_writes.get()
+        writes = nested or _ClientWrites(_last_write(headers))
+        writes_token = current_writes.set(writes)
+
+        async def wrapped_send(message):
+            if message["type"] == "http.response.start" and writes.wrote_at is not None and nested is None:
+                stamp = str(int(writes.wrote_at * 1000)).encode()
+                max_age = str(max(1, math.ceil(DB_STICKY_SECONDS))).encode()
+                message = {**message, "headers": list(message.get("headers", [])) + [
+                    (b"x-last-write", stamp),
+                    (b"set-cookie", b"last_write=" + stamp + b"; Max-Age=" + max_age + b"; Path=/; SameSite=Lax"),
+                ]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, wrapped_send)
+        finally:
+            current_writes.reset(writes_token)
+            force_primary.reset(primary_token)
+            current_client.reset(client_token)
@@ -0,0 +1,34 @@
+import re
+from typing import Optional
+
+# RUT chileno: cuerpo numérico + dígito verificador (módulo 11), p. ej. 12.345.678-5
+
+_RUT = re.compile(r"^(\d{1,8})-?([\dK])$")
+
+
+def check_digit(number: int) -> str:
+    """Dígito verificador de un RUT chileno (módulo 11)."""
+    total, factor = 0, 2
+    while number:
+        total += (number % 10) * factor
+        number //= 10
+        factor = 2 if factor == 7 else factor + 1
+    digit = 11 - (total % 11)
+    return {11: "0", 10: "K"}.get(digit, str(digit))
+
+
+def normalize(rut: str) -> Optional[str]:
+    """Forma canónica '12345678-5' (sin puntos, K mayúscula), o None si el formato no es válido."""
+    match = _RUT.match(rut.strip().replace(".", "").upper()) if isinstance(rut, str) else None
+    if not match:
+        return None
+    return f"{int(match.group(1))}-{match.group(2)}"
+
+
+def is_valid(rut: str) -> bool:
+    """Formato válido y dígito verificador correcto."""
+    canonical = normalize(rut)
+    if canonical is None:
+        return False
+    number, digit = canonical.split("-")
+    return check_digit(int(number)) == digit
@@ -0,0 +1,104 @@
+import os
+import random
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+from fastapi.responses import JSONResponse
+
+from metrics import registry
+
+# Fracción de requests que se miden (0..1). Con 1.0 se mide todo.
+ROUTE_TIMING_SAMPLE_RATE = float(os.getenv("ROUTE_TIMING_SAMPLE_RATE", "1.0"))
+
+ROUTE_SECONDS = registry.histogram(
+    "http_request_duration_seconds", "Latencia por plantilla de ruta", ("method", "route", "status"))
+ROUTE_PHASE_SECONDS = registry.histogram(
+    "http_request_phase_seconds", "Latencia por fase (db, serialization, framework)", ("method", "route", "phase"))
+
+
+class RequestTiming:
+    """Acumulador de tiempos de un request; db.py y la respuesta JSON le suman sus fases."""
+
+    __slots__ = ("start", "db", "db_queries", "serialization")
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.db = 0.0
+        self.db_queries = 0
+        self.serialization = 0.0
+
+    def server_timing(self) -> str:
+        total = time.perf_counter() - self.start
+        framework = max(total - self.db - self.serialization, 0.0)
+        return (
+            f'db;dur={self.db * 1000:.2f};desc="{self.db_queries} queries", '
+            f"serialization;dur={self.serialization * 1000:.2f}, "
+            f"framework;dur={framework * 1000:.2f}, "
+            f"total;dur={total * 1000:.2f}"
+        )
+
+
+# Timing del request en curso (None si el request no fue muestreado)
+current_timing: ContextVar[Optional[RequestTiming]] = ContextVar("current_timing", default=None)
+
+
+class TimedJSONResponse(JSONResponse):
+    """JSONResponse que registra el tiempo de codificación en el request en curso."""
+
+    def render(self, content) -> bytes:
+        timing = current_timing.get()
+        if timing is None:
+            return super().render(content)
+        start = time.perf_counter()
+        try:
+            return super().render(content)
+        finally:
+            timing.serialization += time.perf_counter() - start
+
+
+class RouteTimingMiddleware:
+    """
+    Middleware ASGI que mide la latencia por plantilla de ruta
+    (p. ej. /nomina/{nomina_id}/users/search) y agrega el header Server-Timing.
+    """
+
+    def __init__(self, app, sample_rate: float = ROUTE_TIMING_SAMPLE_RATE):
+        self.app = app
+        self.sample_rate = sample_rate
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or (self.sample_rate < 1.0 and random.random() >= self.sample_rate):
+            await self.app(scope, receive, send)
+            return
+
+        timing = RequestTiming()
+        token = current_timing.set(timing)
+        status_code = 500
+
+        async def send_with_timing(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", timing.server_timing().encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            current_timing.reset(token)
+            self._observe(scope, timing, status_code)
+
+    @staticmethod
+    def _observe(scope, timing: RequestTiming, status_code: int) -> None:
+        route = scope.get("route")
+        # Sin plantilla (404) se agrupa para no crear una serie por path crudo
+        template = getattr(route, "path", None) or "unmatched"
+        method = scope.get("method", "")
+        total = time.perf_counter() - timing.start
+        ROUTE_SECONDS.observe(total, method, template, str(status_code))
+        ROUTE_PHASE_SECONDS.observe(timing.db, method, template, "db")
+        ROUTE_PHASE_SECONDS.observe(timing.serialization, method, template, "serialization")
+        ROUTE_PHASE_SECONDS.observe(max(total - timing.db - timing.serialization, 0.0), method, template, "framework")